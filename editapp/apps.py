@@ -1,5 +1,15 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_save, post_delete
 
 
 class EditAppConfig(AppConfig):
     name = 'editapp'
+
+    def ready(self):
+        # drop cached zones and queue for export when a domain changes
+        from .models import Domain, domain_queue
+        from .zonecache import domain_changed
+        post_save.connect(domain_changed, sender=Domain, dispatch_uid='zonecache_save')
+        post_delete.connect(domain_changed, sender=Domain, dispatch_uid='zonecache_delete')
+        post_save.connect(domain_queue, sender=Domain, dispatch_uid='export_queue_save')
+        post_delete.connect(domain_queue, sender=Domain, dispatch_uid='export_queue_delete')
@@ -0,0 +1,91 @@
+# pull zones from name servers with concurrent zone transfers
+# the transfers run on an asyncio loop in their own thread, the
+# caller reads the results and stores them
+
+import asyncio
+import queue
+import threading
+import dns.asyncquery
+import dns.exception
+import dns.zone
+
+from .zonefile import parsezone
+from . import metrics
+
+def hostport(server, port=53):
+    """
+    split host:port, [v6addr]:port, or a bare host
+    """
+    if server.startswith('['):
+        host, _, p = server[1:].partition(']')
+        return host, int(p[1:]) if p.startswith(':') else port
+    if server.count(':') == 1:
+        host, p = server.split(':')
+        return host, int(p)
+    return server, port
+
+@metrics.flushtask
+def parseworker(zone, text, keepsoa):
+    """
+    parsezone() in a pool worker
+    """
+    return parsezone(zone, text, keepsoa)
+
+async def transfer(zone, server, port, timeout):
+    """
+    AXFR one zone, returns its text in master file format
+    """
+    z = dns.zone.Zone(zone + '.')
+    await asyncio.wait_for(dns.asyncquery.inbound_xfr(server, z, port=port, timeout=timeout), timeout)
+    return z.to_text(relativize=True)
+
+async def transferall(zones, concurrency, timeout, keepsoa, pool, results):
+    """
+    transfer (zone, server, port) with at most concurrency at once, parse
+    them in pool, and put (zone, recs, errors) on results
+    """
+    sem = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_event_loop()
+
+    async def one(zone, server, port):
+        async with sem:
+            try:
+                text = await transfer(zone, server, port, timeout)
+            except asyncio.TimeoutError:
+                results.put((zone, [], ["{0}: timed out".format(server)]))
+                return
+            except (dns.exception.DNSException, OSError, EOFError) as e:
+                results.put((zone, [], ["{0}: {1}".format(server, str(e) or type(e).__name__)]))
+                return
+        results.put(await loop.run_in_executor(pool, parseworker, zone, text, keepsoa))
+
+    await asyncio.gather(*(one(*z) for z in zones))
+
+def axfrzones(zones, concurrency=20, timeout=30, keepsoa=False, pool=None):
+    """
+    transfer and parse zones, generates (zone, recs, errors) in the
+    order they finish, and raises whatever else went wrong
+    zones is [(zone, server, port)], pool an executor for parsing
+    """
+    results = queue.Queue()
+    done = object()
+
+    def run():
+        try:
+            asyncio.run(transferall(zones, concurrency, timeout, keepsoa, pool, results))
+        except Exception as e:
+            results.put(e)
+        finally:
+            results.put(done)
+
+    th = threading.Thread(target=run, daemon=True)
+    th.start()
+    while True:
+        r = results.get()
+        if r is done:
+            break
+        if isinstance(r, Exception):
+            th.join()
+            raise r
+        yield r
+    th.join()
@@ -0,0 +1,303 @@
+# bulk record edits
+# find and replace an address or host name in records across zones,
+# finding the records with the rdata index and committing a batch of
+# zones per transaction, and batches of edits to one zone for the API
+
+from django.db import transaction
+from django.db.models import Case, When, Value, Max
+from django.utils import timezone
+from .models import Domain, Record, RdataRef, PendingExport, Change, parseline, refvalue, rdatarefs, \
+    fieldspans, REFTYPES
+from time import time
+import bisect
+import ipaddress
+
+def qualified(new):
+    """
+    a replacement host name with a trailing dot, so it doesn't turn
+    into a name in each zone it's put in
+    addresses are left alone
+    """
+    new = new.strip()
+    try:
+        ipaddress.ip_address(new)
+        return new
+    except ValueError:
+        pass
+    return new if new.endswith('.') else new + '.'
+
+def substitute(text, old, new, zone):
+    """
+    replace the address and name fields in a line of text that match
+    old with new, leaving the owner and everything else alone
+    returns the new text, or None if nothing matched
+    """
+    target = refvalue(old)
+    hits = [ (start, end) for ftype, start, end in fieldspans(text, parseline(text))
+        if ftype in REFTYPES and refvalue(text[start:end], zone) == target ]
+    for start, end in reversed(hits):
+        text = text[:start] + new + text[end:]
+    return text if hits else None
+
+def matches(old, new, rrtypes=None, domains=None):
+    """
+    records to change, generates (record, newtext, parsed, error)
+    error is None if the new text is valid
+    """
+    for r in RdataRef.records(old, rrtypes, domains):
+        text = substitute(r.text, old, new, r.domain_id)
+        if text is None:
+            continue
+        rec = parseline(text)
+        if not rec.is_valid():
+            yield r, text, rec, rec.err_str() or "Not valid"
+        elif not rec.rr or (rec.rr.rrname, refvalue(new, r.domain_id)) not in rdatarefs(rec, r.domain_id):
+            yield r, text, rec, "New value isn't an address or name field"
+        else:
+            yield r, text, rec, None
+
+def owners(batch):
+    """
+    owner names for records in the batch with blank names, from the
+    previous named record, as {(domain, seq): name}
+    one query rather than one per record
+    """
+    blank = [ r for r, text, rec in batch if not r.name ]
+    if not blank:
+        return {}
+    named = {}
+    for d, seq, name in Record.objects.filter(domain_id__in=set(r.domain_id for r in blank)) \
+            .exclude(name='').order_by('domain', 'seq').values_list('domain', 'seq', 'name'):
+        named.setdefault(d, []).append((seq, name))
+    res = {}
+    for r in blank:
+        prev = [ name for seq, name in named.get(r.domain_id, ()) if seq < r.seq ]
+        res[(r.domain_id, r.seq)] = prev[-1] if prev else ''
+    return res
+
+def applybatch(batch):
+    """
+    save a batch of (record, newtext, parsed) in one transaction
+    journals the changes and updates the index, then touches each
+    zone once rather than once per record
+    records whose text has changed since they were read are left alone
+    returns the ones that were
+    """
+    with transaction.atomic():
+        # lock the zones as editzone() does, then the records
+        zones = sorted(set(r.domain_id for r, text, rec in batch))
+        list(Domain.objects.select_for_update().filter(domain__in=zones).order_by('domain') \
+            .values_list('domain', flat=True))
+        current = dict(Record.objects.select_for_update().filter(id__in=[ r.id for r, text, rec in batch ]) \
+            .order_by('id').values_list('id', 'text'))
+        stale = [ b for b in batch if current.get(b[0].id) != b[0].text ]
+        batch = [ b for b in batch if current.get(b[0].id) == b[0].text ]
+        if not batch:
+            return stale
+        zones = sorted(set(r.domain_id for r, text, rec in batch))
+        own = owners(batch)
+        changes = []
+        for r, text, rec in batch:
+            owner = r.name or own[(r.domain_id, r.seq)]
+            oldkey = (owner, r.ttl, r.rrtype, r.rdata) if r.rrtype and r.valid else None
+            r.settext(text, rec)
+            newkey = (owner, r.ttl, r.rrtype, r.rdata)
+            if oldkey != newkey:
+                if oldkey:
+                    changes.append(Change(domain=r.domain_id, op='del', name=oldkey[0], ttl=oldkey[1],
+                        rrtype=oldkey[2], rdata=oldkey[3]))
+                changes.append(Change(domain=r.domain_id, op='add', name=owner, ttl=r.ttl,
+                    rrtype=r.rrtype, rdata=r.rdata))
+        # only the rdata changes, so one UPDATE for the batch
+        Record.objects.filter(id__in=[ r.id for r, text, rec in batch ]).update(
+            text=Case(*[ When(id=r.id, then=Value(r.text)) for r, text, rec in batch ]),
+            rdata=Case(*[ When(id=r.id, then=Value(r.rdata)) for r, text, rec in batch ]))
+        Change.objects.bulk_create(changes, batch_size=500)
+        # a big OR of (domain, seq) pairs is quadratic in the ORM, so
+        # fetch a superset and pick out the refs to delete
+        keys = set((r.domain_id, r.seq) for r, text, rec in batch)
+        refs = RdataRef.objects.filter(domain_id__in=zones, seq__in=set(seq for d, seq in keys)) \
+            .values_list('id', 'domain', 'seq')
+        RdataRef.objects.filter(id__in=[ i for i, d, seq in refs if (d, seq) in keys ]).delete()
+        RdataRef.add([ r for r, text, rec in batch ])
+        t = timezone.now()
+        Domain.objects.filter(domain__in=zones).update(updated=t, rrsstale=True)
+        PendingExport.queuemany(zones, t)
+    return stale
+
+def replace(old, new, rrtypes=None, domains=None, dryrun=False, batchsize=500, report=None):
+    """
+    replace old with new in records of rrtypes in domains
+    a new host name is always fully qualified
+    commits batchsize zones at a time, dryrun doesn't change anything
+    report(kind, ...) is called with
+      ('change', zone, seq, oldtext, newtext) for each record
+      ('error', zone, seq, oldtext, newtext, errstr) for each bad one,
+      and for each one changed by someone else before its batch
+      ('batch', zones, records, seconds) after each batch is committed
+    returns (records changed, zones changed, errors)
+    """
+    report = report or (lambda *args: None)
+    new = qualified(new)
+    nrecs = nerrs = 0
+    nzones = 0
+    batch = []
+    zones = set()
+
+    def flush():
+        nonlocal nrecs, nerrs
+        t = time()
+        stale = applybatch(batch)
+        for r, text, rec in stale:
+            report('error', r.domain_id, r.seq, r.text, text, "Changed since it was read")
+        nrecs -= len(stale)
+        nerrs += len(stale)
+        staleids = set(r.id for r, text, rec in stale)
+        done = set(r.domain_id for r, text, rec in batch if r.id not in staleids)
+        report('batch', len(done), len(batch) - len(stale), time() - t)
+        return len(done)
+
+    for r, text, rec, err in matches(old, new, rrtypes, domains):
+        if err:
+            report('error', r.domain_id, r.seq, r.text, text, err)
+            nerrs += 1
+            continue
+        report('change', r.domain_id, r.seq, r.text, text)
+        # whole zones go in a batch
+        if r.domain_id not in zones and len(zones) >= batchsize:
+            nzones += len(zones) if dryrun else flush()
+            batch, zones = [], set()
+        batch.append((r, text, rec))
+        zones.add(r.domain_id)
+        nrecs += 1
+
+    if batch:
+        nzones += len(zones) if dryrun else flush()
+    return nrecs, nzones, nerrs
+
+def ownerof(named, seqs, seq):
+    """
+    owner name of record seq given {seq: name} of the named records
+    and their seqs sorted
+    """
+    n = bisect.bisect_right(seqs, seq)
+    return named[seqs[n-1]] if n else ''
+
+def editzone(dom, ops):
+    """
+    apply a list of edits to one zone, call in a transaction
+    each op is a dict with op 'add', 'replace', or 'delete', the
+    record as seq or as its exact text in old, and the new text
+    checks them all first, then writes the records in bulk and touches
+    the zone once
+    returns a result dict for each op, {'ok': True, 'seq': n} or
+    {'ok': False, 'error': why}, and doesn't write anything if any fail
+    """
+    Domain.objects.select_for_update().only('domain').get(domain=dom.domain)
+    dom.checksplit()
+    recs = dom.record_set
+
+    # the records the ops refer to
+    want = [ op['seq'] for op in ops if type(op.get('seq')) is int ]
+    byseq = { r.seq: r for r in recs.filter(seq__in=want) }
+    olds = [ op['old'] for op in ops if op.get('old') is not None and type(op.get('seq')) is not int ]
+    bytext = {}
+    for r in recs.filter(text__in=olds).order_by('seq'):
+        bytext.setdefault(r.text, []).append(r)
+        byseq[r.seq] = r
+    last = recs.aggregate(Max('seq'))['seq__max']
+    nextseq = 0 if last is None else last+1
+
+    named = dict(recs.exclude(name='').values_list('seq', 'name'))
+    before = dict(named)
+    beforeseqs = sorted(before)
+    oldkeys = {}                        # journal keys of changed records as they were
+    changed = {}                        # seq: Record added or replaced
+    deleted = set()
+    added = set()
+    results = []
+    for op in ops:
+        kind = op.get('op')
+        if kind not in ('add', 'replace', 'delete'):
+            results.append({'ok': False, 'error': "Unknown op {0}".format(kind)})
+            continue
+        if kind != 'delete':
+            text = op.get('text')
+            if not isinstance(text, str) or '\n' in text:
+                results.append({'ok': False, 'error': "Need one line of text"})
+                continue
+            rec = parseline(text)
+            if not rec.is_valid():
+                results.append({'ok': False, 'error': rec.err_str() or "Not valid"})
+                continue
+
+        if kind == 'add':
+            r = Record(domain=dom, seq=nextseq)
+            nextseq += 1
+            added.add(r.seq)
+            byseq[r.seq] = r
+        else:
+            r = None
+            if op.get('seq') is not None and type(op['seq']) is not int:
+                # bool is an int too, but true isn't record 1
+                results.append({'ok': False, 'error': "Need an integer seq"})
+                continue
+            if type(op.get('seq')) is int:
+                r = byseq.get(op['seq'])
+            elif op.get('old') is not None:
+                # the first one with that text not already handled
+                for c in bytext.get(op['old'], ()):
+                    if c.seq not in deleted and c.seq not in changed:
+                        r = c
+                        break
+            if r is None or r.seq in deleted:
+                results.append({'ok': False, 'error': "No such record"})
+                continue
+            if r.seq not in oldkeys and r.seq not in added:
+                oldkeys[r.seq] = (ownerof(before, beforeseqs, r.seq), r.ttl, r.rrtype, r.rdata) \
+                    if r.rrtype and r.valid else None
+
+        if kind == 'delete':
+            deleted.add(r.seq)
+            changed.pop(r.seq, None)
+            named.pop(r.seq, None)
+        else:
+            r.settext(text, rec)
+            changed[r.seq] = r
+            if r.name:
+                named[r.seq] = r.name
+            else:
+                named.pop(r.seq, None)
+        results.append({'ok': True, 'seq': r.seq})
+
+    if not all(res['ok'] for res in results):
+        return results
+
+    # journal
+    jn = []
+    namedseqs = sorted(named)
+    for seq, key in oldkeys.items():
+        if key:
+            jn.append(Change(domain=dom.domain, op='del', name=key[0], ttl=key[1], rrtype=key[2], rdata=key[3]))
+    for seq, r in sorted(changed.items()):
+        if r.rrtype and r.valid:
+            jn.append(Change(domain=dom.domain, op='add', name=ownerof(named, namedseqs, seq), ttl=r.ttl,
+                rrtype=r.rrtype, rdata=r.rdata))
+
+    # write
+    adds = [ r for seq, r in changed.items() if seq in added ]
+    reps = [ r for seq, r in changed.items() if seq not in added ]
+    gone = deleted - added
+    recs.filter(seq__in=gone).delete()
+    if reps:
+        upd = {}
+        for f in ('name', 'ttl', 'rrtype', 'rdata', 'text', 'valid'):
+            upd[f] = Case(*[ When(seq=r.seq, then=Value(getattr(r, f))) for r in reps ],
+                output_field=Record._meta.get_field(f))
+        recs.filter(seq__in=[ r.seq for r in reps ]).update(**upd)
+    Record.objects.bulk_create(adds, batch_size=500)
+    RdataRef.objects.filter(domain=dom, seq__in=gone | set(r.seq for r in reps)).delete()
+    RdataRef.add(adds + reps)
+    Change.objects.bulk_create(jn, batch_size=500)
+    dom.touch()
+    return results
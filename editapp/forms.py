@@ -30,3 +30,13 @@ class DomainEditForm(forms.Form):
 
     domain = forms.CharField(label='Domain name', max_length=64)
     owner = forms.CharField(label='User name', max_length=20)
+
+class ReplaceForm(forms.Form):
+    """
+    find and replace an address or host name across zones
+    """
+
+    old = forms.CharField(label='Replace', max_length=255)
+    new = forms.CharField(label='With', max_length=255)
+    rrtypes = forms.CharField(label='Only rrtypes', max_length=100, required=False)
+    domains = forms.CharField(label='Only zones', widget=Textarea(attrs={'rows': 3}), required=False)
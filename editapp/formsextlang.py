@@ -10,7 +10,17 @@ import dns.tokenizer
 import dns.rdataclass
 import dns.exception
 
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
 import re
+import threading
+from time import perf_counter
 
 # field types
 from dnsextlang import ExtFieldS,ExtFieldN, ExtFieldX, ExtFieldA, ExtFieldAA, ExtFieldAAAA, \
@@ -27,26 +37,262 @@ from django import forms
 from django.forms.widgets import Textarea, HiddenInput
 from django.core.exceptions import ValidationError
 from django.http.request import QueryDict
+from django.conf import settings
+from django.core.cache import caches
+from . import metrics
+
+# snapshot of the rrtype descriptions made by manage.py snaprrtypes
+# so workers don't have to look them up in the DNS
+SNAPSHOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rrtypes.json')
+
+class SnapExtlang(Extlang):
+    """
+    Extlang with rrtypes from a snapshot file
+    each rrtype is only made into an Extlangrr the first time it's used
+    """
+    def __init__(self, snapfile):
+        # not super().__init__, there's no file to parse or DNS to ask
+        self.file = snapfile
+        self.domain = None
+        self.lang = None
+        self.resolver = None
+        self.rrs = dict()
+
+        with open(snapfile) as f:
+            snap = json.load(f)
+        self.source = snap['source']
+        # [rrtype, rrname, rrqual, rrcomment, [[type, quals, name, comment], ...]]
+        # indexed by number and name like rrs
+        self.snap = dict()
+        for r in snap['rrtypes']:
+            self.snap[r[0]] = r
+            self.snap[r[1]] = r
+
+    def __getitem__(self, key):
+        """
+        get an extlang object by int rrtype or string name
+        """
+        if type(key) is str:
+            key = key.upper()
+        if key not in self.rrs:
+            r = self.snap.get(key)
+            if not r:
+                return None
+            rtype, rname, rqual, rcomment, fields = r
+            self._stash(rtype, rname, rqual, rcomment,
+                [ dict(zip(('type', 'quals', 'name', 'comment'), f)) for f in fields ])
+        return self.rrs[key]
+
+    def rrnames(self, select=None, obsolete=False):
+        """
+        all of the rrnames in the snapshot
+        perhaps with the experimental and obsolete ones
+        as a list or as an HTML <select>
+        """
+        l = [ k for k, r in self.snap.items() if type(k) is str
+            and (obsolete or not ("O" in (r[2] or "") or "E" in (r[2] or ""))) ]
+        l.sort()
+        if not select:
+            return l
+
+        # HTML select
+        o = "\n".join("<option>{0}</option>".format(r) for r in l)
+        return '<select name="{0}" size="1">\n{1}\n</select>\n'.format(select, o)
+
+    def rrtypes(self, select=None, obsolete=False):
+        """
+        all of the rrtypes in the snapshot, as numbers
+        """
+        l = sorted(self.snap[rr][0] for rr in self.rrnames(obsolete=obsolete))
+        if not select:
+            return l
+
+        # HTML select
+        o = "\n".join("<option>{0}</option>".format(r) for r in l)
+        return '<select name="{0}" size="1">\n{1}\n</select>\n'.format(select, o)
+
+def snapshot(xl, names):
+    """
+    snapshot of the rrtypes names in Extlang xl, in the form SnapExtlang reads
+    """
+    rrtypes = []
+    for n in sorted(set(names)):
+        r = xl[n]
+        if r:
+            rrtypes.append([r.rrtype, r.rrname.upper(), r.rrqual, r.rrcomment,
+                [ [f['type'], f['quals'], f['name'], f['comment']] for f in r.fields ]])
+    return { 'source': os.path.basename(xl.file) if xl.file else xl.domain, 'rrtypes': rrtypes }
+
+def loadextlang():
+    """
+    Extlang from the snapshot if there is one, otherwise from the DNS
+    """
+    snapfile = getattr(settings, 'EXTLANG_SNAPSHOT', SNAPSHOT)
+    if snapfile and os.path.exists(snapfile):
+        return SnapExtlang(snapfile)
+    return Extlang(domain='services.net')
 
 # extlang instance used by all the parsing stuff
-extxl = Extlang(domain='services.net')
+extxl = loadextlang()
 
-def validate_rrs(rrs):
+# time this thread has spent parsing records, for the request
+# timing middleware
+_parse = threading.local()
+
+def parsetime():
     """
-    see if a chunk of code is a valid list of rrs
+    seconds this thread has spent parsing records with dnsextlang
+    """
+    return getattr(_parse, 'secs', 0.0)
+
+class timedparse:
+    """
+    context manager that adds the time spent in it to parsetime()
+    """
+    def __enter__(self):
+        self.start = perf_counter()
+
+    def __exit__(self, *exc):
+        _parse.secs = parsetime() + perf_counter() - self.start
+
+def checkline(line):
+    """
+    parse one line the way ExtrecList does
+    returns (valid, error string)
+    """
+    if not line.strip() or line.strip()[0] == ';': # blank or comment
+        return True, ''
+    try:
+        with timedparse():
+            xr = Extrec(extxl, string=line)
+    except (ExtSyntax, ExtBadField) as e:
+        return False, e.msg or ''
+    return xr.is_valid(), xr.err_str() or ''
+
+def _warm():
+    """
+    pool worker initializer, make all the rrtype descriptions up front
+    """
+    for rr in extxl.rrnames(obsolete=True):
+        extxl[rr]
+
+def _checkchunk(lines):
+    return [ checkline(l) for l in lines ]
+
+logger = logging.getLogger(__name__)
+
+# pool for checkmany, made the first time it's needed
+_pool = None
+
+def _newpool(jobs):
+    """
+    process pool for checkmany
+    the workers are started by a fork server where there is one,
+    rather than forked from this process, since a threaded web server
+    may have other threads holding locks the child would inherit
     """
-    l = ExtrecList(extxl, string=rrs)
-    if not l.is_valid():
-        raise ValidationError(l.err_str())
+    ctx = None
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context('forkserver')
+    return ProcessPoolExecutor(jobs, mp_context=ctx, initializer=_warm)
+
+def checkmany(lines):
+    """
+    checkline() for each of a list of lines, in a process pool if
+    there are more than settings.PARALLEL_CHECK_LINES of them
+    each line is a record so they can be split up anywhere
+    if a worker dies the pool is dropped, these lines are checked
+    here, and the next big batch gets a new pool
+    """
+    global _pool
+    jobs = getattr(settings, 'PARALLEL_CHECK_JOBS', None) or os.cpu_count() or 1
+    if len(lines) < getattr(settings, 'PARALLEL_CHECK_LINES', 5000) or jobs < 2:
+        return _checkchunk(lines)
+    if _pool is None:
+        _pool = _newpool(jobs)
+    size = -(-len(lines) // (jobs * 4))   # a few chunks per worker to even out the load
+    chunks = [ lines[n:n+size] for n in range(0, len(lines), size) ]
+    try:
+        with timedparse():
+            return [ r for res in _pool.map(_checkchunk, chunks) for r in res ]
+    except BrokenProcessPool:
+        logger.warning("check pool is broken, checking %d lines in this process", len(lines))
+        _pool.shutdown(wait=False)
+        _pool = None
+    return _checkchunk(lines)
+
+def linecache():
+    """
+    the django cache for line check results, settings.LINE_CACHE
+    names it, default 'lines', None if there isn't one
+    not the zone cache, a big paste would push all the zones out
+    """
+    name = getattr(settings, 'LINE_CACHE', 'lines')
+    return caches[name] if name in settings.CACHES else None
+
+def checklines(lines, known=()):
+    """
+    (valid, error string) for each distinct line that isn't in known,
+    a set of lines already known to be valid, e.g. the zone's current
+    records
+    results are cached by a hash of the line so unchanged bad lines
+    and lines seen in other zones don't have to be parsed again
+    """
+    todo = set(l for l in lines if l not in known)
+    c = linecache()
+    if c is None:
+        return dict(zip(todo, checkmany(list(todo))))
+    keys = { "line:" + hashlib.sha1(l.encode()).hexdigest(): l for l in todo }
+    res = { keys[k]: v for k, v in c.get_many(list(keys)).items() }
+    new = [ l for l in todo if l not in res ]
+    new = dict(zip(new, checkmany(new)))
+    if new:
+        c.set_many({ k: new[l] for k, l in keys.items() if l in new })
+        res.update(new)
+    return res
+
+def validate_rrs(rrs, known=None):
+    """
+    see if a chunk of code is a valid list of rrs
+    known is a set of lines known to be valid, then only the rest are
+    parsed, with the same result as parsing the lot
+    big chunks are parsed in a process pool, see checkmany()
+    """
+    lines = rrs.splitlines()
+    t = perf_counter()
+    if known is None and len(lines) < getattr(settings, 'PARALLEL_CHECK_LINES', 5000):
+        with timedparse():
+            l = ExtrecList(extxl, string=rrs)
+        metrics.observe('editapp_parse_seconds', perf_counter() - t, kind='block')
+        metrics.inc('editapp_parse_records_total', len(lines), kind='block')
+        if not l.is_valid():
+            raise ValidationError(l.err_str())
+        return
+
+    known = known or ()
+    res = checklines(lines, known)
+    metrics.observe('editapp_parse_seconds', perf_counter() - t, kind='block')
+    metrics.inc('editapp_parse_records_total', sum(1 for l in lines if l not in known), kind='block')
+    bad = [ res[l] for l in lines if l not in known and not res[l][0] ]
+    if bad:
+        raise ValidationError(", ".join(e for v, e in bad if e))
 
 class RRField(forms.CharField):
     """
     a validated text field of RRs
+    set known to a set of lines known to be valid so only changed lines
+    are parsed
     """
     def __init__(self, *args, **kwargs):
         super(RRField, self).__init__(widget=Textarea,
-            validators=[validate_rrs], help_text = "DNS records for a zone",
+            help_text = "DNS records for a zone",
             *args, **kwargs)
+        self.known = None
+
+    def validate(self, value):
+        super(RRField, self).validate(value)
+        if value not in self.empty_values:
+            validate_rrs(value, self.known)
 
 ################
 # create a form on the fly for the fields in an RR
@@ -123,17 +369,18 @@ def fieldfunx(field):
     else:
         validator = [validate_x]
     return forms.CharField(label=field.name, initial=field, help_text="Hex strings" if field.is_multi() else "Hex value",
-        validator=validator)
+        validators=validator)
+
+# pattern for a DNS name, with \nnn octal escapes
+# should use the one in extfieldN
+_namepattern = re.compile(r"""[*0-9a-z_] ((\\[0-7]{3}|[-0-9a-z_])*(\\[0-7]{3}|[0-9a-z_])?)
+    (\.(\\[0-7]{3}|[0-9a-z_])((\\[0-7]{3}|[-0-9a-z_])*(\\[0-7]{3}|[0-9a-z_])?))* \.?|\.""",
+    re.I|re.X)
 
 def validate_n(name):
     """
     validate a domain name
     """
-    # pattern for a DNS name, with \nnn octal escapes
-    # should use the one in extfieldN
-    _namepattern = re.compile(r"""[*0-9a-z_] ((\\[0-7]{3}|[-0-9a-z_])*(\\[0-7]{3}|[0-9a-z_])?)
-        (\.(\\[0-7]{3}|[0-9a-z_])((\\[0-7]{3}|[-0-9a-z_])*(\\[0-7]{3}|[0-9a-z_])?))* \.?|\.""",
-        re.I|re.X)
     r = _namepattern.fullmatch(name) # close enough
     if not r:
         raise ValidationError("Domain name needed")
@@ -182,6 +429,9 @@ class RRForm(forms.Form):
     form to edit a single RR using the fields from dnsextlang
     can be created from a text RR, or a dict of edited values
     or rrname="XXX" for new empty RR
+    what you get is an instance of the subclass for the rrtype from
+    rrformclass(), which already has the fields, so this only has to
+    set the values
     """
 
     # fields common to all rr forms
@@ -192,128 +442,132 @@ class RRForm(forms.Form):
 
     rrname0 = forms.CharField(widget=HiddenInput) # passed back so it knows what to reconstruct
 
+    def __new__(cls, *args, **kwargs):
+        """
+        pick the subclass for the rrtype
+        a string RR is parsed here to find out what it is, and __init__
+        uses the result
+        """
+        rec = None
+        if 'rrname' in kwargs:
+            rrname = kwargs['rrname']
+        elif args and type(args[0]) is str:
+            with timedparse():
+                rec = Extrec(extxl, args[0])
+            if not rec.rr:
+                raise ValidationError(rec.err_str() or "Not a record")
+            rrname = rec.rr.rrname
+        elif args and type(args[0]) in (dict, QueryDict):
+            rrname = args[0]['rrname0']
+        else:
+            # not a string or a querydict, I give up
+            raise ValidationError("Mystery RRForm data")
+        if cls is RRForm:
+            cls = rrformclass(rrname)
+        self = super(RRForm, cls).__new__(cls)
+        self._parsed = rec
+        return self
+
     def __init__(self, *args, **kwargs):
         if 'rrname' in kwargs:          # new empty record
             rrname = kwargs['rrname']
             del kwargs['rrname']
-            super(RRForm, self).__init__(initial = { 'rrname0': rrname }, **kwargs)
 
             # make an empty RR of the right type
             self.rec = Extrec(extxl, rrtype=rrname)
-
-            # visible field if form will be displayed
-            # added here due to binding problem noted below
-            self.fields['rrname'] = forms.CharField(label="rrname",
-                initial=rrname, disabled=True)
-
-            # add fields for rrtype fields
-            for n, f in enumerate(self.rec.fields, start=0):
-                self.fields['rr{0}'.format(n)] = fieldfns[f.fieldtype](f)
+            super(RRForm, self).__init__(initial=self.initialvalues({ 'rrname0': rrname }), **kwargs)
             return
         
         if type(args[0]) is str:        # parse up an string RR into an unbound form
-            rr = args[0]
-            self.rec = Extrec(extxl, rr)
+            self.rec = self._parsed
         
             # populate common fields with values from the rr
-            super(RRForm, self).__init__(initial = { 'name': self.rec.name, 'ttl': self.rec.ttl,
-                    'rrname0': self.rec.rr.rrname }, **kwargs)
-
-            # visible field if form will be displayed
-            # added here due to binding problem noted below
-            self.fields['rrname'] = forms.CharField(label="rrname",
-                initial=self.rec.rr.rrname, disabled=True)
-
-            # add fields for rrtype fields
-            for n, f in enumerate(self.rec.fields, start=0):
-                self.fields['rr{0}'.format(n)] = fieldfns[f.fieldtype](f)
+            super(RRForm, self).__init__(initial=self.initialvalues({ 'name': self.rec.name,
+                    'ttl': self.rec.ttl, 'rrname0': self.rec.rr.rrname }), **kwargs)
             return
         
-        if type(args[0]) in (dict, QueryDict):  # create bound form from dict data
-            qd = args[0]
-            rrname = qd['rrname0']
-            super(RRForm, self).__init__(data=qd)
+        # create bound form from dict data
+        qd = args[0]
+        rrname = qd['rrname0']
+        super(RRForm, self).__init__(data=qd)
             
-            self.rec = Extrec(extxl, noinit=True)  # empty extrec for us to fill
-            self.rec.rr = extxl[rrname]  # set the rrtype
-            self.rec.fields = self.rec.rr.getfields()
-            self.rec.lineno = None
+        self.rec = Extrec(extxl, noinit=True)  # empty extrec for us to fill
+        self.rec.rr = extxl[rrname]  # set the rrtype
+        self.rec.fields = self.rec.rr.getfields()
+        self.rec.lineno = None
             
-            # visible field in case form will be displayed
-            # have to add it here because __init__ doesn't set
-            # disabled fields
-            self.fields['rrname'] = forms.CharField(label="rrname",
-                initial=rrname, disabled=True) # display only for the user
-
-            # optional ttl
-            ttl = qd.get("ttl")
-            if type(ttl) is str and ttl.isdecimal():
-                self.rec.ttl = int(ttl)
-            else:
-                self.rec.ttl = None
-
-            # optional name
-            name = qd.get("name")
-            if name:
-                try:
-                    tok = dns.tokenizer.Token(dns.tokenizer.IDENTIFIER, name, ('\\' in name))
-                except dns.exception.DNSException as e:
-                    raise ValidationError("Invalid name field")
-
-                self.rec.name = fieldclasses["N"]("name", None, None, value=tok)
-            else:
-                self.rec.name = None
-
-            # set up all the fields that have data
-            for n, f in enumerate(self.rec.fields, start=0):
-                fval = qd.get('rr{0}'.format(n))
-                if fval:
-                    # initialize the extlang field
-                    tokens = dns.tokenizer.Tokenizer(fval, filename='<field {0}>'.format(f.name))
-                    if f.multi:
-                        # get as many tokens as there are
-                        toks = []
-                        while True:
-                            try:
-                                tok = tokens.get()
-                            except dns.exception.UnexpectedEnd as e:
-                                raise ValidationError("Truncated %(name)", params={'name': f.name})
-                            
-                            if tok.is_eol_or_eof():
-                                break
-                            toks.append(tok)
-                        f.parse(toks)
-                    else:
-                        # try to get one token
+        # optional ttl
+        ttl = qd.get("ttl")
+        if type(ttl) is str and ttl.isdecimal():
+            self.rec.ttl = int(ttl)
+        else:
+            self.rec.ttl = None
+
+        # optional name
+        name = qd.get("name")
+        if name:
+            try:
+                tok = dns.tokenizer.Token(dns.tokenizer.IDENTIFIER, name, ('\\' in name))
+            except dns.exception.DNSException as e:
+                raise ValidationError("Invalid name field")
+
+            self.rec.name = fieldclasses["N"]("name", None, None, value=tok)
+        else:
+            self.rec.name = None
+
+        # set up all the fields that have data
+        for n, f in enumerate(self.rec.fields, start=0):
+            fval = qd.get('rr{0}'.format(n))
+            if fval:
+                # initialize the extlang field
+                tokens = dns.tokenizer.Tokenizer(fval, filename='<field {0}>'.format(f.name))
+                if f.multi:
+                    # get as many tokens as there are
+                    toks = []
+                    while True:
                         try:
                             tok = tokens.get()
-                        except dns.exception.DNSException as e:
-                            raise ValidationError("Invalid %(name)", params={'name': f.name})
-                        if not tok.is_eol_or_eof():
+                        except dns.exception.UnexpectedEnd as e:
+                            raise ValidationError("Truncated %(name)", params={'name': f.name})
+                            
+                        if tok.is_eol_or_eof():
+                            break
+                        toks.append(tok)
+                    with timedparse():
+                        f.parse(toks)
+                else:
+                    # try to get one token
+                    try:
+                        tok = tokens.get()
+                    except dns.exception.DNSException as e:
+                        raise ValidationError("Invalid %(name)", params={'name': f.name})
+                    if not tok.is_eol_or_eof():
+                        with timedparse():
                             f.parse(tok)
-                        try:
-                            tok = tokens.get()
-                        except dns.exception.DNSException as e:
-                            raise ExtSyntax(e.msg)
+                    try:
+                        tok = tokens.get()
+                    except dns.exception.DNSException as e:
+                        raise ExtSyntax(e.msg)
+
+                # check for junk and end of field
+                if not tok.is_eol_or_eof():
+                    f.valid = False
+                    f.errstr = "junk at end of field"
+                    f.value = fval  # so user can try again
+
+        # set whether the extrec is valid, can be tested in clean() below
+        self.rec.valid = all((f.is_valid() for f in self.rec.fields))
+        if self.rec.valid and self.rec.name:
+            self.rec.valid = self.rec.name.is_valid()
+
+    def initialvalues(self, initial):
+        """
+        add the values of the record's fields to initial
+        """
+        for n, f in enumerate(self.rec.fields, start=0):
+            initial['rr{0}'.format(n)] = f
+        return initial
 
-                    # check for junk and end of field
-                    if not tok.is_eol_or_eof():
-                        f.valid = False
-                        f.errstr = "junk at end of field"
-                        f.value = fval  # so user can try again
-
-                # set up the form field now that it has thed data if
-                # any
-                self.fields['rr{0}'.format(n)] = fieldfns[f.fieldtype](f)
-
-            # set whether the extrec is valid, can be tested in clean() below
-            self.rec.valid = all((f.is_valid() for f in self.rec.fields))
-            if self.rec.valid and self.rec.name:
-                self.rec.valid = self.rec.name.is_valid()
-            return
-        # not a string or a querydict, I give up
-        raise ValidationError("Mystery RRForm data")
-                
     def clean(self):
         """
         splice everything into a text RR if possible
@@ -331,6 +585,45 @@ def validate_comment(comment):
     if comment.strip()[0] != ';':
         raise ValidationError("Not a comment")
 
+class SharedFields(OrderedDict):
+    """
+    base_fields for a per-rrtype form class
+    django deep copies the fields for each form, which costs about as
+    much as making them, but nothing here changes a form's fields so
+    the forms can share them
+    """
+    def __deepcopy__(self, memo):
+        return OrderedDict(self)
+
+# RRForm subclass for each rrtype, made by rrformclass()
+_formclasses = {}
+
+def rrformclass(rrname):
+    """
+    RRForm subclass with fields for the rrtype rrname
+    made the first time it's needed and reused after that, so the
+    django fields and their validators are only set up once
+    """
+    rrname = rrname.upper()
+    cls = _formclasses.get(rrname)
+    if cls:
+        return cls
+    rr = extxl[rrname]
+    if not rr:
+        raise ValidationError("Unknown rrtype %(rrname)s", params={'rrname': rrname})
+
+    # visible field if form will be displayed
+    attrs = { 'rrname': forms.CharField(label="rrname", initial=rr.rrname, disabled=True) }
+    # fields for the rrtype's fields, initial values are set per form
+    for n, f in enumerate(rr.getfields(), start=0):
+        ff = fieldfns[f.fieldtype](f)
+        if ff:
+            attrs['rr{0}'.format(n)] = ff
+    cls = type(RRForm)("RRForm" + re.sub(r'\W', '_', rrname), (RRForm,), attrs)
+    cls.base_fields = SharedFields(cls.base_fields)
+    _formclasses[rrname] = cls
+    return cls
+
 class CommentForm(forms.Form):
     """
     form to edit a single comment line
@@ -0,0 +1,26 @@
+# make or revoke tokens for the JSON API
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from editapp.models import ApiToken
+
+class Command(BaseCommand):
+    help = 'Make a token for the JSON API, or revoke a user\'s tokens'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--revoke', action='store_true', help="Delete the user's tokens")
+        parser.add_argument('user', type=str, help="User the token acts as")
+
+    def handle(self, *args, **options):
+        """
+        print the new token, it can't be retrieved later
+        """
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError("No user " + options['user'])
+        if options['revoke']:
+            n, _ = ApiToken.objects.filter(user=user).delete()
+            print("revoked", n, "tokens")
+        else:
+            print(ApiToken.make(user))
@@ -0,0 +1,367 @@
+# performance benchmarks
+# each one runs in a scratch test database so it doesn't touch real zones
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import F
+from django.contrib.auth.models import User
+from django.test import RequestFactory, Client
+from django.test.utils import override_settings
+from django.utils.timezone import now
+from editapp.models import Domain, RdataRef, ApiToken
+from editapp.formsextlang import SnapExtlang, SNAPSHOT, validate_rrs, RRForm, extxl, linecache
+from editapp import formsextlang
+from editapp.zonecache import zoneview, invalidate
+from editapp.views import indexview
+from editapp.bulkedit import replace
+from dnsextlang import Extlang
+from time import time
+import json
+import os
+import tempfile
+
+def timeit(fn, reps=1):
+    """
+    best time of reps runs of fn, in seconds
+    """
+    best = None
+    for i in range(reps):
+        t = time()
+        fn()
+        t = time() - t
+        best = t if best is None else min(best, t)
+    return best
+
+def benchexport(cmd, options):
+    """
+    incremental export time as the number of zones grows
+    every zone is exported with --all first so the hashes are all
+    there, then --updated should stay flat since it only looks at
+    the queue and the changed zones' hashes
+    """
+    owner = User.objects.create_user(username='bench', password='bench')
+    changed = options['changed']
+    total = 0
+    cmd.stdout.write("{0:>8} {1:>8} {2:>10} {3:>10} {4:>10}".format("zones", "changed", "all", "queue", "scan"))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        zonedir = os.path.join(tmpdir, "zones")
+        os.mkdir(zonedir)
+        for size in options['sizes']:
+            # grow to size zones, all exported
+            t = now()
+            Domain.objects.bulk_create([ Domain(domain="z{0}.example".format(n), owner=owner,
+                updated=t, exported=t, rrs="www A 192.0.2.1\nmail A 192.0.2.2")
+                for n in range(total, size) ], batch_size=500)
+            total = size
+            ta = timeit(lambda: call_command('export', all=zonedir, verbosity=0))
+
+            def change():
+                for n in range(0, total, max(total // changed, 1))[:changed]:
+                    d = Domain.objects.get(domain="z{0}.example".format(n))
+                    d.rrs += "\nz{0} A 192.0.2.3".format(time())
+                    d.save()
+            def export():
+                call_command('export', updated=zonedir, verbosity=0)
+
+            change()
+            tq = timeit(export)
+            # what the old updated > exported comparison costs by itself
+            change()
+            ts = timeit(lambda: list(Domain.objects.filter(updated__gt=F('exported')).values_list('domain')))
+            export()
+            cmd.stdout.write("{0:>8} {1:>8} {2:>9.3f}s {3:>9.3f}s {4:>9.3f}s".format(total, changed, ta, tq, ts))
+
+def benchstartup(cmd, options):
+    """
+    time to load the rrtype descriptions and look up the common ones,
+    from the snapshot and from the DNS or an extlang file
+    """
+    common = ('A', 'AAAA', 'CNAME', 'MX', 'NS', 'SOA', 'TXT', 'SRV')
+    def use(xl):
+        xl.rrnames(select="rrname")
+        for rr in common:
+            xl[rr]
+
+    sources = [ ("snapshot", lambda: SnapExtlang(SNAPSHOT)) ]
+    if options['file']:
+        sources.append((os.path.basename(options['file']), lambda: Extlang(file=options['file'])))
+    else:
+        sources.append(("services.net", lambda: Extlang(domain='services.net')))
+    for name, load in sources:
+        t = time()
+        xl = load()
+        tl = time() - t
+        tu = timeit(lambda: use(xl))
+        cmd.stdout.write("{0:>20} load {1:.4f}s first use {2:.4f}s".format(name, tl, tu))
+
+def benchindex(cmd, options):
+    """
+    time to render the first page of the domain index and a prefix search
+    as the number of zones grows, should stay flat
+    """
+    owner = User.objects.create_user(username='bench', password='bench')
+    total = 0
+    rf = RequestFactory()
+    def page(query):
+        req = rf.get('/edit/', query)
+        req.user = owner
+        indexview(req)
+
+    cmd.stdout.write("{0:>8} {1:>10} {2:>10}".format("zones", "index", "search"))
+    for size in options['sizes']:
+        t = now()
+        Domain.objects.bulk_create([ Domain(domain="z{0}.example".format(n), owner=owner,
+            updated=t, exported=t, rrs="") for n in range(total, size) ], batch_size=500)
+        total = size
+        ti = timeit(lambda: page({}), 3)
+        ts = timeit(lambda: page({'q': 'z5'}), 3)
+        cmd.stdout.write("{0:>8} {1:>9.3f}s {2:>9.3f}s".format(total, ti, ts))
+
+def benchsearch(cmd, options):
+    """
+    time to find the zones that point at an address, from the rdata
+    index and by reading every zone's text
+    """
+    owner = User.objects.create_user(username='bench', password='bench')
+    total = 0
+    cmd.stdout.write("{0:>8} {1:>10} {2:>10} {3:>10}".format("zones", "build", "index", "scan"))
+    for size in options['sizes']:
+        t = now()
+        Domain.objects.bulk_create([ Domain(domain="z{0}.example".format(n), owner=owner,
+            updated=t, exported=t, rrs="www A 10.{0}.{1}.1\n MX 10 mail.example.net.".format(n//250%250, n%250))
+            for n in range(total, size) ], batch_size=500)
+        total = size
+        tb = timeit(lambda: call_command('buildindex', verbosity=0))
+        ti = timeit(lambda: RdataRef.search("10.0.7.1"), 3)
+        ts = timeit(lambda: [ d for d, rrs in Domain.objects.values_list('domain', 'rrs').iterator()
+            if "10.0.7.1" in rrs ], 3)
+        cmd.stdout.write("{0:>8} {1:>9.3f}s {2:>9.4f}s {3:>9.4f}s".format(total, tb, ti, ts))
+
+def benchreplace(cmd, options):
+    """
+    time to replace an MX target in every zone, a batch at a time
+    """
+    owner = User.objects.create_user(username='bench', password='bench')
+    total = 0
+    cmd.stdout.write("{0:>8} {1:>10} {2:>10}".format("zones", "dry run", "replace"))
+    for size in options['sizes']:
+        t = now()
+        Domain.objects.bulk_create([ Domain(domain="z{0}.example".format(n), owner=owner,
+            updated=t, exported=t, rrs="www A 192.0.2.1\n MX 10 mail.old.net.")
+            for n in range(total, size) ], batch_size=500)
+        total = size
+        call_command('buildindex', verbosity=0)
+        td = timeit(lambda: replace("mail.old.net", "mail.new.net.", ["MX"], dryrun=True))
+        tr = timeit(lambda: replace("mail.old.net", "mail.new.net.", ["MX"]))
+        replace("mail.new.net", "mail.old.net.", ["MX"])
+        cmd.stdout.write("{0:>8} {1:>9.3f}s {2:>9.3f}s".format(total, td, tr))
+
+def benchimport(cmd, options):
+    """
+    zone file import throughput with one process and with --jobs
+    """
+    User.objects.create_user(username='bench', password='bench')
+    jobs = os.cpu_count()
+    cmd.stdout.write("{0:>8} {1:>12} {2:>12}".format("zones", "1 job", "{0} jobs".format(jobs)))
+    for size in options['sizes']:
+        with tempfile.TemporaryDirectory() as zonedir:
+            for n in range(size):
+                with open(os.path.join(zonedir, "z{0}.example".format(n)), "w") as fo:
+                    fo.write("$TTL 1h\n@ MX 10 mail\nmail A 192.0.2.1\nwww A 192.0.2.2\n"
+                        "ftp CNAME www\ntxt TXT \"v=spf1 mx -all\"\n")
+            res = []
+            for j in (1, jobs):
+                Domain.objects.all().delete()
+                t = timeit(lambda: call_command('import', zonedir, owner='bench', jobs=j, verbosity=0))
+                res.append(size / t)
+        cmd.stdout.write("{0:>8} {1:>8.0f} z/s {2:>8.0f} z/s".format(size, *res))
+
+def benchapi(cmd, options):
+    """
+    time to add records one at a time through the record form and
+    all at once through the JSON API
+    """
+    owner = User.objects.create_user(username='bench', password='bench')
+    token = ApiToken.make(owner)
+    c = Client()
+    c.force_login(owner)
+    cmd.stdout.write("{0:>8} {1:>10} {2:>10}".format("changes", "forms", "api"))
+    with override_settings(ALLOWED_HOSTS=['*']):
+        for size in options['sizes']:
+            for z in ("form.example", "api.example"):
+                Domain.objects.filter(domain=z).delete()
+                d = Domain.objects.create(domain=z, owner=owner, exported=now(), rrs="; bench")
+                d.splitrecords()
+            def forms():
+                for n in range(size):
+                    c.post('/edit/recadd/form.example', {"rrname": "A", "rrname0": "A",
+                        "name": "h{0}".format(n), "ttl": "", "rr0": "192.0.2.{0}".format(n % 250)})
+            def api():
+                ops = [ {"zone": "api.example", "op": "add", "text": "h{0} A 192.0.2.{1}".format(n, n % 250)}
+                    for n in range(size) ]
+                r = c.post('/edit/api/batch', json.dumps({"ops": ops}), content_type="application/json",
+                    HTTP_AUTHORIZATION="Token " + token)
+                assert r.status_code == 200
+            tf = timeit(forms)
+            ta = timeit(api)
+            cmd.stdout.write("{0:>8} {1:>9.3f}s {2:>9.3f}s".format(size, tf, ta))
+
+def benchzonepage(cmd, options):
+    """
+    time to fetch a page of a zone of N records with nothing cached,
+    with the rendered rows cached, and as a 304 for a conditional GET
+    """
+    owner = User.objects.create_user(username='bench', password='bench')
+    c = Client()
+    c.force_login(owner)
+    cmd.stdout.write("{0:>8} {1:>10} {2:>10} {3:>10}".format("records", "uncached", "rows", "304"))
+    with override_settings(ALLOWED_HOSTS=['*']):
+        for size in options['sizes']:
+            z = "page{0}.example".format(size)
+            d = Domain.objects.create(domain=z, owner=owner, exported=now(),
+                rrs="\n".join("h{0} A 192.0.2.{1}".format(n, n % 250) for n in range(size)))
+            d.splitrecords()
+            url = '/edit/edit/{0}?page=2&size=500'.format(z)
+            def get(**headers):
+                r = c.get(url, **headers)
+                assert r.status_code in (200, 304)
+                return r
+            def uncached():
+                invalidate(z)
+                get()
+            tu = timeit(uncached, 5)
+            tr = timeit(get, 5)
+            etag = get()['ETag']
+            tn = timeit(lambda: get(HTTP_IF_NONE_MATCH=etag), 5)
+            cmd.stdout.write("{0:>8} {1:>9.4f}s {2:>9.4f}s {3:>9.4f}s".format(size, tu, tr, tn))
+
+def benchrowedit(cmd, options):
+    """
+    time and bytes sent to change records in a zone of N records,
+    getting the whole page back and only the changed row
+    """
+    owner = User.objects.create_user(username='bench', password='bench')
+    c = Client()
+    c.force_login(owner)
+    edits = 20
+    cmd.stdout.write("{0:>8} {1:>10} {2:>10} {3:>10} {4:>10}".format("records", "page", "bytes",
+        "row", "bytes"))
+    with override_settings(ALLOWED_HOSTS=['*']):
+        for size in options['sizes']:
+            z = "rows{0}.example".format(size)
+            d = Domain.objects.create(domain=z, owner=owner, exported=now(),
+                rrs="\n".join("h{0} A 192.0.2.{1}".format(n, n % 250) for n in range(size)))
+            d.splitrecords()
+            res = []
+            for frag in ({}, {"fragment": "1"}):
+                sent = [0]
+                def edit():
+                    for n in range(edits):
+                        seq = n * size // edits
+                        r = c.post('/edit/record/{0}/{1}'.format(z, seq), dict(frag, rrname0="A",
+                            name="h{0}".format(seq), rr0="198.51.100.{0}".format(n)))
+                        assert r.status_code == 200
+                        sent[0] += len(r.content)
+                res += [ timeit(edit) / edits, sent[0] // edits ]
+            cmd.stdout.write("{0:>8} {1:>9.4f}s {2:>10} {3:>9.4f}s {4:>10}".format(size, *res))
+
+def benchblockcheck(cmd, options):
+    """
+    time to check a block edit that changes one line of a big zone,
+    parsing all of it and only the changed line
+    """
+    owner = User.objects.create_user(username='bench', password='bench')
+    cmd.stdout.write("{0:>8} {1:>10} {2:>10} {3:>10}".format("lines", "full", "cold", "warm"))
+    for size in options['sizes']:
+        lines = [ "h{0} A 192.0.2.{1}".format(n, n % 250) for n in range(size) ]
+        d = Domain.objects.create(domain="big{0}.example".format(size), owner=owner, exported=now(),
+            rrs="\n".join(lines))
+        d.splitrecords()
+        lines[size // 2] = "changed A 198.51.100.1"
+        text = "\n".join(lines)
+
+        def incremental():
+            validate_rrs(text, set(t for seq, valid, t in zoneview(d)[1] if valid))
+        tf = timeit(lambda: validate_rrs(text))
+        invalidate(d.domain)
+        tc = timeit(incremental)
+        tw = timeit(incremental, 3)
+        cmd.stdout.write("{0:>8} {1:>9.3f}s {2:>9.3f}s {3:>9.3f}s".format(size, tf, tc, tw))
+
+def benchpaste(cmd, options):
+    """
+    time to check a new zone of N lines on one core and in the process pool
+    """
+    cmd.stdout.write("{0:>8} {1:>10} {2:>10}".format("lines", "serial", "{0} jobs".format(os.cpu_count())))
+    for size in options['sizes']:
+        text = "\n".join("h{0} A 10.{1}.{2}.{3}".format(n, n // 62500, n // 250 % 250, n % 250)
+            for n in range(size))
+        def check(threshold):
+            linecache().clear()         # or the second run would find them all cached
+            with override_settings(PARALLEL_CHECK_LINES=threshold):
+                validate_rrs(text, set())
+        ts = timeit(lambda: check(size + 1))
+        check(0)                        # start the pool
+        tp = timeit(lambda: check(0))
+        cmd.stdout.write("{0:>8} {1:>9.3f}s {2:>9.3f}s".format(size, ts, tp))
+
+def benchforms(cmd, options):
+    """
+    time to make record forms for every rrtype, N of each, making the
+    field classes every time as it used to and once per rrtype
+    """
+    rrnames = extxl.rrnames()
+    for rr in rrnames:                  # so loading the descriptions isn't counted
+        extxl[rr]
+    cmd.stdout.write("{0} rrtypes".format(len(rrnames)))
+    cmd.stdout.write("{0:>8} {1:>10} {2:>10} {3:>10}".format("forms", "rebuilt", "cached", "per form"))
+    for size in options['sizes']:
+        def make(rebuild):
+            for n in range(size):
+                for rr in rrnames:
+                    if rebuild:
+                        formsextlang._formclasses.clear()
+                    RRForm(rrname=rr)
+        tr = timeit(lambda: make(True))
+        tc = timeit(lambda: make(False), 3)
+        nforms = size * len(rrnames)
+        cmd.stdout.write("{0:>8} {1:>9.3f}s {2:>9.3f}s {3:>8.1f}us".format(nforms, tr, tc, tc / nforms * 1e6))
+
+BENCHES = {
+    'export': benchexport,
+    'index': benchindex,
+    'search': benchsearch,
+    'replace': benchreplace,
+    'import': benchimport,
+    'api': benchapi,
+    'blockcheck': benchblockcheck,
+    'paste': benchpaste,
+    'forms': benchforms,
+    'zonepage': benchzonepage,
+    'rowedit': benchrowedit,
+    'startup': benchstartup,
+}
+
+class Command(BaseCommand):
+    help = 'Run a performance benchmark in a scratch database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('bench', choices=sorted(BENCHES), help="Which benchmark")
+        parser.add_argument('--sizes', type=int, nargs='+',
+            help="Zone or change counts to try, default 1000 10000 100000 (100 1000 for api, 10 100 for forms)")
+        parser.add_argument('--changed', type=int, default=10, help="Zones changed per run")
+        parser.add_argument('--file', type=str, help="Extlang file to compare with the snapshot")
+
+    def handle(self, *args, **options):
+        """
+        make a test database, run the benchmark, and get rid of it
+        """
+        if not options['sizes']:
+            options['sizes'] = { 'api': [100, 1000], 'forms': [10, 100] }.get(options['bench'],
+                [1000, 10000, 100000])
+        old = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            BENCHES[options['bench']](self, options)
+        finally:
+            connection.creation.destroy_test_db(old, verbosity=0)
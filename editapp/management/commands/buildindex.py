@@ -0,0 +1,52 @@
+# rebuild the index of addresses and host names in records
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from editapp.models import Domain, Record, RdataRef, REFTYPES, chunks
+from editapp.formsextlang import extxl
+from time import time
+
+class Command(BaseCommand):
+    help = 'Rebuild the index of addresses and host names in records'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=200, help="Zones read and indexed per transaction")
+
+    def handle(self, *args, **options):
+        """
+        split any old zones, then index all the records from scratch
+        """
+
+        v = options['verbosity']        # 0 - 3, default 1
+        t = time()
+
+        # splitting indexes them too
+        for chunk in chunks(Domain.objects.filter(record__isnull=True), options['chunk_size']):
+            for d in chunk:
+                d.checksplit()
+
+        # only records of types that have addresses or names need parsing
+        rrtypes = [ rr for rr in extxl.rrnames(obsolete=True)
+            if extxl[rr] and any(f['type'] in REFTYPES for f in extxl[rr].fields) ]
+
+        # a chunk of zones at a time, each replaced in one transaction,
+        # so lookups see the old refs until the new ones are there
+        nrecs = nrefs = 0
+        for chunk in chunks(Domain.objects.all(), options['chunk_size']):
+            names = [ d.domain for d in chunk ]
+            with transaction.atomic():
+                # locked as editzone() does so an edit can't slip in
+                list(Domain.objects.select_for_update().filter(domain__in=names).order_by('domain') \
+                    .values_list('domain', flat=True))
+                recs = list(Record.objects.filter(domain_id__in=names, rrtype__in=rrtypes, valid=True) \
+                    .only('id', 'domain', 'seq', 'text'))
+                for r in recs:
+                    r.settext(r.text)
+                RdataRef.objects.filter(domain_id__in=names).delete()
+                RdataRef.add(recs)
+            nrecs += len(recs)
+            nrefs += sum(len(r.refs) for r in recs)
+            if v > 1:
+                print("indexed", nrecs, "records")
+        if v > 0:
+            print("indexed {0} records, {1} references in {2:.1f}s".format(nrecs, nrefs, time()-t))
@@ -1,11 +1,231 @@
 # command line zone exporter
 
-from django.core.management.base import BaseCommand
-from django.db.models import F
-from editapp.models import Domain
-from time import time
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.db import transaction, close_old_connections
+from django.db.models import F, Max, Q
+from editapp.models import Domain, PendingExport, Change, ExportHash, chunks, parseline, fieldspans
+from editapp import metrics
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from datetime import timedelta
+from time import time, sleep
 from django.utils.timezone import now
+from hashlib import sha256
+import json
+import os
 import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+try:
+    import resource
+except ImportError:                     # not on Windows
+    resource = None
+try:
+    import fcntl
+except ImportError:                     # not on Windows either
+    fcntl = None
+
+def peakrss():
+    """
+    peak resident set size of this process in MB, None if unknown
+    """
+    if not resource:
+        return None
+    r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return r / (1 << 20) if sys.platform == 'darwin' else r / (1 << 10) # bytes on Mac, KB elsewhere
+
+# zone name to SHA-256 of each zone file's contents, in the zone
+# directory, from before the hashes were kept in ExportHash
+MANIFEST = ".manifest"
+
+def loadmanifest(dir, dirkey):
+    """
+    move the hashes from an old manifest in dir into ExportHash
+    """
+    filename = os.path.join(dir, MANIFEST)
+    try:
+        with open(filename) as fi:
+            manifest = json.load(fi)
+    except FileNotFoundError:
+        return
+    if not ExportHash.objects.filter(dir=dirkey).exists():
+        items = sorted(manifest.items())
+        for n in range(0, len(items), 1000):
+            ExportHash.store(dirkey, dict(items[n:n+1000]))
+    os.remove(filename)
+
+def zonedata(head, rrs):
+    """
+    contents of a zone file, prefixed with head if defined
+    """
+    return (((head + "\n") if head else "") + rrs + "\n").encode()
+
+def writezone(filename, head, rrs, hashhead, oldhash, sync=False):
+    """
+    write one zone file, prefixed with head if defined
+    hashhead is the head used for the hash, i.e., before the serial
+    was bumped, so a new serial alone doesn't count as a change
+    skip it if the hash matches oldhash and the file is there
+    written to a temp file and renamed so nobody sees half a zone,
+    and so hard links to the old version in a staged export are left alone
+    returns (hash, bytes written or None if skipped)
+    """
+    digest = sha256(zonedata(hashhead, rrs)).hexdigest()
+    if digest == oldhash and os.path.exists(filename):
+        return digest, None
+    data = zonedata(head, rrs)
+    dir, name = os.path.split(filename)
+    tmpname = os.path.join(dir, ".new." + name) # zone names can't start with a dot
+    with open(tmpname, "wb") as fo:
+        fo.write(data)
+        # one fsync per file, there's no portable way to sync a batch
+        # of files short of os.sync() of every filesystem on the
+        # machine, and with --jobs the threads' fsyncs share journal
+        # commits anyway
+        if sync:
+            fo.flush()
+            os.fsync(fo.fileno())
+    os.replace(tmpname, filename)
+    return digest, len(data)
+
+class dirlock:
+    """
+    context manager that holds an exclusive lock on a zone directory,
+    so two exports into the same directory take turns rather than
+    one's files being lost when the other publishes a staged copy
+    the lock is on a file next to the directory, since with --stage
+    the directory itself is replaced
+    """
+    def __init__(self, dir, v=0):
+        parent, base = os.path.split(os.path.abspath(dir))
+        self.filename = os.path.join(parent, "." + base + ".lock")
+        self.v = v
+
+    def __enter__(self):
+        self.fo = open(self.filename, "a")
+        if fcntl:
+            try:
+                fcntl.flock(self.fo, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                if self.v > 0:
+                    print("waiting for another export to", self.filename[:-5])
+                fcntl.flock(self.fo, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        self.fo.close()             # releases the lock
+
+def stagedir(dir):
+    """
+    make a staging directory next to dir with hard links to the
+    files currently in dir
+    dir has to be a symlink to the current version, or not exist yet
+    """
+    if os.path.exists(dir) and not os.path.islink(dir):
+        raise CommandError("{0} has to be a symlink for a staged export, move it to {0}.0 and "
+            "symlink it".format(dir))
+    parent, base = os.path.split(os.path.abspath(dir))
+    stage = tempfile.mkdtemp(prefix=base+".", dir=parent)
+    os.chmod(stage, 0o755)
+    if os.path.exists(dir):
+        for fn in os.listdir(dir):
+            os.link(os.path.join(dir, fn), os.path.join(stage, fn))
+    return stage
+
+def publish(dir, stage):
+    """
+    atomically point the symlink dir at the staging directory
+    and remove the previous version
+    """
+    fd = os.open(stage, os.O_RDONLY) # make sure the directory entries are on disk
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    old = os.path.realpath(dir) if os.path.islink(dir) else None
+    parent, base = os.path.split(os.path.abspath(dir))
+    tmplink = os.path.join(parent, "." + base + ".swap")
+    if os.path.lexists(tmplink):
+        os.remove(tmplink)
+    os.symlink(os.path.basename(stage), tmplink)
+    os.replace(tmplink, dir)
+    if old and old != os.path.realpath(stage):
+        shutil.rmtree(old, ignore_errors=True)
+
+def absname(name, zone):
+    """
+    fully qualified version of a name in a zone
+    """
+    if name.endswith('.'):
+        return name
+    if name in ('', '@'):
+        return zone + '.'
+    return "{0}.{1}.".format(name, zone)
+
+def absrdata(rrtype, rdata, zone):
+    """
+    rdata with the names in it made fully qualified, since the
+    journal has them the way they are in the zone
+    """
+    line = " {0} {1}".format(rrtype, rdata)
+    names = [ (start, end) for ftype, start, end in fieldspans(line, parseline(line)) if ftype == 'N' ]
+    for start, end in reversed(names):
+        line = line[:start] + absname(line[start:end], zone) + line[end:]
+    return line[len(rrtype)+2:]
+
+def deltatext(zone, changes, fmt, ttl, since, last):
+    """
+    text of a zone's changes from the journal
+    as an nsupdate script or a diff with - and + lines
+    """
+    if fmt == 'nsupdate':
+        lines = [ "zone {0}.".format(zone) ]
+        for c in changes:
+            if c.op == 'add':
+                lines.append("update add {0} {1} {2} {3}".format(absname(c.name, zone),
+                    ttl if c.ttl is None else c.ttl, c.rrtype, absrdata(c.rrtype, c.rdata, zone)))
+            else:
+                lines.append("update delete {0} {1} {2}".format(absname(c.name, zone), c.rrtype,
+                    absrdata(c.rrtype, c.rdata, zone)))
+        lines.append("send")
+    else:
+        lines = [ "; {0} changes {1} to {2}".format(zone, since, last) ]
+        for c in changes:
+            lines.append("{0}{1} {2}{3} {4}".format('+' if c.op == 'add' else '-', absname(c.name, zone),
+                "" if c.ttl is None else "{0} ".format(c.ttl), c.rrtype, absrdata(c.rrtype, c.rdata, zone)))
+    return "\n".join(lines) + "\n"
+
+def gaps(ids, lo, hi):
+    """
+    (first, last) ranges of the numbers from lo to hi that aren't in
+    the sorted list ids
+    """
+    res = []
+    for i in [ i for i in ids if lo <= i <= hi ] + [hi+1]:
+        if i > lo:
+            res.append((lo, i-1))
+        lo = max(lo, i+1)
+    return res
+
+def percentiles(values, pcts=(50, 90, 99)):
+    """
+    (pct, value) for each percentile in pcts of a list of numbers
+    nearest rank, fine for a progress report
+    """
+    values = sorted(values)
+    return [ (p, values[min(len(values)-1, int(len(values)*p/100))]) for p in pcts ]
+
+def runhook(hook, dir, changes):
+    """
+    run the post export hook with the list of changes on stdin
+    """
+    subprocess.run(hook, shell=True, check=True, input="".join("{0} {1}\n".format(*c) for c in changes),
+        universal_newlines=True, env=dict(os.environ, EXPORT_DIR=dir))
 
 class Command(BaseCommand):
     help = 'Export updated zone files'
@@ -13,65 +233,389 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('--updated', type=str, help="Export updated zones to this directory")
         parser.add_argument('--all', type=str, help="Export all zones to this directory")
+        parser.add_argument('--queue-stale', action='store_true',
+            help="Queue the zones changed since they were last exported, after upgrading to the queue")
         parser.add_argument('--list', type=str, help="Export list of zones to this file")
-        
+        parser.add_argument('--jobs', type=int, default=1, help="Number of threads writing files")
+        parser.add_argument('--chunk-size', type=int, default=500,
+            help="Zones read per query and marked exported per transaction")
+        parser.add_argument('--force', action='store_true', help="Write zones even if they haven't changed")
+        parser.add_argument('--changes', type=str, help="List written and removed zones in this file")
+        parser.add_argument('--stage', action='store_true',
+            help="Write into a new directory and switch the zone directory symlink to it")
+        parser.add_argument('--hook', type=str, default=getattr(settings, 'EXPORT_HOOK', None),
+            help="Shell command to run after export with the changes on stdin")
+        parser.add_argument('--watch', type=str, help="Keep exporting changed zones to this directory")
+        parser.add_argument('--debounce', type=float, default=2.0,
+            help="Seconds a zone has to be unchanged before --watch exports it")
+        parser.add_argument('--poll', type=float, default=1.0, help="Seconds between --watch queue checks")
+        parser.add_argument('--report', type=float, default=300.0,
+            help="Seconds between --watch latency reports")
+        parser.add_argument('--once', action='store_true', help="Stop --watch when the queue is empty")
+        parser.add_argument('--deltas', type=str, help="Write journaled record changes to this directory")
+        parser.add_argument('--since', type=int,
+            help="Journal serial to start --deltas after, default the last one written")
+        parser.add_argument('--gap-wait', type=int, default=3600,
+            help="Seconds --deltas keeps looking for journal entries skipped by transactions still open")
+        parser.add_argument('--format', choices=('nsupdate', 'diff'), default='nsupdate',
+            help="--deltas as nsupdate scripts or diffs")
+        parser.add_argument('--ttl', type=int, default=3600, help="TTL for added records that don't have one")
+        parser.add_argument('--metrics-file', type=str,
+            help="Write this run's metrics to this file for the node exporter")
+
     def handle(self, *args, **options):
         """
         do export
         """
 
         v = options['verbosity']        # 0 - 3, default 1
+        jobs = max(options['jobs'], 1)
+        chunksize = max(options['chunk_size'], 1)
 
         if options['list']:
-            doms = Domain.objects.all().order_by('domain')
+            doms = Domain.objects.order_by('domain').values_list('domain', flat=True)
             with open(options['list'], "w") as fo:
-                for d in doms:
-                    if d.domain != 'HEAD':
-                        print(d.domain, file=fo)
-                    
-        def writeit(doms, dir, head):
+                for d in doms.iterator():
+                    if d != 'HEAD':
+                        print(d, file=fo)
+
+        def markexported(names, dirkey, hashes):
+            """
+            mark a chunk of domains as exported in one update, note
+            the new hashes of the ones that changed, and take them off
+            the queue in the same transaction unless they changed
+            again after we started
+            """
+            with transaction.atomic():
+                Domain.objects.filter(domain__in=names).update(exported=current_time)
+                ExportHash.store(dirkey, hashes)
+                dequeue(names)
+
+        def unhash(dirkey, names):
+            """
+            forget the hashes of zones whose files were removed
+            """
+            for n in range(0, len(names), chunksize):
+                ExportHash.objects.filter(dir=dirkey, domain__in=names[n:n+chunksize]).delete()
+
+        def dequeue(names):
+            """
+            take names off the export queue if they haven't changed since we started
+            """
+            PendingExport.objects.filter(domain__in=names, changed__lte=current_time).delete()
+
+        def gethead():
+            """
+            get the common head records if any
+            returns (head with new serial, head as stored)
+            """
+            h = Domain.objects.filter(domain='HEAD')
+            if len(h) == 0:
+                return None, None
+            hashhead = h[0].zonetext()
+            # hack: replace the sequence number with the current
+            # timestamp
+            timestamp = str(int(time()))
+            if v > 0:
+                print("timestamp",timestamp)
+            head = re.sub(r'(SOA\s+\S+\s+\S+\s+)\d+', lambda m: m.group(1)+timestamp, hashhead, flags=re.I)
+            if v > 1:
+                print("zone head\n", head)
+            return head, hashhead
+
+        def writeit(doms, dir, heads, alldoms, gone=()):
             """
             write the domains in doms to files in the dir
-            prefix with head if defined
+            prefix with head if defined, heads is (head, hashhead)
+            a chunk at a time, files written by a pool of jobs threads,
+            then the chunk marked as exported in one update
+            with stage, into a copy of the directory that replaces
+            the old one when it's complete
+            zones whose contents match their hash in ExportHash aren't
+            rewritten, zones with a hash that no longer exist are removed
+            only the hashes of the zones in each chunk are read, and
+            only the ones that changed are written
+            alldoms says doms is all of the domains, otherwise
+            gone is the queued names to check for removal
+            zones written or in gone are taken off the export queue
+            returns the stats including lists of written and removed zones
+            """
+            head, hashhead = heads
+            queued = gone
+            st = { 'zones': 0, 'bytes': 0, 'db': 0.0, 'files': 0.0,
+                'written': [], 'skipped': 0, 'removed': [] }
+            t0 = time()
+            pool = ThreadPoolExecutor(jobs) if jobs > 1 else None
+            it = chunks(doms, chunksize)
+            dirkey = os.path.abspath(dir)
+            loadmanifest(dir, dirkey)
+            stage = options['stage']
+            outdir = stagedir(dir) if stage else dir
+            staged = []
+            stagedhashes = {}
+
+            try:
+                while True:
+                    t = time()
+                    chunk = [ (d.domain, d.zonetext()) for d in next(it, []) ]
+                    st['db'] += time() - t
+                    if not chunk:
+                        break
+
+                    t = time()
+                    names = [ dn for dn, rrs in chunk ]
+                    oldhashes = {} if options['force'] else ExportHash.digests(dirkey, names)
+                    st['db'] += time() - t
+
+                    t = time()
+                    files = [ ("{0}/{1}".format(outdir, dn), head, rrs, hashhead, oldhashes.get(dn), stage)
+                        for dn, rrs in chunk ]
+                    if pool:
+                        results = list(pool.map(lambda f: writezone(*f), files))
+                    else:
+                        results = [ writezone(*f) for f in files ]
+                    st['files'] += time() - t
+
+                    sizes = []
+                    newhashes = {}
+                    for (dn, rrs), f, (digest, size) in zip(chunk, files, results):
+                        if digest != oldhashes.get(dn):
+                            newhashes[dn] = digest
+                        if size is None:
+                            st['skipped'] += 1
+                            if v > 1:
+                                print("unchanged", f[0])
+                        else:
+                            sizes.append(size)
+                            st['written'].append(dn)
+                            if v > 0:
+                                print("export", f[0])
+
+                    if stage:           # mark when they're published
+                        staged.extend(names)
+                        stagedhashes.update(newhashes)
+                    else:
+                        t = time()
+                        markexported(names, dirkey, newhashes)
+                        st['db'] += time() - t
+
+                    st['zones'] += len(chunk)
+                    st['bytes'] += sum(sizes)
+
+                # remove files for zones that are gone
+                t = time()
+                hashed = ExportHash.objects.filter(dir=dirkey)
+                if alldoms:
+                    gone = set(hashed.exclude(domain__in=Domain.objects.values('domain')) \
+                        .values_list('domain', flat=True))
+                else:
+                    names = sorted(set(gone))
+                    gone = set()
+                    for n in range(0, len(names), chunksize):
+                        cnames = names[n:n+chunksize]
+                        gone |= set(hashed.filter(domain__in=cnames) \
+                            .exclude(domain__in=Domain.objects.filter(domain__in=cnames).values('domain')) \
+                            .values_list('domain', flat=True))
+                st['db'] += time() - t
+                for dn in sorted(gone):
+                    filename = "{0}/{1}".format(outdir, dn)
+                    if v > 0:
+                        print("remove", filename)
+                    try:
+                        os.remove(filename)
+                    except FileNotFoundError:
+                        pass
+                    st['removed'].append(dn)
+                if not stage:
+                    unhash(dirkey, st['removed'])
+            except BaseException:
+                if stage:               # leave the published version alone
+                    shutil.rmtree(outdir, ignore_errors=True)
+                raise
+            finally:
+                if pool:
+                    pool.shutdown()
+            if stage:
+                publish(dir, outdir)
+                t = time()
+                for n in range(0, len(staged), chunksize):
+                    cnames = staged[n:n+chunksize]
+                    markexported(cnames, dirkey, { dn: stagedhashes[dn] for dn in cnames if dn in stagedhashes })
+                unhash(dirkey, st['removed'])
+                st['db'] += time() - t
+            if queued:
+                dequeue(queued)
+
+            changes = [ ("written", dn) for dn in st['written'] ] + \
+                [ ("removed", dn) for dn in st['removed'] ]
+            if options['changes']:
+                with open(options['changes'], "w") as fo:
+                    for c in changes:
+                        print(*c, file=fo)
+            if options['hook'] and changes:
+                if v > 0:
+                    print("run", options['hook'])
+                runhook(options['hook'], dir, changes)
+
+            metrics.observe('editapp_export_seconds', time() - t0)
+            metrics.inc('editapp_export_zones_total', len(st['written']), result='written')
+            metrics.inc('editapp_export_zones_total', st['skipped'], result='skipped')
+            metrics.inc('editapp_export_zones_total', len(st['removed']), result='removed')
+            if options['metrics_file']:
+                metrics.writetextfile(options['metrics_file'])
+
+            if v > 0:
+                elapsed = time() - t0
+                print("{0} zones {1} bytes in {2:.2f}s, {3:.1f} zones/s, db {4:.2f}s files {5:.2f}s" \
+                    .format(st['zones'], st['bytes'], elapsed, st['zones']/elapsed if elapsed else 0,
+                    st['db'], st['files']))
+                print("{0} written {1} skipped {2} removed".format(len(st['written']),
+                    st['skipped'], len(st['removed'])))
+                rss = peakrss()
+                if rss is not None:
+                    print("peak RSS {0:.1f}MB".format(rss))
+            return st
+
+        def watch(dir):
             """
-            for d in doms:
-                filename = "{0}/{1}".format(dir, d.domain)
+            export zones as they're queued in PendingExport
+            a zone is exported once it's been unchanged for debounce
+            seconds, so a burst of edits turns into one export
+            """
+            nonlocal current_time
+            debounce = timedelta(seconds=options['debounce'])
+            latency = []                # seconds from first change to export
+            lastreport = time()
+
+            def report():
+                if latency and v > 0:
+                    print("{0} zones exported, latency {1}".format(len(latency),
+                        " ".join("p{0} {1:.2f}s".format(*p) for p in percentiles(latency))))
+
+            try:
+                while True:
+                    close_old_connections() # in case the database went away
+                    current_time = now()
+                    pending = list(PendingExport.objects.filter(changed__lte=current_time-debounce) \
+                        .order_by('changed')[:chunksize])
+                    if pending:
+                        names = [ p.domain for p in pending ]
+                        heads = gethead()
+                        with dirlock(dir, v):
+                            if 'HEAD' in names: # new head, redo them all
+                                writeit(Domain.objects.exclude(domain='HEAD'), dir, heads, True, gone=names)
+                            else:
+                                writeit(Domain.objects.filter(domain__in=names), dir, heads, False, gone=names)
+                        done = now()
+                        latency.extend((done - p.queued).total_seconds() for p in pending)
+                        latency = latency[-10000:]
+                        if v > 1:
+                            print("exported", " ".join(names))
+                    elif options['once'] and not PendingExport.objects.exists():
+                        break
+
+                    if time() - lastreport >= options['report']:
+                        report()
+                        lastreport = time()
+                    if not pending:
+                        sleep(options['poll'])
+            except KeyboardInterrupt:
+                pass
+            report()
+
+        def writedeltas(dir):
+            """
+            write the changes in the journal since a serial number to
+            a file per zone, and note the last serial in dir/.serial
+            a transaction can commit after one that got a higher serial,
+            so the serials skipped so far are noted after it with the
+            time first seen, and looked for again until --gap-wait
+            """
+            serialfile = os.path.join(dir, ".serial")
+            since = options['since']
+            holes = []                  # (first, last, time first seen)
+            if since is None:
+                try:
+                    with open(serialfile) as fi:
+                        since = int(fi.readline())
+                        holes = [ tuple(map(int, l.split())) for l in fi if l.strip() ]
+                except FileNotFoundError:
+                    since = 0
+            t = int(time())
+            last = max(Change.objects.aggregate(Max('id'))['id__max'] or since, since)
+            want = Q(id__gt=since, id__lte=last)
+            for first, hlast, seen in holes:
+                want |= Q(id__range=(first, hlast))
+            suffix = '.nsupdate' if options['format'] == 'nsupdate' else '.diff'
+            ids = []
+            n = 0
+            # HEAD's entries aren't written, but count as seen
+            for zone, zc in groupby(Change.objects.filter(want).order_by('domain', 'id').iterator(),
+                    lambda c: c.domain):
+                zc = list(zc)
+                ids.extend(c.id for c in zc)
+                if zone == 'HEAD':
+                    continue
+                filename = "{0}/{1}{2}".format(dir, zone, suffix)
                 if v > 0:
-                    print("export",filename)
+                    print("deltas", filename)
                 with open(filename, "w") as fo:
-                    if head:
-                        print(head, file=fo)
-                    print(d.rrs, file=fo)
-                d.exported = current_time    # mark as exported
-                d.save()
+                    fo.write(deltatext(zone, zc, options['format'], options['ttl'], since, last))
+                n += 1
+            ids.sort()
+            newholes = []
+            for first, hlast, seen in holes:
+                if t - seen < options['gap_wait']:
+                    newholes += [ (f, l, seen) for f, l in gaps(ids, first, hlast) ]
+            newholes += [ (f, l, t) for f, l in gaps(ids, since+1, last) ]
+            tmpname = serialfile + ".new"
+            with open(tmpname, "w") as fo:
+                print(last, file=fo)
+                for h in newholes:
+                    print(*h, file=fo)
+            os.replace(tmpname, serialfile)
+            if v > 0:
+                print("wrote changes to {0} zones, serial {1} to {2}".format(n, since, last))
+                if newholes:
+                    print("serials not seen yet", " ".join("{0}-{1}".format(*h) for h in newholes))
 
         # TZ aware version of "now"
         current_time = now()
 
-        # get the common head records if any
+        if options['queue_stale']:
+            # looks at every zone, so only once, not on every --updated
+            stale = list(Domain.objects.filter(updated__gt=F('exported')).values_list('domain', flat=True))
+            PendingExport.queuemany(stale, current_time)
+            if v > 0:
+                print("queued {0} zones changed since they were exported".format(len(stale)))
+
         if options['updated'] or options['all']:
-            h = Domain.objects.filter(domain='HEAD')
-            if len(h) > 0:
-                head = h[0].rrs
-                # hack: replace the sequence number with the current
-                # timestamp
-                timestamp = str(int(time()))
-                if v > 0:
-                    print("timestamp",timestamp)
-                head = re.sub(r'(SOA\s+\S+\s+\S+\s+)\d+', lambda m: m.group(1)+timestamp, head, flags=re.I)
-                if v > 1:
-                    print("zone head\n", head)
-            else:
-                head = None
-            
+            heads = gethead()
+
         if options['updated']:
-            doms = Domain.objects.filter(updated__gt=F('exported')).exclude(domain='HEAD')
-            writeit(doms, options['updated'], head)
+            with dirlock(options['updated'], v):
+                # the queue is indexed, so this doesn't look at unchanged zones
+                queued = PendingExport.objects.filter(changed__lte=current_time)
+                deleted = list(queued.exclude(domain__in=Domain.objects.values('domain')) \
+                    .values_list('domain', flat=True))
+                if queued.filter(domain='HEAD').exists(): # new head, redo them all
+                    doms = Domain.objects.exclude(domain='HEAD')
+                    writeit(doms, options['updated'], heads, True, gone=deleted+['HEAD'])
+                else:
+                    doms = Domain.objects.filter(domain__in=queued.values('domain'))
+                    writeit(doms, options['updated'], heads, False, gone=deleted)
             if v > 0:
                 print("wrote updated zones")
 
         if options['all']:
-            doms = Domain.objects.exclude(domain='HEAD')
-            writeit(doms, options['all'], head)
+            with dirlock(options['all'], v):
+                doms = Domain.objects.exclude(domain='HEAD')
+                writeit(doms, options['all'], heads, True)
             if v > 0:
                 print("wrote all zones")
+
+        if options['deltas']:
+            writedeltas(options['deltas'])
+
+        if options['watch']:
+            watch(options['watch'])
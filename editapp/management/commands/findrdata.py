@@ -0,0 +1,31 @@
+# find the records that point at an address or host name
+
+from django.core.management.base import BaseCommand
+from editapp.models import RdataRef
+from time import time
+
+class Command(BaseCommand):
+    help = 'Find records that refer to an address or host name'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--type', type=str, action='append', help="Only this rrtype, can repeat")
+        parser.add_argument('--zones', action='store_true', help="Only list the zones")
+        parser.add_argument('value', type=str, help="Address or host name")
+
+    def handle(self, *args, **options):
+        """
+        look it up in the index
+        """
+
+        v = options['verbosity']        # 0 - 3, default 1
+        t = time()
+        hits = RdataRef.search(options['value'], options['type'])
+        t = time() - t
+        if options['zones']:
+            for d in sorted(set(h[0] for h in hits)):
+                print(d)
+        else:
+            for d, seq, text in hits:
+                print("{0} {1} {2}".format(d, seq, text))
+        if v > 1:
+            print("{0} records in {1:.3f}s".format(len(hits), t))
@@ -0,0 +1,120 @@
+# import a directory of zone files in BIND master file format
+# or pull zones from name servers with AXFR
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from concurrent.futures import ProcessPoolExecutor
+from editapp.zonefile import parsezone, storezones
+from editapp.axfr import axfrzones, hostport
+from editapp import metrics
+from time import time
+import os
+
+@metrics.flushtask
+def readzone(args):
+    """
+    read and parse one zone file, runs in a worker process
+    """
+    path, zone, keepsoa = args
+    try:
+        with open(path, encoding='utf-8', errors='replace') as fi:
+            text = fi.read()
+    except OSError as e:
+        return zone, [], [str(e)]
+    return parsezone(zone, text, keepsoa)
+
+class Command(BaseCommand):
+    help = 'Import zone files from a directory or zones by AXFR'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--owner', type=str, required=True, help="User who owns the imported zones")
+        parser.add_argument('--replace', action='store_true', help="Replace zones that already exist, default skip them")
+        parser.add_argument('--suffix', type=str, default='', help="Strip this from file names to get zone names")
+        parser.add_argument('--jobs', type=int, default=os.cpu_count(), help="Parse in N processes")
+        parser.add_argument('--batch-size', type=int, default=500, help="Zones stored per transaction")
+        parser.add_argument('--keep-soa', action='store_true', help="Keep the zones' SOA records, default drop them")
+        parser.add_argument('--allow-errors', action='store_true', help="Import zones with bad records, default skip them")
+        parser.add_argument('--report', type=str, help="Write failures to this file rather than standard output")
+        parser.add_argument('--axfr', type=str, help="Transfer the zones from this server[:port]")
+        parser.add_argument('--concurrency', type=int, default=20, help="Zone transfers at once")
+        parser.add_argument('--timeout', type=float, default=30, help="Seconds allowed for each transfer")
+        parser.add_argument('source', type=str, nargs='+',
+            help="Directory of zone files, or with --axfr zones as zone or zone@server[:port]")
+
+    def handle(self, *args, **options):
+        """
+        parse the files in a process pool, store them in batches
+        """
+
+        v = options['verbosity']        # 0 - 3, default 1
+        try:
+            owner = User.objects.get(username=options['owner'])
+        except User.DoesNotExist:
+            raise CommandError("No user " + options['owner'])
+
+        files = []
+        xfrs = []
+        if options['axfr']:
+            for z in options['source']:
+                zone, _, server = z.partition('@')
+                xfrs.append((zone.rstrip('.').lower(),) + hostport(server or options['axfr']))
+        else:
+            if len(options['source']) != 1:
+                raise CommandError("Only one directory")
+            dir = options['source'][0]
+            for fn in sorted(os.listdir(dir)):
+                path = os.path.join(dir, fn)
+                if fn.startswith('.') or not os.path.isfile(path):
+                    continue
+                zone = fn[:-len(options['suffix'])] if options['suffix'] and fn.endswith(options['suffix']) else fn
+                files.append((path, zone.rstrip('.').lower(), options['keep_soa']))
+
+        t = time()
+        tstore = 0
+        nzones = nrecs = 0
+        failed = []
+        skipped = []
+        batch = []
+
+        def store():
+            nonlocal tstore, nrecs
+            ts = time()
+            sk = set(storezones(batch, owner, options['replace']))
+            skipped.extend(sorted(sk))
+            nrecs -= sum(len(recs) for zone, recs in batch if zone in sk)
+            tstore += time() - ts
+            if v > 1:
+                print("stored", nzones, "zones")
+
+        with ProcessPoolExecutor(max_workers=max(options['jobs'], 1)) as pool:
+            if xfrs:
+                zones = axfrzones(xfrs, max(options['concurrency'], 1), options['timeout'],
+                    options['keep_soa'], pool)
+            else:
+                zones = pool.map(readzone, files, chunksize=16)
+            for zone, recs, errs in zones:
+                if not recs or (errs and not options['allow_errors']):
+                    failed.append((zone, errs))
+                    continue
+                batch.append((zone, recs))
+                nzones += 1
+                nrecs += len(recs)
+                if len(batch) >= options['batch_size']:
+                    store()
+                    batch = []
+            if batch:
+                store()
+
+        t = time() - t
+        nzones -= len(skipped)
+        fo = open(options['report'], 'w') if options['report'] else None
+        for zone, errs in failed:
+            print("{0} failed: {1}".format(zone, "; ".join(errs) or "empty"), file=fo)
+        for zone in skipped:
+            print("{0} skipped, already exists".format(zone), file=fo)
+        if fo:
+            fo.close()
+        if v > 0:
+            print("imported {0} zones {1} records, {2} failed, {3} skipped in {4:.1f}s, "
+                "{5:.0f} zones/s, {6:.1f}s storing".format(nzones, nrecs, len(failed), len(skipped), t,
+                nzones / t if t else 0, tstore))
@@ -0,0 +1,54 @@
+# summarize the profiles of sampled requests
+
+from django.core.management.base import BaseCommand, CommandError
+from editapp.profiles import stored, combine, maketoken, HOTMODULES
+from collections import defaultdict
+from io import StringIO
+
+class Command(BaseCommand):
+    help = 'Show the hottest functions in the stored request profiles'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--view', type=str, help="Only profiles of this view")
+        parser.add_argument('--zone', type=str, help="Only profiles of this zone")
+        parser.add_argument('--top', type=int, default=20, help="Number of functions to show")
+        parser.add_argument('--sort', choices=('cumulative', 'tottime', 'ncalls'), default='cumulative',
+            help="What to rank the functions by")
+        parser.add_argument('--everything', action='store_true',
+            help="All functions, not only the views, formsextlang, and dnsextlang")
+        parser.add_argument('--token', action='store_true',
+            help="Print a token for staff to profile a request with ?profile=token")
+
+    def handle(self, *args, **options):
+        """
+        add up the profiles and print the top functions
+        """
+        if options['token']:
+            self.stdout.write(maketoken())
+            return
+
+        profs = stored(options['view'], options['zone'])
+        if not profs:
+            raise CommandError("No profiles")
+
+        # what was profiled
+        byview = defaultdict(list)
+        for f, tags in profs:
+            byview[tags['view']].append(tags)
+        self.stdout.write("{0:<20} {1:>8} {2:>10} {3:>10} {4:>10}".format("view", "requests", "mean", "max", "max size"))
+        for view, tl in sorted(byview.items()):
+            secs = [ t['seconds'] for t in tl ]
+            sizes = [ t['size'] for t in tl if t['size'] is not None ]
+            self.stdout.write("{0:<20} {1:>8} {2:>9.3f}s {3:>9.3f}s {4:>10}".format(view, len(tl), sum(secs) / len(secs),
+                max(secs), max(sizes) if sizes else '-'))
+        self.stdout.write("")
+
+        out = StringIO()
+        st = combine([ f for f, tags in profs ], stream=out)
+        st.files = []                   # not a line for each profile
+        st.sort_stats(options['sort'])
+        if options['everything']:
+            st.print_stats(options['top'])
+        else:
+            st.print_stats(HOTMODULES, options['top'])
+        self.stdout.write(out.getvalue())
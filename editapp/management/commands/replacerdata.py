@@ -0,0 +1,44 @@
+# replace an address or host name in records across zones
+
+from django.core.management.base import BaseCommand
+from editapp.models import Domain
+from editapp.bulkedit import replace, qualified
+from time import time
+
+class Command(BaseCommand):
+    help = 'Replace an address or host name in records across zones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--old', type=str, required=True, help="Address or host name to replace")
+        parser.add_argument('--new', type=str, required=True, help="What to replace it with")
+        parser.add_argument('--type', type=str, action='append', help="Only this rrtype, can repeat")
+        parser.add_argument('--dry-run', action='store_true', help="Show the changes but don't make them")
+        parser.add_argument('--batch-size', type=int, default=500, help="Zones committed per transaction")
+        parser.add_argument('domains', nargs='*', help="Zones to change, default all")
+
+    def handle(self, *args, **options):
+        """
+        do the replacement, print a diff and the batch times
+        """
+
+        v = options['verbosity']        # 0 - 3, default 1
+
+        def report(kind, *args):
+            if kind == 'change' and (v > 1 or (v > 0 and options['dry_run'])):
+                print("{0} {1}\n-{2}\n+{3}".format(*args))
+            elif kind == 'error' and v > 0:
+                print("{0} {1} not changed: {4}\n-{2}\n+{3}".format(*args))
+            elif kind == 'batch' and v > 0:
+                print("batch: {0} zones {1} records in {2:.3f}s".format(*args))
+
+        if v > 0 and qualified(options['new']) != options['new']:
+            print("replacing with", qualified(options['new']))
+        doms = None
+        if options['domains']:
+            doms = Domain.objects.filter(domain__in=options['domains'])
+        t = time()
+        nrecs, nzones, nerrs = replace(options['old'], options['new'], options['type'], doms,
+            dryrun=options['dry_run'], batchsize=options['batch_size'], report=report)
+        if v > 0:
+            print("{0} {1} records in {2} zones, {3} errors, {4:.3f}s".format(
+                "would change" if options['dry_run'] else "changed", nrecs, nzones, nerrs, time()-t))
@@ -0,0 +1,37 @@
+# snapshot the rrtype descriptions into a local file
+
+from django.core.management.base import BaseCommand, CommandError
+from editapp.formsextlang import snapshot, SNAPSHOT
+from dnsextlang import Extlang
+import json
+
+class Command(BaseCommand):
+    help = 'Snapshot the rrtype descriptions so the app does not load them from the DNS'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--domain', type=str, default='services.net', help="Load rrtypes from this DNS domain")
+        parser.add_argument('--file', type=str, help="Load rrtypes from this extlang file instead")
+        parser.add_argument('--output', type=str, default=SNAPSHOT, help="Snapshot file")
+
+    def handle(self, *args, **options):
+        """
+        load them all and write them out
+        """
+
+        v = options['verbosity']        # 0 - 3, default 1
+
+        if options['file']:
+            xl = Extlang(file=options['file'])
+            names = [ k for k in xl.rrs if type(k) is str ]
+        else:
+            xl = Extlang(domain=options['domain'])
+            names = xl.rrnames(obsolete=True)
+        if not names:
+            raise CommandError("No rrtypes from {0}".format(options['file'] or options['domain']))
+
+        snap = snapshot(xl, names)
+        with open(options['output'], "w") as fo:
+            json.dump(snap, fo, separators=(',', ':'))
+            fo.write("\n")
+        if v > 0:
+            print("wrote", len(snap['rrtypes']), "rrtypes to", options['output'])
@@ -0,0 +1,37 @@
+# split existing zones into per-record rows
+
+from django.core.management.base import BaseCommand
+from editapp.models import Domain, chunks
+
+class Command(BaseCommand):
+    help = 'Split zones into individual records'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help="Resplit zones that already have records")
+        parser.add_argument('--chunk-size', type=int, default=500, help="Zones read per query")
+        parser.add_argument('domains', nargs='*', help="Zones to split, default all")
+
+    def handle(self, *args, **options):
+        """
+        do the split
+        """
+
+        v = options['verbosity']        # 0 - 3, default 1
+
+        doms = Domain.objects.all()
+        if options['domains']:
+            doms = doms.filter(domain__in=options['domains'])
+
+        n = 0
+        for chunk in chunks(doms, max(options['chunk_size'], 1)):
+            for d in chunk:
+                if options['force']:
+                    d.zonetext()        # pick up any record edits first
+                    d.splitrecords()
+                elif not d.checksplit():
+                    continue
+                n += 1
+                if v > 1:
+                    print("split", d.domain)
+        if v > 0:
+            print("split", n, "zones")
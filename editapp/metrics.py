@@ -0,0 +1,259 @@
+# prometheus style metrics for the editor and the exporter
+# each process counts in memory and every few seconds writes its counts
+# to its own file in settings.METRICS_DIR.  /metrics adds up the files
+# of all the processes, so web workers, import workers, and exports
+# run from cron are all counted
+# everything is kept as counters, histograms as a counter per bucket,
+# so adding up the processes is just a sum
+# the files of processes that have exited are merged into one archive
+# file, so the directory doesn't keep growing.  It has to be on the
+# same host as the processes, since it checks their pids
+
+from django.conf import settings
+from collections import defaultdict
+from time import time
+import atexit
+import functools
+import json
+import os
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:                     # not on Windows
+    fcntl = None
+
+# name: (type, help)
+METRICS = {
+    'editapp_request_seconds': ('histogram', "Time to answer a request, by view"),
+    'editapp_parse_seconds': ('histogram', "Time to parse a block or zone of records, by kind"),
+    'editapp_parse_records_total': ('counter', "Records parsed in blocks and zones, by kind"),
+    'editapp_zone_cache_hits_total': ('counter', "Zone cache lookups that were current"),
+    'editapp_zone_cache_misses_total': ('counter', "Zone cache lookups that went to the database"),
+    'editapp_row_cache_hits_total': ('counter', "Edit page row windows rendered from the cache"),
+    'editapp_row_cache_misses_total': ('counter', "Edit page row windows rendered from the zone"),
+    'editapp_export_seconds': ('histogram', "Time to export a set of zones"),
+    'editapp_export_zones_total': ('counter', "Zones looked at by export, by result"),
+}
+
+# histogram buckets in seconds
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300)
+
+_lock = threading.Lock()
+_values = defaultdict(float)            # (sample name, ((label, value), ...)): count
+_state = { 'pid': None, 'flushed': 0.0, 'file': None }
+
+def metricsdir():
+    """
+    where the processes keep their counts
+    """
+    return getattr(settings, 'METRICS_DIR', None) or os.path.join(tempfile.gettempdir(), 'editapp-metrics')
+
+def _mine():
+    """
+    make sure the counts are this process's, a forked child starts
+    from zero rather than counting its parent's again
+    """
+    pid = os.getpid()
+    if _state['pid'] != pid:
+        _values.clear()
+        _state['pid'] = pid
+        _state['flushed'] = time()
+        _state['file'] = "{0}-{1}.json".format(pid, int(time()*1000))
+
+def _add(name, labels, n):
+    _values[(name, tuple(sorted(labels.items())))] += n
+
+def inc(name, n=1, **labels):
+    """
+    add n to a counter
+    """
+    with _lock:
+        _mine()
+        _add(name, labels, n)
+    maybeflush()
+
+def observe(name, value, **labels):
+    """
+    count a value, usually seconds, in a histogram
+    """
+    with _lock:
+        _mine()
+        for le in BUCKETS:
+            if value <= le:
+                _add(name + '_bucket', dict(labels, le=repr(float(le))), 1)
+        _add(name + '_bucket', dict(labels, le='+Inf'), 1)
+        _add(name + '_sum', labels, value)
+        _add(name + '_count', labels, 1)
+    maybeflush()
+
+def flush():
+    """
+    write this process's counts to its file
+    """
+    with _lock:
+        _mine()
+        data = [ [name, list(labels), v] for (name, labels), v in _values.items() ]
+        _state['flushed'] = time()
+        fn = os.path.join(metricsdir(), _state['file'])
+    if not data:
+        return
+    os.makedirs(metricsdir(), exist_ok=True)
+    with open(fn + ".tmp", "w") as fo:
+        json.dump(data, fo)
+    os.replace(fn + ".tmp", fn)
+
+def maybeflush():
+    """
+    flush if it's been settings.METRICS_FLUSH seconds, default 5, since
+    the last time
+    """
+    if time() - _state['flushed'] >= getattr(settings, 'METRICS_FLUSH', 5):
+        flush()
+
+def flushtask(fn):
+    """
+    decorator for functions run by process pool workers, which exit
+    without running atexit, so the counts are written after each task
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            flush()
+    return wrapper
+
+def _atexit():
+    if _values and _state['pid'] == os.getpid():
+        flush()
+
+atexit.register(_atexit)
+
+# counts of processes that have exited
+ARCHIVE = "archive.json"
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:             # someone else's
+        pass
+    return True
+
+def _read(fn):
+    try:
+        with open(os.path.join(metricsdir(), fn)) as fi:
+            return json.load(fi)
+    except (OSError, ValueError):       # gone or being replaced
+        return None
+
+def _add_to(res, data):
+    for name, labels, v in data:
+        res[(name, tuple(tuple(l) for l in labels))] += v
+
+def _archive(names, arch):
+    """
+    add the files of processes that have exited into the archive and
+    remove them, call with the directory locked
+    the archive lists the files it last merged, so if we die before
+    removing them they're not counted twice
+    returns the archive
+    """
+    dead = [ fn for fn in names if fn.endswith('.json') and fn.split('-')[0].isdigit()
+        and int(fn.split('-')[0]) != os.getpid() and not _alive(int(fn.split('-')[0])) ]
+    if not dead:
+        return arch
+    values = defaultdict(float)
+    _add_to(values, arch['values'])
+    merged = []
+    for fn in dead:
+        data = None if fn in arch['files'] else _read(fn)
+        if data is not None:
+            _add_to(values, data)
+            merged.append(fn)
+    if merged:
+        arch = { 'files': merged, 'values': [ [name, list(labels), v] for (name, labels), v in values.items() ] }
+        tmpname = os.path.join(metricsdir(), ARCHIVE + ".tmp")
+        with open(tmpname, "w") as fo:
+            json.dump(arch, fo)
+        os.replace(tmpname, os.path.join(metricsdir(), ARCHIVE))
+    for fn in dead:
+        try:
+            os.remove(os.path.join(metricsdir(), fn))
+        except FileNotFoundError:
+            pass
+    return arch
+
+def collect(allprocs=True):
+    """
+    counts added up over the files of all the processes, or only
+    this one's
+    the files of processes that have exited are archived on the way
+    """
+    if not allprocs:
+        with _lock:
+            _mine()
+            return dict(_values)
+    flush()
+    res = defaultdict(float)
+    d = metricsdir()
+    if not os.path.isdir(d):
+        return res
+    with open(os.path.join(d, ".lock"), "a") as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX) # released when it's closed
+        arch = _read(ARCHIVE) or { 'files': [], 'values': [] }
+        arch = _archive(os.listdir(d), arch)
+        _add_to(res, arch['values'])
+        for fn in os.listdir(d):
+            if fn.endswith('.json') and fn != ARCHIVE and fn not in arch['files']:
+                data = _read(fn)
+                if data is not None:
+                    _add_to(res, data)
+    return res
+
+def _fmt(name, labels, v):
+    ls = ",".join('{0}="{1}"'.format(k, str(lv).replace('\\', '\\\\').replace('"', '\\"')) for k, lv in labels)
+    return "{0}{1} {2}".format(name, "{" + ls + "}" if ls else "", repr(float(v)))
+
+def render(allprocs=True):
+    """
+    the counts in the prometheus text format, with the zone cache hit
+    ratio worked out from the hits and misses
+    """
+    values = collect(allprocs)
+    lines = []
+    for name, (mtype, text) in sorted(METRICS.items()):
+        samples = [ (n, labels, v) for (n, labels), v in values.items()
+            if n == name or (mtype == 'histogram' and n in (name + '_bucket', name + '_sum', name + '_count')) ]
+        if not samples:
+            continue
+        lines.append("# HELP {0} {1}".format(name, text))
+        lines.append("# TYPE {0} {1}".format(name, mtype))
+        # buckets in order within each set of labels
+        def order(s):
+            n, labels, v = s
+            other = tuple(l for l in labels if l[0] != 'le')
+            le = dict(labels).get('le')
+            return (other, n != name + '_bucket', float(le) if le else 0.0, n)
+        lines.extend(_fmt(*s) for s in sorted(samples, key=order))
+
+    hits = sum(v for (n, l), v in values.items() if n == 'editapp_zone_cache_hits_total')
+    misses = sum(v for (n, l), v in values.items() if n == 'editapp_zone_cache_misses_total')
+    if hits + misses:
+        lines.append("# HELP editapp_zone_cache_hit_ratio Fraction of zone cache lookups that were hits")
+        lines.append("# TYPE editapp_zone_cache_hit_ratio gauge")
+        lines.append(_fmt('editapp_zone_cache_hit_ratio', (), hits / (hits + misses)))
+    return "\n".join(lines) + "\n"
+
+def writetextfile(filename, allprocs=False):
+    """
+    write the metrics for the node exporter's textfile collector,
+    renamed into place so it never reads half a file
+    """
+    with open(filename + ".tmp", "w") as fo:
+        fo.write(render(allprocs))
+    os.replace(filename + ".tmp", filename)
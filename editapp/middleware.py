@@ -0,0 +1,109 @@
+# per-request cost of the views
+# counts the queries and time in the database, the time parsing records
+# with dnsextlang, and the total, and reports them in response headers
+# and the log
+# and profiles a sample of requests
+
+from django.conf import settings
+from django.db import connections
+from .formsextlang import parsetime
+from .models import Record
+from . import metrics, profiles
+from contextlib import ExitStack
+from time import perf_counter
+import cProfile
+import logging
+import random
+
+logger = logging.getLogger(__name__)
+
+class QueryCounter:
+    """
+    database execute wrapper that counts the queries and the time
+    they take, without keeping the SQL the way the debug query log does
+    """
+    def __init__(self):
+        self.n = 0
+        self.secs = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        t = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.n += 1
+            self.secs += perf_counter() - t
+
+class TimingMiddleware:
+    """
+    time each request, put the numbers in
+      X-Query-Count: queries
+      Server-Timing: db;dur=ms, parse;dur=ms, total;dur=ms
+    and log them with the view's name at INFO, and count the time in
+    the request latency histogram in metrics
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.viewname = None
+        queries = QueryCounter()
+        p0 = parsetime()
+        t0 = perf_counter()
+        with ExitStack() as stack:
+            for c in connections.all():
+                stack.enter_context(c.execute_wrapper(queries))
+            response = self.get_response(request)
+        total = perf_counter() - t0
+        parse = parsetime() - p0
+        q, db = queries.n, queries.secs
+
+        response['X-Query-Count'] = str(q)
+        response['Server-Timing'] = "db;dur={0:.1f}, parse;dur={1:.1f}, total;dur={2:.1f}".format(
+            db*1000, parse*1000, total*1000)
+        metrics.observe('editapp_request_seconds', total, view=request.viewname or '-')
+        logger.info("%s %s %s: %d queries, db %.1fms, parse %.1fms, total %.1fms", request.method,
+            request.path, request.viewname or '-', q, db*1000, parse*1000, total*1000)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.viewname = getattr(view_func, '__name__', None)
+
+class ProfileMiddleware:
+    """
+    run a sample of the editapp views under cProfile and store the
+    profiles, see profiles.py
+    settings.PROFILE_SAMPLE is the fraction of requests, default 0, and
+    staff can profile a request by adding ?profile=token, from
+    manage.py profiles --token
+    has to be last in MIDDLEWARE, since it calls the view itself and
+    the process_view of anything after it would be skipped
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if getattr(view_func, '__module__', None) != 'editapp.views':
+            return None
+        token = request.GET.get('profile')
+        if not (token and request.user.is_staff and profiles.checktoken(token)) \
+                and random.random() >= getattr(settings, 'PROFILE_SAMPLE', 0):
+            return None
+
+        prof = cProfile.Profile()
+        t = perf_counter()
+        try:
+            response = prof.runcall(view_func, request, *view_args, **view_kwargs)
+        finally:
+            t = perf_counter() - t
+            # zone views take the zone name first
+            zone = view_args[0] if view_args else None
+            size = Record.objects.filter(domain_id=zone).count() if zone else None
+            try:
+                profiles.save(prof, view_func.__name__, zone, size, request.get_full_path(), t)
+            except OSError as e:
+                logger.warning("can't save profile: %s", e)
+        return response
@@ -1,5 +1,14 @@
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.contrib.auth.models import User
+from django.utils import timezone
+from collections import Counter
+import hashlib
+import ipaddress
+import re
+import secrets
+from dnsextlang import Extrec, ExtComment, ExtSyntax, ExtBadField
+
+from .formsextlang import extxl, timedparse
 
 # Create your models here.
 class Domain(models.Model):
@@ -8,8 +17,461 @@ class Domain(models.Model):
     updated = models.DateTimeField(auto_now_add=True) # when it was changed
     exported = models.DateTimeField()   # when it was saved to a file for the DNS server
     rrs = models.TextField()
+    rrsstale = models.BooleanField(default=False) # records edited, rrs needs rebuilding
 
     class Meta:
         permissions = (
             ("see_all", "Can see all users' domains"),
-        )
\ No newline at end of file
+        )
+        # a user's domains in order for the index page
+        index_together = (('owner', 'domain'),)
+
+    def zonetext(self):
+        """
+        text of the zone
+        if records have been edited one at a time, rebuild rrs from them
+        """
+        if self.rrsstale:
+            self.rrs = "\n".join(self.record_set.order_by('seq').values_list('text', flat=True))
+            self.rrsstale = False
+            # don't clear the flag if someone edited a record in the meantime
+            Domain.objects.filter(domain=self.domain, updated=self.updated) \
+                .update(rrs=self.rrs, rrsstale=False)
+        return self.rrs
+
+    def splitrecords(self, journal=False):
+        """
+        replace the domain's records with the lines in rrs
+        journal says to put the differences in the change journal
+        """
+        recs = [ Record.fromtext(self, n, l) for n, l in enumerate(self.rrs.splitlines(), start=0) ]
+        with transaction.atomic():
+            if journal:
+                old = Counter(rrkeys(self.record_set.order_by('seq') \
+                    .values_list('name', 'ttl', 'rrtype', 'rdata', 'valid')))
+                new = Counter(rrkeys((r.name, r.ttl, r.rrtype, r.rdata, r.valid) for r in recs))
+                Change.log(self.domain, 'del', (old - new).elements())
+                Change.log(self.domain, 'add', (new - old).elements())
+            self.record_set.all().delete()
+            Record.objects.bulk_create(recs)
+            RdataRef.objects.filter(domain=self).delete()
+            RdataRef.add(recs)
+
+    def checksplit(self):
+        """
+        split up a zone from before there were records
+        returns True if it did
+        """
+        if self.record_set.exists() or not self.zonetext().strip():
+            return False
+        self.splitrecords()
+        return True
+
+    def touch(self):
+        """
+        note that a record changed without rewriting the whole row
+        """
+        self.updated = timezone.now()
+        self.rrsstale = True
+        Domain.objects.filter(domain=self.domain).update(updated=self.updated, rrsstale=True)
+        PendingExport.queue(self.domain, self.updated)
+
+def chunks(doms, size):
+    """
+    yield lists of up to size domains from doms in name order
+    one query per list, keyed on the last name, so only size rows
+    are in memory at a time and only the columns needed for export
+    and splitting
+    """
+    doms = doms.only('domain', 'updated', 'rrs', 'rrsstale').order_by('domain')
+    last = None
+    while True:
+        q = doms if last is None else doms.filter(domain__gt=last)
+        chunk = list(q[:size])
+        if not chunk:
+            return
+        yield chunk
+        last = chunk[-1].domain
+
+def rrkeys(recs):
+    """
+    (name, ttl, rrtype, rdata) for each valid DNS record in recs
+    in zone order, blank names filled in from the previous record
+    recs is (name, ttl, rrtype, rdata, valid) for each line
+    """
+    owner = ''
+    for name, ttl, rrtype, rdata, valid in recs:
+        if name:
+            owner = name
+        if rrtype and valid:
+            yield (owner, ttl, rrtype, rdata)
+
+def parseline(line, lineno=1):
+    """
+    parse one line of a zone the same way ExtrecList does
+    returns an Extrec, or an ExtComment for comments and junk
+    """
+    if not line.strip() or line.strip()[0] == ';': # blank or comment
+        return ExtComment(extxl, string=line, lineno=lineno)
+    try:
+        with timedparse():
+            return Extrec(extxl, string=line, lineno=lineno)
+    except (ExtSyntax, ExtBadField) as e:
+        return ExtComment(extxl, string=line, lineno=lineno, errstr=e.msg)
+
+# field types whose values go in the rdata index
+REFTYPES = ('A', 'AAAA', 'N')
+
+def refvalue(value, zone=None):
+    """
+    normalize an address or host name for the rdata index
+    lower case, addresses in standard form, names absolute without
+    the trailing dot, relative to zone if it's given
+    """
+    v = value.strip().lower()
+    try:
+        return str(ipaddress.ip_address(v))
+    except ValueError:
+        pass
+    if v.endswith('.'):
+        return v[:-1]
+    if zone is None:
+        return v
+    if v == '@':
+        return zone.lower()
+    return v + '.' + zone.lower()
+
+def rdatarefs(rec, zone):
+    """
+    (rrtype, value) for the addresses and host names in a parsed record
+    """
+    if not rec.rr or rec.fields is None or not rec.is_valid():
+        return []
+    return [ (rec.rr.rrname, refvalue(str(v), zone)) for f, v in zip(rec.rr.fields, rec.fields)
+        if f['type'] in REFTYPES and v.value ]
+
+# a token the way the zone file tokenizer sees it, a quoted string,
+# a comment, or anything else up to white space
+_tokenre = re.compile(r'"(?:[^"\\]|\\.)*"|;.*|[^\s"]+')
+
+def fieldspans(text, rec):
+    """
+    where the rdata fields of a line of text are, given the record
+    parsed from it
+    the owner, TTL, class, and rrtype each take one token if they're
+    there, then each field takes one token, except that a field that
+    takes the rest of the line ends it
+    returns (field type, start, end) for each one token field
+    """
+    if not rec.rr or rec.fields is None:
+        return []
+    spans = []
+    for m in _tokenre.finditer(text):
+        if m.group().startswith(';'):
+            break
+        spans.append(m.span())
+    n = (rec.name is not None) + (rec.ttl is not None) + (rec.rclass is not None) + 1
+    res = []
+    for f, v in zip(rec.rr.fields, rec.fields):
+        if v.multi or n >= len(spans):
+            break
+        res.append((f['type'],) + spans[n])
+        n += 1
+    return res
+
+class Record(models.Model):
+    """
+    one line of a zone, so single record edits don't have to
+    rewrite the whole zone
+    seq is the order in the zone and doesn't change when other
+    records are added or deleted
+    """
+    domain = models.ForeignKey(Domain, on_delete=models.CASCADE)
+    seq = models.IntegerField()
+    name = models.CharField(max_length=255, blank=True) # blank for comments or no name
+    ttl = models.IntegerField(null=True)
+    rrtype = models.CharField(max_length=20, blank=True) # rrname, blank for comments
+    rdata = models.TextField(blank=True)
+    text = models.TextField(blank=True) # the line as it appears in the zone
+    valid = models.BooleanField(default=True)
+
+    class Meta:
+        unique_together = (('domain', 'seq'),)
+
+    def settext(self, text, rec=None):
+        """
+        parse a line and set the fields from it
+        rec is the line already parsed
+        """
+        rec = rec or parseline(text)
+        self.text = text
+        self.refs = rdatarefs(rec, self.domain_id)
+        self.valid = rec.is_valid()
+        if rec.rr and rec.fields is not None:
+            self.name = str(rec.name)[:255] if rec.name else ''
+            self.ttl = rec.ttl
+            self.rrtype = rec.rr.rrname
+            self.rdata = " ".join(map(str, rec.fields))
+        else:                           # comment or didn't parse
+            self.name = ''
+            self.ttl = None
+            self.rrtype = ''
+            self.rdata = ''
+
+    def rrkey(self):
+        """
+        (name, ttl, rrtype, rdata) for the journal, None if it's not
+        a valid DNS record
+        blank name is filled in from the previous record
+        """
+        if not (self.rrtype and self.valid):
+            return None
+        owner = self.name
+        if not owner:
+            owner = Record.objects.filter(domain_id=self.domain_id, seq__lt=self.seq).exclude(name='') \
+                .order_by('-seq').values_list('name', flat=True).first() or ''
+        return (owner, self.ttl, self.rrtype, self.rdata)
+
+    @classmethod
+    def fromtext(cls, dom, seq, text):
+        """
+        new unsaved record in dom from a line of text
+        """
+        r = cls(domain=dom, seq=seq)
+        r.settext(text)
+        return r
+
+    @classmethod
+    def append(cls, dom, text):
+        """
+        add a record at the end of dom
+        """
+        with transaction.atomic():
+            # lock the domain so simultaneous adds don't get the same seq
+            Domain.objects.select_for_update().only('domain').get(domain=dom.domain)
+            last = cls.objects.filter(domain=dom).aggregate(models.Max('seq'))['seq__max']
+            r = cls.fromtext(dom, 0 if last is None else last+1, text)
+            r.save()
+            RdataRef.add([r])
+            Change.log(dom.domain, 'add', [r.rrkey()])
+            dom.touch()
+        return r
+
+    def change(self, text):
+        """
+        replace this record with a new line of text
+        """
+        with transaction.atomic():
+            old = self.rrkey()
+            self.settext(text)
+            self.save()
+            RdataRef.objects.filter(domain_id=self.domain_id, seq=self.seq).delete()
+            RdataRef.add([self])
+            new = self.rrkey()
+            if old != new:
+                Change.log(self.domain_id, 'del', [old])
+                Change.log(self.domain_id, 'add', [new])
+            self.domain.touch()
+
+    def remove(self):
+        """
+        delete this record from its zone
+        """
+        with transaction.atomic():
+            Change.log(self.domain_id, 'del', [self.rrkey()])
+            RdataRef.objects.filter(domain_id=self.domain_id, seq=self.seq).delete()
+            self.delete()
+            self.domain.touch()
+
+class RdataRef(models.Model):
+    """
+    inverted index of the addresses and host names in records
+    so finding the zones that point at something doesn't have to
+    read every zone
+    points at the record by seq rather than a foreign key since
+    bulk_create doesn't return ids on every database
+    """
+    value = models.CharField(max_length=255) # from refvalue()
+    rrtype = models.CharField(max_length=20)
+    domain = models.ForeignKey(Domain, on_delete=models.CASCADE)
+    seq = models.IntegerField()
+
+    class Meta:
+        index_together = (('value', 'rrtype'), ('domain', 'seq'))
+
+    @classmethod
+    def add(cls, recs):
+        """
+        index records that have had settext() called
+        """
+        cls.objects.bulk_create([ cls(value=v[:255], rrtype=t, domain_id=r.domain_id, seq=r.seq)
+            for r in recs for t, v in getattr(r, 'refs', ()) ], batch_size=500)
+
+    @classmethod
+    def records(cls, value, rrtypes=None, domains=None, limit=None):
+        """
+        records that refer to value, optionally only of some rrtypes
+        and in some domains (a Domain queryset), at most limit of them
+        generates Records in domain and seq order
+        """
+        refs = cls.objects.filter(value=refvalue(value))
+        if rrtypes:
+            refs = refs.filter(rrtype__in=[ t.upper() for t in rrtypes ])
+        if domains is not None:
+            refs = refs.filter(domain__in=domains)
+        hits = {}
+        refs = refs.order_by('domain', 'seq').values_list('domain', 'seq')
+        for d, seq in (refs[:limit] if limit else refs):
+            hits.setdefault(d, set()).add(seq)
+
+        # fetch the records a batch of domains at a time
+        # a big OR of (domain, seq) pairs is quadratic in the ORM, so
+        # fetch a superset and pick out the ones that match
+        doms = sorted(hits)
+        for n in range(0, len(doms), 100):
+            recs = Record.objects.filter(domain_id__in=doms[n:n+100],
+                seq__in=set().union(*(hits[d] for d in doms[n:n+100]))).order_by('domain', 'seq')
+            yield from (r for r in recs if r.seq in hits[r.domain_id])
+
+    @classmethod
+    def search(cls, value, rrtypes=None, domains=None, limit=None):
+        """
+        same as records() but returns [(domain, seq, text), ...]
+        """
+        return [ (r.domain_id, r.seq, r.text) for r in cls.records(value, rrtypes, domains, limit) ]
+
+class Change(models.Model):
+    """
+    journal of DNS records added to and deleted from zones
+    for incremental export, id is the journal serial number
+    """
+    domain = models.CharField(max_length=64) # not a foreign key so it outlives the zone
+    when = models.DateTimeField(default=timezone.now)
+    op = models.CharField(max_length=3, choices=(('add', 'add'), ('del', 'delete')))
+    name = models.CharField(max_length=255, blank=True) # owner as in the zone
+    ttl = models.IntegerField(null=True)
+    rrtype = models.CharField(max_length=20)
+    rdata = models.TextField()
+
+    class Meta:
+        index_together = (('domain', 'id'),)
+
+    @classmethod
+    def log(cls, domainname, op, keys):
+        """
+        add (name, ttl, rrtype, rdata) records to the journal
+        skipping None for things that aren't DNS records
+        """
+        cls.objects.bulk_create([ cls(domain=domainname, op=op, name=k[0], ttl=k[1], rrtype=k[2], rdata=k[3])
+            for k in keys if k ])
+
+class PendingExport(models.Model):
+    """
+    zones changed since they were last exported, for export --watch
+    queued when a domain is saved, deleted, or has a record changed
+    not a foreign key so deleted zones stay queued
+    """
+    domain = models.CharField(max_length=64, primary_key=True)
+    queued = models.DateTimeField() # first change since it was exported
+    changed = models.DateTimeField(db_index=True) # latest change
+
+    @classmethod
+    def queue(cls, domainname, when=None):
+        """
+        note that a domain has changed
+        """
+        when = when or timezone.now()
+        if cls.objects.filter(domain=domainname).update(changed=when):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(domain=domainname, queued=when, changed=when)
+        except IntegrityError:          # someone else queued it first
+            cls.objects.filter(domain=domainname).update(changed=when)
+
+    @classmethod
+    def queuemany(cls, domainnames, when=None):
+        """
+        queue a lot of domains with a few queries
+        """
+        when = when or timezone.now()
+        domainnames = set(domainnames)
+        old = set(cls.objects.filter(domain__in=domainnames).values_list('domain', flat=True))
+        cls.objects.filter(domain__in=old).update(changed=when)
+        try:
+            with transaction.atomic():
+                cls.objects.bulk_create([ cls(domain=d, queued=when, changed=when) for d in domainnames - old ])
+        except IntegrityError:          # someone else queued some, do them one at a time
+            for d in domainnames - old:
+                cls.queue(d, when)
+
+class ExportHash(models.Model):
+    """
+    SHA-256 of each zone file as last exported to a zone directory, so
+    export can tell which zones changed by looking up only the ones
+    it's writing
+    not a foreign key so the files of deleted zones can be found
+    """
+    dir = models.CharField(max_length=200) # absolute path of the zone directory
+    domain = models.CharField(max_length=64)
+    digest = models.CharField(max_length=64)
+
+    class Meta:
+        unique_together = (('dir', 'domain'),)
+
+    @classmethod
+    def digests(cls, dir, domainnames):
+        """
+        {domain: digest} for the domains with a hash in dir
+        """
+        return dict(cls.objects.filter(dir=dir, domain__in=domainnames).values_list('domain', 'digest'))
+
+    @classmethod
+    def store(cls, dir, digests):
+        """
+        set the hashes in {domain: digest} for dir
+        """
+        if not digests:
+            return
+        with transaction.atomic():
+            cls.objects.filter(dir=dir, domain__in=list(digests)).delete()
+            cls.objects.bulk_create([ cls(dir=dir, domain=d, digest=h) for d, h in digests.items() ])
+
+def domain_queue(sender, instance, **kwargs):
+    """
+    post_save and post_delete handler for Domain
+    """
+    PendingExport.queue(instance.domain)
+
+class ApiToken(models.Model):
+    """
+    key for the JSON API
+    only a hash of the token is stored
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    key = models.CharField(max_length=64, unique=True) # sha256 of the token
+    created = models.DateTimeField(default=timezone.now)
+
+    @staticmethod
+    def _hash(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    @classmethod
+    def make(cls, user):
+        """
+        new token for user, returns the token itself
+        """
+        token = secrets.token_hex(20)
+        cls.objects.create(user=user, key=cls._hash(token))
+        return token
+
+    @classmethod
+    def authuser(cls, header):
+        """
+        user for an Authorization: Token xxx header, or None
+        """
+        kind, _, token = (header or '').partition(' ')
+        if kind.lower() != 'token' or not token.strip():
+            return None
+        t = cls.objects.select_related('user').filter(key=cls._hash(token.strip())).first()
+        return t.user if t and t.user.is_active else None
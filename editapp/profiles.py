@@ -0,0 +1,93 @@
+# stored profiles of sampled requests, see ProfileMiddleware
+# each profile is a pstats file with a .json file next to it saying
+# which view, zone, and zone size it was, in settings.PROFILE_DIR
+# only the newest settings.PROFILE_KEEP are kept
+
+from django.conf import settings
+from django.core import signing
+from time import time
+import json
+import os
+import pstats
+import tempfile
+
+# the code the summary is about
+HOTMODULES = r'editapp/views\.py|editapp/formsextlang\.py|dnsextlang'
+
+def profiledir():
+    """
+    where the profiles go
+    """
+    return getattr(settings, 'PROFILE_DIR', None) or os.path.join(tempfile.gettempdir(), 'editapp-profiles')
+
+def save(prof, view, zone, size, path, secs):
+    """
+    store a finished cProfile.Profile with its tags, and remove the
+    oldest ones past PROFILE_KEEP, default 500
+    """
+    d = profiledir()
+    os.makedirs(d, exist_ok=True)
+    base = os.path.join(d, "{0:.6f}-{1}".format(time(), os.getpid()))
+    prof.dump_stats(base + ".prof")
+    with open(base + ".json", "w") as fo:
+        json.dump({ 'view': view, 'zone': zone, 'size': size, 'path': path, 'seconds': secs,
+            'time': time() }, fo)
+
+    names = sorted(fn[:-5] for fn in os.listdir(d) if fn.endswith('.json'))
+    for old in names[:max(len(names) - getattr(settings, 'PROFILE_KEEP', 500), 0)]:
+        for ext in ('.json', '.prof'):
+            try:
+                os.remove(os.path.join(d, old + ext))
+            except FileNotFoundError:
+                pass
+
+def stored(view=None, zone=None):
+    """
+    (pstats file, tags) for the stored profiles, oldest first,
+    perhaps only for one view or zone
+    """
+    d = profiledir()
+    try:
+        names = sorted(fn[:-5] for fn in os.listdir(d) if fn.endswith('.json'))
+    except FileNotFoundError:
+        return []
+    res = []
+    for n in names:
+        try:
+            with open(os.path.join(d, n + ".json")) as fi:
+                tags = json.load(fi)
+        except (OSError, ValueError):   # rotated away
+            continue
+        if (view and tags['view'] != view) or (zone and tags['zone'] != zone):
+            continue
+        if os.path.exists(os.path.join(d, n + ".prof")):
+            res.append((os.path.join(d, n + ".prof"), tags))
+    return res
+
+def combine(files, stream=None):
+    """
+    one pstats.Stats for a list of pstats files
+    """
+    st = pstats.Stats(files[0], stream=stream)
+    for f in files[1:]:
+        st.add(f)
+    return st
+
+# staff add ?profile=token to a URL to profile that request
+SALT = 'editapp.profile'
+
+def maketoken():
+    """
+    token for ?profile=, good for PROFILE_TOKEN_AGE seconds, default an hour
+    """
+    return signing.TimestampSigner(salt=SALT).sign('profile')
+
+def checktoken(token):
+    """
+    is this a current ?profile= token
+    """
+    try:
+        signing.TimestampSigner(salt=SALT).unsign(token, max_age=getattr(settings, 'PROFILE_TOKEN_AGE', 3600))
+    except signing.BadSignature:
+        return False
+    return True
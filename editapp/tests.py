@@ -1,10 +1,80 @@
-from django.test import TestCase, Client
-from .models import Domain
+from django.test import TestCase, Client, override_settings
+from django.core.management import call_command
+from django.db import connection
+from .models import Domain, Record, PendingExport, RdataRef, ApiToken, Change, ExportHash
+from . import zonecache, metrics
+from .axfr import axfrzones
+from .bulkedit import replace
 from django.contrib.auth.models import User
 from django.utils import timezone
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from io import StringIO
+from unittest import mock
+import hashlib
+import json
+import os
+import signal
+import socketserver
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+import dns.message
+import dns.rcode
+import dns.rrset
+import dns.zone
+
+class AXFRHandler(socketserver.BaseRequestHandler):
+    """
+    stand-in primary for AXFR tests, serves server.zones
+    """
+    def handle(self):
+        ln = self.request.recv(2)
+        if len(ln) < 2:
+            return
+        n = struct.unpack("!H", ln)[0]
+        q = dns.message.from_wire(self.request.recv(n))
+        name = q.question[0].name.to_text(omit_final_dot=True)
+        if name == "slow.example":
+            time.sleep(2)
+            return
+        r = dns.message.make_response(q)
+        if name in self.server.zones:
+            z = dns.zone.from_text(self.server.zones[name], name + ".", relativize=False)
+            soa = z.find_rrset("@", "SOA")
+            r.answer.append(soa)
+            for n, rds in z.iterate_rdatasets():
+                if rds.rdtype != dns.rdatatype.SOA:
+                    rrs = dns.rrset.RRset(n, rds.rdclass, rds.rdtype)
+                    rrs.update(rds)
+                    r.answer.append(rrs)
+            r.answer.append(soa)
+        else:
+            r.set_rcode(dns.rcode.REFUSED)
+        w = r.to_wire()
+        self.request.sendall(struct.pack("!H", len(w)) + w)
 
 class EditappTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        """
+        keep the metrics the tests make out of the real metrics directory
+        """
+        super().setUpClass()
+        cls.metricsdir = tempfile.TemporaryDirectory()
+        cls.metricssettings = override_settings(METRICS_DIR=cls.metricsdir.name)
+        cls.metricssettings.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        metrics._values.clear()         # or atexit would write them to the real one
+        cls.metricssettings.disable()
+        cls.metricsdir.cleanup()
+        super().tearDownClass()
+
     def setUp(self):
         """
         make a dummy domain and head
@@ -28,6 +98,26 @@ class EditappTestCase(TestCase):
         self.c = Client()
         self.c.post('/login/', {'username': 'bob', 'password': 'zz'})
 
+    def tempzonedir(self):
+        """
+        an empty zone directory in a temp directory of its own, since
+        export puts its lock file next to the zone directory
+        """
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        zonedir = os.path.join(tmp.name, "zones")
+        os.mkdir(zonedir)
+        return zonedir
+
+    def assertQueryBudget(self, rc, budget):
+        """
+        the request that got response rc made at most budget queries,
+        counted by the timing middleware
+        """
+        n = int(rc['X-Query-Count'])
+        self.assertLessEqual(n, budget, "{0} {1} made {2} queries, budget {3}".format(
+            rc.request['REQUEST_METHOD'], rc.request['PATH_INFO'], n, budget))
+
 # make sure we're really logged in
     def test_01login(self):
         resp = self.c.get('/edit')
@@ -90,3 +180,756 @@ class EditappTestCase(TestCase):
             "rrs": "; a comment\n 10 A 1.2.3\nwww A 1.2.3.4"})
         self.assertIn("Bad IPv4 format", rc.content.decode())
 
+# parsed zones are cached until the domain changes
+    def test_09zonecache(self):
+        hits, misses = zonecache.stats['hits'], zonecache.stats['misses']
+        rowhits = metrics._values[('editapp_row_cache_hits_total', ())]
+        self.c.get('/edit/edit/test.com')
+        rc = self.c.get('/edit/edit/test.com')
+        self.assertIn('1.2.3.4', rc.content.decode())
+        self.assertEqual(zonecache.stats['misses'], misses+1)
+        # the rows came from the cache without looking at the zone
+        self.assertEqual(zonecache.stats['hits'], hits)
+        self.assertEqual(metrics._values[('editapp_row_cache_hits_total', ())], rowhits+1)
+        # each window has its own entry
+        self.c.get('/edit/edit/test.com?size=10')
+        self.assertEqual(zonecache.stats['hits'], hits+1)
+        self.assertIsNotNone(zonecache.zcache().get("rows:test.com:0:10"))
+
+        rc = self.c.post('/edit/editblock/test.com', {"domain": "test.com", "owner": "bob",
+            "rrs": "; a comment\nwww A 5.6.7.8"})
+        self.assertIn("www A 5.6.7.8", rc.content.decode())
+        self.assertNotIn("1.2.3.4", rc.content.decode())
+        self.assertEqual(zonecache.stats['misses'], misses+2)
+
+# single record edits update one record and rebuild the zone text later
+    def test_10records(self):
+        self.c.get('/edit/edit/test.com')   # splits the old style zone
+        self.assertEqual(Record.objects.filter(domain="test.com").count(), 2)
+        www = Record.objects.get(domain="test.com", seq=1)
+        self.assertEqual((www.name, www.rrtype, www.rdata), ("www", "A", "1.2.3.4"))
+
+        self.c.post('/edit/record/test.com/0', {"comment": "; different comment", "rrname0": "COMMENT",
+            "delete": "Delete"})
+        self.c.post('/edit/recadd/test.com', {"rrname": "A", "rrname0": "A",
+            "name": "", "ttl": "100", "rr0": "11.22.33.44" })
+        dom = Domain.objects.get(domain="test.com")
+        self.assertTrue(dom.rrsstale)
+        self.assertIn("a comment", dom.rrs)     # not rewritten yet
+        self.assertEqual(list(dom.record_set.order_by('seq').values_list('seq', flat=True)), [1, 2])
+
+        rc = self.c.get('/edit/editblock/test.com')
+        self.assertNotIn("a comment", rc.content.decode())
+        dom = Domain.objects.get(domain="test.com")
+        self.assertFalse(dom.rrsstale)
+        self.assertEqual(dom.rrs, "www A 1.2.3.4\n   100 A 11.22.33.44")
+
+# export zones on a thread pool
+    def test_11export(self):
+        Domain.objects.create(domain="other.com", owner=User.objects.get(username='bob'),
+            exported=timezone.make_aware(datetime(2000,1,1)), rrs="mail A 5.6.7.8")
+        zonedir = self.tempzonedir()
+        call_command('export', all=zonedir, jobs=2, chunk_size=1, verbosity=0)
+        self.assertEqual(sorted(os.listdir(zonedir)), ["other.com", "test.com"])
+        with open(os.path.join(zonedir, "test.com")) as fi:
+            zone = fi.read()
+        self.assertIn("NS ns2.example.com.", zone)
+        self.assertIn("www A 1.2.3.4", zone)
+        self.assertNotIn("99999", zone)     # serial replaced
+        self.assertFalse(os.path.exists(os.path.join(zonedir, "HEAD")))
+        dom = Domain.objects.get(domain="test.com")
+        self.assertGreater(dom.exported, dom.updated)
+
+        # a zone changed before there was a queue
+        Domain.objects.filter(domain="other.com").update(updated=timezone.now(), rrs="mail A 5.6.7.9")
+        PendingExport.objects.all().delete()
+        call_command('export', updated=zonedir, verbosity=0)
+        with open(os.path.join(zonedir, "other.com")) as fi:
+            self.assertNotIn("5.6.7.9", fi.read())
+        call_command('export', updated=zonedir, queue_stale=True, verbosity=0)
+        with open(os.path.join(zonedir, "other.com")) as fi:
+            self.assertIn("5.6.7.9", fi.read())
+        self.assertFalse(PendingExport.objects.exists())
+
+# unchanged zones aren't rewritten, deleted ones are removed
+    def test_12manifest(self):
+        zonedir = self.tempzonedir()
+        changes = os.path.join(zonedir, "changes")
+        call_command('export', all=zonedir, changes=changes, verbosity=0)
+        with open(changes) as fi:
+            self.assertEqual(fi.read(), "written test.com\n")
+
+        call_command('export', all=zonedir, changes=changes, verbosity=0)
+        with open(changes) as fi:
+            self.assertEqual(fi.read(), "")
+
+        self.assertEqual(list(ExportHash.objects.filter(dir=zonedir).values_list('domain', flat=True)),
+            ["test.com"])
+
+        Domain.objects.filter(domain="test.com").delete()
+        call_command('export', updated=zonedir, changes=changes, verbosity=0)
+        with open(changes) as fi:
+            self.assertEqual(fi.read(), "removed test.com\n")
+        self.assertFalse(os.path.exists(os.path.join(zonedir, "test.com")))
+        self.assertFalse(ExportHash.objects.filter(dir=zonedir).exists())
+
+        # hashes from an old manifest file are moved into the database
+        zonedir = self.tempzonedir()
+        for fn, data in (("gone.com", "x A 1.2.3.4\n"), (".manifest", '{"gone.com": "0"}')):
+            with open(os.path.join(zonedir, fn), "w") as fo:
+                fo.write(data)
+        call_command('export', all=zonedir, verbosity=0)
+        self.assertEqual(sorted(os.listdir(zonedir)), [])
+
+# staged export switches the symlink and runs the hook once
+    def test_13stage(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            zonedir = os.path.join(tmpdir, "zones")
+            hookout = os.path.join(tmpdir, "hookout")
+            call_command('export', all=zonedir, stage=True, hook="cat > "+hookout, verbosity=0)
+            self.assertTrue(os.path.islink(zonedir))
+            first = os.path.realpath(zonedir)
+            with open(hookout) as fi:
+                self.assertEqual(fi.read(), "written test.com\n")
+
+            Domain.objects.create(domain="other.com", owner=User.objects.get(username='bob'),
+                exported=timezone.make_aware(datetime(2000,1,1)), rrs="mail A 5.6.7.8")
+            call_command('export', updated=zonedir, stage=True, hook="cat > "+hookout, verbosity=0)
+            self.assertNotEqual(os.path.realpath(zonedir), first)
+            self.assertFalse(os.path.exists(first))
+            self.assertEqual(sorted(os.listdir(zonedir)), ["other.com", "test.com"])
+            with open(hookout) as fi:
+                self.assertEqual(fi.read(), "written other.com\n")
+
+            # exports into the same directory take turns
+            from .management.commands.export import dirlock
+            got = []
+            def other():
+                with dirlock(zonedir):
+                    got.append(os.path.realpath(zonedir))
+            with dirlock(zonedir):
+                th = threading.Thread(target=other)
+                th.start()
+                time.sleep(0.2)
+                self.assertEqual(got, [])
+            th.join()
+            self.assertEqual(got, [os.path.realpath(zonedir)])
+
+# changes are queued and exported by export --watch
+    def test_14watch(self):
+        zonedir = self.tempzonedir()
+        call_command('export', watch=zonedir, debounce=0, once=True, verbosity=0)
+        self.assertFalse(PendingExport.objects.exists())
+        self.assertTrue(os.path.exists(os.path.join(zonedir, "test.com")))
+
+        self.c.post('/edit/recadd/test.com', {"rrname": "A", "rrname0": "A",
+            "name": "", "ttl": "100", "rr0": "11.22.33.44" })
+        Domain.objects.get(domain="test.com").delete()
+        Domain.objects.create(domain="other.com", owner=User.objects.get(username='bob'),
+            exported=timezone.make_aware(datetime(2000,1,1)), rrs="mail A 5.6.7.8")
+        self.assertEqual(sorted(PendingExport.objects.values_list('domain', flat=True)),
+            ["other.com", "test.com"])
+
+        call_command('export', watch=zonedir, debounce=0, once=True, verbosity=0)
+        self.assertFalse(PendingExport.objects.exists())
+        self.assertEqual(sorted(os.listdir(zonedir)), ["other.com"])
+
+# record changes are journaled and exported as deltas
+    def test_15deltas(self):
+        self.c.get('/edit/edit/test.com')
+        self.c.post('/edit/editblock/test.com', {"domain": "test.com", "owner": "bob",
+            "rrs": "; a comment\n MX 10 mail\nwww A 1.2.3.4"})
+        self.c.post('/edit/record/test.com/2', {"rrname0": "A", "name": "www", "ttl": "",
+            "rr0": "5.6.7.8"})
+        with tempfile.TemporaryDirectory() as deltadir:
+            call_command('export', deltas=deltadir, verbosity=0)
+            with open(os.path.join(deltadir, "test.com.nsupdate")) as fi:
+                self.assertEqual(fi.read(), "zone test.com.\n"
+                    "update add test.com. 3600 MX 10 mail.test.com.\n"
+                    "update delete www.test.com. A 1.2.3.4\n"
+                    "update add www.test.com. 3600 A 5.6.7.8\n"
+                    "send\n")
+
+            # nothing new since the last run
+            os.remove(os.path.join(deltadir, "test.com.nsupdate"))
+            call_command('export', deltas=deltadir, verbosity=0)
+            self.assertFalse(os.path.exists(os.path.join(deltadir, "test.com.nsupdate")))
+
+            # a serial that commits after a higher one isn't lost
+            top = Change.objects.order_by('-id')[0].id
+            Change.objects.create(id=top+3, domain="test.com", op="add", name="late", rrtype="A",
+                rdata="10.0.0.3")
+            call_command('export', deltas=deltadir, verbosity=0)
+            with open(os.path.join(deltadir, ".serial")) as fi:
+                serial = fi.read().split()
+            self.assertEqual(serial[:3], [str(top+3), str(top+1), str(top+2)])
+            Change.objects.create(id=top+1, domain="test.com", op="add", name="later", rrtype="A",
+                rdata="10.0.0.1")
+            call_command('export', deltas=deltadir, verbosity=0)
+            with open(os.path.join(deltadir, "test.com.nsupdate")) as fi:
+                self.assertEqual(fi.read(), "zone test.com.\n"
+                    "update add later.test.com. 3600 A 10.0.0.1\n"
+                    "send\n")
+            with open(os.path.join(deltadir, ".serial")) as fi:
+                self.assertEqual(fi.read().split()[:3], [str(top+3), str(top+2), str(top+2)])
+            call_command('export', deltas=deltadir, gap_wait=0, verbosity=0)
+            with open(os.path.join(deltadir, ".serial")) as fi:
+                self.assertEqual(fi.read(), "{0}\n".format(top+3))
+
+            call_command('export', deltas=deltadir, since=0, format='diff', verbosity=0)
+            with open(os.path.join(deltadir, "test.com.diff")) as fi:
+                diff = fi.read()
+                self.assertIn("-www.test.com. A 1.2.3.4\n", diff)
+                self.assertIn("+test.com. MX 10 mail.test.com.\n", diff)
+
+# big zones are shown a page at a time
+    def test_16pages(self):
+        self.c.post('/edit/editblock/test.com', {"domain": "test.com", "owner": "bob",
+            "rrs": "\n".join("h{0} A 10.0.0.{1}".format(n, n % 250) for n in range(45))})
+        rc = self.c.get('/edit/edit/test.com?size=20').content.decode()
+        self.assertIn("Records 1&ndash;20 of 45", rc)
+        self.assertIn("h19 A", rc)
+        self.assertNotIn("h20 A", rc)
+        rc = self.c.get('/edit/edit/test.com?size=20&page=9').content.decode()
+        self.assertIn("Records 41&ndash;45 of 45", rc)
+        rc = self.c.get('/edit/edit/test.com?size=20&rec=25').content.decode()
+        self.assertIn("Records 21&ndash;40 of 45", rc)
+        self.assertIn("h25 A", rc)
+
+        # a changed record is shown on its page
+        rc = self.c.post('/edit/record/test.com/30?size=10', {"rrname0": "A", "name": "h30", "ttl": "",
+            "rr0": "10.9.9.9"}).content.decode()
+        self.assertIn("h30 A 10.9.9.9", rc)
+        self.assertIn("Records 31&ndash;40 of 45", rc)
+
+# the domain list is paged and searchable
+    def test_17index(self):
+        bob = User.objects.get(username='bob')
+        for n in range(12):
+            Domain.objects.create(domain="z{0:02d}.example".format(n), owner=bob,
+                exported=timezone.make_aware(datetime(2000,1,1)), rrs="")
+        with self.settings(INDEX_PAGE_SIZE=5):
+            rc = self.c.get('/edit/?q=z').content.decode()
+            self.assertIn('z04.example', rc)
+            self.assertNotIn('z05.example', rc)
+            self.assertIn('after=z04.example', rc)
+            rc = self.c.get('/edit/?q=z&after=z04.example').content.decode()
+            self.assertIn('z09.example', rc)
+            self.assertIn('before=z05.example', rc)
+            rc = self.c.get('/edit/?q=z&before=z05.example').content.decode()
+            self.assertIn('z00.example', rc)
+            self.assertNotIn('before=', rc)
+            rc = self.c.get('/edit/?q=est&anywhere=1').content.decode()
+            self.assertIn('/edit/test.com', rc)
+        rj = self.c.get('/edit/lookup?q=z1&limit=2').json()
+        self.assertEqual(rj['domains'], ['z10.example', 'z11.example'])
+
+# the rdata index finds records that point at things
+    def test_18rdataindex(self):
+        self.c.post('/edit/editblock/test.com', {"domain": "test.com", "owner": "bob",
+            "rrs": "www A 1.2.3.4\n MX 10 mail\nftp CNAME www.other.com."})
+        hits = RdataRef.search("1.2.3.4")
+        self.assertEqual(hits, [("test.com", 0, "www A 1.2.3.4")])
+        self.assertEqual(len(RdataRef.search("MAIL.test.com.", ["MX"])), 1)
+        self.assertEqual(RdataRef.search("mail.test.com", ["A"]), [])
+
+        # follows single record edits
+        self.c.post('/edit/record/test.com/0', {"rrname0": "A", "name": "www", "ttl": "",
+            "rr0": "5.6.7.8"})
+        self.assertEqual(RdataRef.search("1.2.3.4"), [])
+        self.assertEqual(len(RdataRef.search("5.6.7.8")), 1)
+        rc = self.c.get('/edit/search?v=www.other.com').content.decode()
+        self.assertIn("ftp CNAME www.other.com.", rc)
+
+        RdataRef.objects.all().delete()
+        call_command('buildindex', verbosity=0)
+        self.assertEqual(RdataRef.objects.filter(domain="test.com").count(), 3)
+        self.assertEqual(len(RdataRef.search("5.6.7.8", ["A"])), 1)
+
+        # a zone at a time, refs that are out of step are replaced
+        Domain.objects.create(domain="other.com", owner=User.objects.get(username='bob'),
+            exported=timezone.make_aware(datetime(2000,1,1)), rrs="www A 5.6.7.8").splitrecords()
+        RdataRef.objects.create(value="9.9.9.9", rrtype="A", domain_id="test.com", seq=0)
+        call_command('buildindex', chunk_size=1, verbosity=0)
+        self.assertEqual(RdataRef.search("9.9.9.9"), [])
+        self.assertEqual(len(RdataRef.search("5.6.7.8", ["A"])), 2)
+        self.assertEqual(RdataRef.objects.filter(domain="test.com").count(), 3)
+
+# find and replace across zones
+    def test_19replace(self):
+        bob = User.objects.get(username='bob')
+        self.c.post('/edit/editblock/test.com', {"domain": "test.com", "owner": "bob",
+            "rrs": "www A 1.2.3.4\n MX 10 mail.old.net."})
+        for n in range(3):
+            d = Domain.objects.create(domain="z{0}.example".format(n), owner=bob,
+                exported=timezone.make_aware(datetime(2000,1,1)), rrs=" MX 10 MAIL.old.net.\nwww A 9.9.9.9")
+            d.splitrecords()
+
+        call_command('replacerdata', old="mail.old.net", new="mx.new.net.", type=["MX"], dry_run=True,
+            batch_size=2, verbosity=0)
+        self.assertEqual(len(RdataRef.search("mail.old.net")), 4)
+
+        call_command('replacerdata', old="mail.old.net", new="mx.new.net.", type=["MX"],
+            batch_size=2, verbosity=0)
+        self.assertEqual(RdataRef.search("mail.old.net"), [])
+        self.assertEqual(len(RdataRef.search("mx.new.net")), 4)
+        dom = Domain.objects.get(domain="test.com")
+        self.assertEqual(dom.zonetext(), "www A 1.2.3.4\n MX 10 mx.new.net.")
+        self.assertTrue(PendingExport.objects.filter(domain="z2.example").exists())
+
+        # owners that look like the old name stay, new names get a dot
+        d = Domain.objects.create(domain="z9.example", owner=bob,
+            exported=timezone.make_aware(datetime(2000,1,1)), rrs="mx MX 10 mx\nns NS ns\nns A 10.1.1.1")
+        d.splitrecords()
+        call_command('replacerdata', old="mx.z9.example", new="mail.new.net", verbosity=0)
+        call_command('replacerdata', old="ns.z9.example.", new="ns1.new.net", type=["NS"], verbosity=0)
+        self.assertEqual(Domain.objects.get(domain="z9.example").zonetext(),
+            "mx MX 10 mail.new.net.\nns NS ns1.new.net.\nns A 10.1.1.1")
+
+        # bad replacements are reported, not made
+        call_command('replacerdata', old="1.2.3.4", new="not-an-address", verbosity=0)
+        self.assertEqual(len(RdataRef.search("1.2.3.4")), 1)
+
+        # only for staff
+        rc = self.c.get('/edit/replace')
+        self.assertEqual(rc.status_code, 302)
+        User.objects.filter(username='bob').update(is_staff=True)
+        rc = self.c.post('/edit/replace', {"old": "9.9.9.9", "new": "8.8.8.8", "rrtypes": "A",
+            "domains": "z1.example", "apply": "Replace"})
+        self.assertIn("Changed\n   1 records in 1 zones", rc.content.decode())
+        self.assertEqual(len(RdataRef.search("9.9.9.9")), 2)
+
+        # records edited after they're found aren't written back
+        def edit(kind, zone, *args):
+            if kind == 'change' and zone == "z0.example":
+                Record.objects.filter(domain_id=zone, seq=args[0]).update(text="www A 7.7.7.7")
+        self.assertEqual(replace("9.9.9.9", "6.6.6.6", ["A"], report=edit), (1, 1, 1))
+        self.assertIn("www A 7.7.7.7", Domain.objects.get(domain="z0.example").zonetext())
+        self.assertIn("www A 6.6.6.6", Domain.objects.get(domain="z2.example").zonetext())
+        self.assertFalse(Change.objects.filter(domain="z0.example", rdata="9.9.9.9").exists())
+
+# import a directory of BIND zone files
+    def test_20import(self):
+        with tempfile.TemporaryDirectory() as zonedir:
+            with open(os.path.join(zonedir, "example.org"), "w") as fo:
+                fo.write("""$TTL 1h
+$ORIGIN example.org.
+@ IN SOA ns1.example.org. hostmaster.example.org. (
+        2017010101 ; serial
+        3600 900 604800 300 )
+; mail
+@ MX 10 mail    ; primary
+mail 300 IN A 192.0.2.1
+www IN 2h A 192.0.2.2
+txt TXT "semi;colon"
+""")
+            with open(os.path.join(zonedir, "bad.org"), "w") as fo:
+                fo.write("www A not-an-address\n")
+            with open(os.path.join(zonedir, "test.com"), "w") as fo:
+                fo.write("www A 10.0.0.1\n")
+            call_command('import', zonedir, owner='bob', jobs=2, batch_size=1, verbosity=0,
+                report=os.path.join(zonedir, ".report"))
+            with open(os.path.join(zonedir, ".report")) as fi:
+                report = fi.read()
+
+        dom = Domain.objects.get(domain="example.org")
+        self.assertEqual(dom.zonetext(), "; mail\nexample.org. 3600 MX 10 mail\nmail 300 IN A 192.0.2.1\n"
+            "www 7200 IN A 192.0.2.2\ntxt 3600 TXT \"semi;colon\"")
+        self.assertEqual(dom.record_set.filter(valid=True).count(), 5)
+        self.assertEqual(len(RdataRef.search("mail.example.org", ["MX"])), 1)
+        self.assertTrue(PendingExport.objects.filter(domain="example.org").exists())
+        self.assertIn("bad.org failed: record 1", report)
+        self.assertIn("test.com skipped", report)
+        self.assertFalse(Domain.objects.filter(domain="bad.org").exists())
+        self.assertIn("1.2.3.4", Domain.objects.get(domain="test.com").zonetext())
+
+        # replaced zones are journaled, skipped ones aren't counted
+        with tempfile.TemporaryDirectory() as zonedir:
+            with open(os.path.join(zonedir, "test.com"), "w") as fo:
+                fo.write("www A 10.0.0.1\nmail A 10.0.0.2\n")
+            out = StringIO()
+            with redirect_stdout(out):
+                call_command('import', zonedir, owner='bob', verbosity=1)
+            self.assertIn("imported 0 zones 0 records", out.getvalue())
+            call_command('import', zonedir, owner='bob', replace=True, verbosity=0)
+        self.assertEqual(sorted(Change.objects.filter(domain="test.com").values_list('op', 'name', 'rdata')),
+            [('add', 'mail', '10.0.0.2'), ('add', 'www', '10.0.0.1'), ('del', 'www', '1.2.3.4')])
+
+# pull zones from a primary with AXFR
+    def test_21axfr(self):
+        srv = socketserver.ThreadingTCPServer(("127.0.0.1", 0), AXFRHandler)
+        srv.daemon_threads = True
+        srv.zones = { "axfr{0}.example".format(n): """$TTL 300
+@ SOA ns1.example.net. hostmaster.example.net. 1 3600 900 604800 300
+@ NS ns1.example.net.
+@ MX 10 mail
+mail A 192.0.2.{0}
+""".format(n) for n in range(5) }
+        threading.Thread(target=srv.serve_forever, daemon=True).start()
+        try:
+            zones = [ "axfr{0}.example".format(n) for n in range(5) ] + ["slow.example", "nope.example"]
+            with tempfile.TemporaryDirectory() as tmp:
+                call_command('import', *zones, axfr="127.0.0.1:{0}".format(srv.server_address[1]),
+                    owner='bob', concurrency=3, timeout=0.5, jobs=1, batch_size=2, verbosity=0,
+                    report=os.path.join(tmp, "report"))
+                with open(os.path.join(tmp, "report")) as fi:
+                    report = fi.read()
+
+            # a failed parse isn't taken for the end of the zones
+            def broken(zone, text, keepsoa):
+                raise ValueError("parse failed")
+            with mock.patch("editapp.axfr.parseworker", broken), ThreadPoolExecutor(1) as pool:
+                with self.assertRaisesRegex(ValueError, "parse failed"):
+                    list(axfrzones([("axfr1.example", "127.0.0.1", srv.server_address[1])], pool=pool))
+        finally:
+            srv.shutdown()
+            srv.server_close()
+
+        self.assertEqual(Domain.objects.filter(domain__startswith="axfr").count(), 5)
+        dom = Domain.objects.get(domain="axfr3.example")
+        self.assertIn("mail 300 IN A 192.0.2.3", dom.zonetext())
+        self.assertNotIn("SOA", dom.zonetext())
+        self.assertEqual(dom.record_set.filter(valid=False).count(), 0)
+        self.assertIn("slow.example failed: 127.0.0.1: timed out", report)
+        self.assertIn("nope.example failed", report)
+
+# JSON batch edits
+    def test_22apibatch(self):
+        bob = User.objects.get(username='bob')
+        token = ApiToken.make(bob)
+        self.c.get('/edit/edit/test.com')   # split it
+        def api(ops, token=token):
+            return self.c.post('/edit/api/batch', json.dumps({"ops": ops}), content_type="application/json",
+                HTTP_AUTHORIZATION="Token " + token)
+
+        self.assertEqual(api([], token="wrong").status_code, 401)
+        rc = api([{"zone": "test.com", "op": "add", "text": "mail A 10.0.0.1"},
+            {"zone": "test.com", "op": "replace", "old": "www A 1.2.3.4", "text": "www A 5.6.7.8"},
+            {"zone": "test.com", "op": "delete", "seq": 0},
+            {"zone": "test.com", "op": "add", "text": " MX 10 mail"}])
+        self.assertEqual(rc.status_code, 200)
+        self.assertEqual([ r['seq'] for r in rc.json()['results'] ], [2, 1, 0, 3])
+        dom = Domain.objects.get(domain="test.com")
+        self.assertEqual(dom.zonetext(), "www A 5.6.7.8\nmail A 10.0.0.1\n MX 10 mail")
+        self.assertEqual(len(RdataRef.search("mail.test.com", ["MX"])), 1)
+        self.assertEqual(sorted(Change.objects.filter(domain="test.com").values_list('op', 'name', 'rdata')),
+            [('add', 'mail', '10 mail'), ('add', 'mail', '10.0.0.1'), ('add', 'www', '5.6.7.8'),
+             ('del', 'www', '1.2.3.4')])
+
+        # one bad op and nothing happens
+        rc = api([{"zone": "test.com", "op": "delete", "seq": 1},
+            {"zone": "test.com", "op": "add", "text": "x A 1.2.3"},
+            {"zone": "nope.com", "op": "delete", "seq": 1}])
+        self.assertEqual(rc.status_code, 400)
+        res = rc.json()['results']
+        self.assertEqual([ r['ok'] for r in res ], [True, False, False])
+        self.assertEqual(res[2]['error'], "No zone nope.com")
+        self.assertIn("www A 5.6.7.8", Domain.objects.get(domain="test.com").zonetext())
+
+        # true isn't record 1
+        rc = api([{"zone": "test.com", "op": "delete", "seq": True},
+            {"zone": "test.com", "op": "delete", "seq": "1"}])
+        self.assertEqual(rc.status_code, 400)
+        self.assertEqual([ r['error'] for r in rc.json()['results'] ], ["Need an integer seq"] * 2)
+        self.assertIn("mail A 10.0.0.1", Domain.objects.get(domain="test.com").zonetext())
+
+# block edits only parse changed lines and report the same errors
+    def test_23blockcheck(self):
+        from .formsextlang import validate_rrs, checklines
+        from django.core.exceptions import ValidationError
+        text = "ok A 1.2.3.4\nx A 1.2.3\n; c\nwww 1h A 1.2.3.4\ny BOGUS z\nx A 1.2.3"
+        with self.assertRaises(ValidationError) as full:
+            validate_rrs(text)
+        with self.assertRaises(ValidationError) as inc:
+            validate_rrs(text, known={"ok A 1.2.3.4"})
+        self.assertEqual(full.exception.messages, inc.exception.messages)
+        self.assertNotIn("ok A 1.2.3.4", checklines(text.splitlines(), {"ok A 1.2.3.4"}))
+
+        # a big paste's results don't push the zones out of the zone cache
+        from .formsextlang import linecache
+        zonecache.zcache().set("zone:keep", "x")
+        lines = [ "h{0} A 10.{1}.{2}.1".format(n, n // 250, n % 250) for n in range(3000) ]
+        checklines(lines)
+        self.assertEqual(zonecache.zcache().get("zone:keep"), "x")
+        self.assertEqual(len(linecache().get_many([ "line:" + hashlib.sha1(l.encode()).hexdigest()
+            for l in lines ])), 3000)
+
+        self.c.get('/edit/edit/test.com')
+        rc = self.c.post('/edit/editblock/test.com', {"domain": "test.com", "owner": "bob",
+            "rrs": "; a comment\nwww A 1.2.3.4\nbad A 1.2"})
+        self.assertIn("Bad IPv4 format", rc.content.decode())
+        self.assertNotIn("bad A", Domain.objects.get(domain="test.com").zonetext())
+
+# big pastes are checked in a process pool with the same errors
+    def test_24parallelcheck(self):
+        from . import formsextlang
+        from django.core.exceptions import ValidationError
+        from dnsextlang import ExtrecList
+        text = "\n".join("h{0} A 10.0.{1}.{2}".format(n, n // 250, n % 250) if n % 7 else "h{0} A 10.0.{0}".format(n)
+            for n in range(40))
+        full = ExtrecList(formsextlang.extxl, string=text).err_str()
+        try:
+            with self.settings(PARALLEL_CHECK_LINES=5, PARALLEL_CHECK_JOBS=2):
+                with self.assertRaises(ValidationError) as par:
+                    formsextlang.validate_rrs(text)
+                self.assertIsNotNone(formsextlang._pool)
+
+                # a dead worker doesn't break later checks
+                for pid in list(formsextlang._pool._processes):
+                    os.kill(pid, signal.SIGKILL)
+                formsextlang.linecache().clear()
+                with self.assertLogs('editapp.formsextlang', 'WARNING'), \
+                        self.assertRaises(ValidationError) as broken:
+                    formsextlang.validate_rrs(text)
+                self.assertIsNone(formsextlang._pool)
+                self.assertEqual(broken.exception.messages, [full])
+                formsextlang.linecache().clear()
+                with self.assertRaises(ValidationError):
+                    formsextlang.validate_rrs(text)
+                self.assertIsNotNone(formsextlang._pool)
+        finally:
+            if formsextlang._pool:
+                formsextlang._pool.shutdown()
+                formsextlang._pool = None
+        self.assertEqual(par.exception.messages, [full])
+        self.assertEqual(full.count("Bad IPv4 format"), 6)
+
+# record forms come from one class per rrtype, made once
+    def test_25rrforms(self):
+        from .formsextlang import RRForm, rrformclass, extxl
+        f = RRForm("www 300 MX 10 mail.test.com.")
+        self.assertIs(type(f), rrformclass('mx'))
+        self.assertIs(type(RRForm(rrname="MX")), type(f))
+        self.assertEqual(list(f.fields)[:3], ['name', 'ttl', 'rrname0'])
+        html = str(f)
+        self.assertIn('value="mail.test.com."', html)
+        self.assertIn('value="MX"', html)
+
+        # another form of the same type doesn't share values
+        g = RRForm("ftp MX 20 other.test.com.")
+        self.assertIn('value="other.test.com."', str(g))
+        self.assertNotIn('other.test.com.', str(f))
+
+        # bound forms check out the same way as before
+        b = RRForm({"rrname0": "MX", "name": "www", "ttl": "300", "rr0": "10", "rr1": "mail.test.com."})
+        self.assertTrue(b.is_valid())
+        self.assertEqual(b.cleaned_data['dnsrecord'], str(f.rec))
+        self.assertFalse(RRForm({"rrname0": "A", "name": "", "rr0": "1.2"}).is_valid())
+
+        # every rrtype makes a form
+        for rr in extxl.rrnames():
+            str(RRForm(rrname=rr))
+
+# zone pages answer conditional GETs until the zone changes
+    def test_26conditional(self):
+        Domain.objects.filter(domain="test.com").update(updated=timezone.now() - timedelta(minutes=1))
+        for url in ('/edit/edit/test.com', '/edit/record/test.com/1', '/edit/editblock/test.com'):
+            rc = self.c.get(url)
+            self.assertEqual(rc.status_code, 200)
+            etag = rc['ETag']
+            self.assertIn('no-cache', rc['Cache-Control'])
+            rc = self.c.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(rc.status_code, 304)
+            self.assertEqual(rc.content, b"")
+            rc = self.c.get(url, HTTP_IF_MODIFIED_SINCE=rc['Last-Modified'])
+            self.assertEqual(rc.status_code, 304)
+        rc = self.c.get('/edit/edit/test.com?size=10', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(rc.status_code, 200)
+
+        # a change makes a new tag and new rows
+        rc = self.c.get('/edit/edit/test.com')
+        etag = rc['ETag']
+        self.assertIn('1.2.3.4', rc.content.decode())
+        self.c.post('/edit/record/test.com/1', {"rrname0": "A", "name": "www", "rr0": "5.6.7.8"})
+        rc = self.c.get('/edit/edit/test.com', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(rc.status_code, 200)
+        self.assertNotEqual(rc['ETag'], etag)
+        self.assertIn('5.6.7.8', rc.content.decode())
+        self.assertNotIn('1.2.3.4', rc.content.decode())
+        # no Last-Modified until the second of the change is over
+        Domain.objects.filter(domain="test.com").update(updated=timezone.now() + timedelta(milliseconds=500))
+        self.assertNotIn('Last-Modified', self.c.get('/edit/edit/test.com'))
+        Domain.objects.filter(domain="test.com").update(updated=timezone.now() - timedelta(seconds=1))
+        self.assertIn('Last-Modified', self.c.get('/edit/edit/test.com'))
+
+        # other users don't get a tag for zones they can't see
+        User.objects.create_user(username='eve', password='eve')
+        c = Client()
+        c.login(username='eve', password='eve')
+        rc = c.get('/edit/edit/test.com', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(rc.status_code, 404)
+
+# the edit page's script edits records with fragments and JSON
+    def test_27fragments(self):
+        rc = self.c.get('/edit/edit/test.com')
+        self.assertIn('id="rec1"', rc.content.decode())
+        self.assertIn('<script>', rc.content.decode())
+
+        # record form without the page around it
+        rc = self.c.get('/edit/record/test.com/1?fragment=1')
+        self.assertIn('class="recform"', rc.content.decode())
+        self.assertIn('value="1.2.3.4"', rc.content.decode())
+        self.assertNotIn('<html>', rc.content.decode())
+
+        rc = self.c.post('/edit/record/test.com/1', {"rrname0": "A", "name": "www", "rr0": "5.6.7.8",
+            "fragment": "1"})
+        j = rc.json()
+        self.assertEqual((j['seq'], j['valid'], j['text']), (1, True, "www A 5.6.7.8"))
+        self.assertIn('id="rec1"', j['row'])
+        self.assertIn('www A 5.6.7.8', j['row'])
+        self.assertEqual(Record.objects.get(domain_id="test.com", seq=1).text, "www A 5.6.7.8")
+
+        rc = self.c.post('/edit/record/test.com/1', {"rrname0": "A", "name": "www", "rr0": "5.6",
+            "fragment": "1"})
+        self.assertEqual(rc.status_code, 400)
+        self.assertTrue(rc.json()['errors'])
+
+        # add and delete
+        rc = self.c.post('/edit/recadd/test.com', {"rrname": "MX", "fragment": "1"})
+        self.assertIn('name="rrname0"', rc.content.decode())
+        self.assertNotIn('name="delete"', rc.content.decode())
+        rc = self.c.post('/edit/recadd/test.com', {"rrname0": "MX", "name": "", "rr0": "10",
+            "rr1": "mail.test.com.", "fragment": "1"})
+        self.assertEqual(rc.json()['seq'], 2)
+        self.assertIn('id="rec2"', rc.json()['row'])
+        rc = self.c.post('/edit/record/test.com/0', {"rrname0": "COMMENT", "comment": "; gone",
+            "delete": "Delete", "fragment": "1"})
+        self.assertEqual(rc.json(), {'seq': 0, 'deleted': True})
+        self.assertEqual(Domain.objects.get(domain="test.com").zonetext().split(), "www A 5.6.7.8 MX 10 mail.test.com.".split())
+
+
+# the views stay within their query budgets however big the zone is
+    def test_28budgets(self):
+        rc = self.c.get('/edit/edit/test.com')
+        self.assertIn('total;dur=', rc['Server-Timing'])
+        self.assertQueryBudget(rc, 17)
+        self.assertEqual(len(connection.queries_log), 0)    # counted without keeping the SQL
+        for n in (1, 300):
+            d = Domain.objects.get(domain="test.com")
+            d.rrs = "\n".join("h{0} A 10.0.0.{1}".format(k, k % 250) for k in range(n))
+            d.save()
+            d.splitrecords()
+            self.assertQueryBudget(self.c.get('/edit/'), 5)
+            self.assertQueryBudget(self.c.get('/edit/edit/test.com?size=500'), 17)
+            self.assertQueryBudget(self.c.get('/edit/edit/test.com?size=500'), 7)
+            self.assertQueryBudget(self.c.get('/edit/record/test.com/0'), 8)
+            self.assertQueryBudget(self.c.get('/edit/editblock/test.com'), 9)
+            self.assertQueryBudget(self.c.get('/edit/search?v=10.0.0.1'), 6)
+            self.assertQueryBudget(self.c.post('/edit/record/test.com/0', {"rrname0": "A", "name": "h0",
+                "rr0": "10.9.9.9", "fragment": "1"}), 16)
+            self.assertQueryBudget(self.c.post('/edit/recadd/test.com', {"rrname0": "A", "name": "x",
+                "rr0": "10.9.9.9", "fragment": "1"}), 15)
+            self.assertQueryBudget(self.c.post('/edit/record/test.com/0', {"rrname0": "A", "name": "h0",
+                "rr0": "10.9.9.8"}), 21)
+
+        rc = self.c.post('/edit/editblock/test.com', {"domain": "test.com", "owner": "bob",
+            "rrs": "; a comment\nwww A 1.2.3.4"})
+        self.assertQueryBudget(rc, 23)
+
+# metrics from all the processes in prometheus format
+    def test_29metrics(self):
+        with tempfile.TemporaryDirectory() as mdir, self.settings(METRICS_DIR=mdir):
+            # another process's counts
+            with open(os.path.join(mdir, "1-1.json"), "w") as fo:
+                json.dump([["editapp_export_zones_total", [["result", "written"]], 5]], fo)
+            self.c.get('/edit/edit/test.com')
+            self.c.post('/edit/editblock/test.com', {"domain": "test.com", "owner": "bob",
+                "rrs": "; a comment\nwww A 5.6.7.8"})
+            self.c.get('/edit/edit/test.com')
+
+            rc = self.c.get('/metrics')
+            self.assertEqual(rc.status_code, 200)
+            text = rc.content.decode()
+            self.assertIn('# TYPE editapp_request_seconds histogram', text)
+            self.assertRegex(text, r'editapp_request_seconds_bucket\{le="\+Inf",view="editview"\} \d')
+            self.assertRegex(text, r'editapp_parse_records_total\{kind="block"\} \d')
+            self.assertIn('editapp_zone_cache_hit_ratio ', text)
+            mine = metrics.collect(False).get(('editapp_export_zones_total', (('result', 'written'),)), 0)
+            self.assertIn('editapp_export_zones_total{{result="written"}} {0}'.format(float(mine + 5)), text)
+
+            # the export writes its own numbers for the node exporter
+            mfile = os.path.join(mdir, "export.prom")
+            call_command('export', all=self.tempzonedir(), metrics_file=mfile, verbosity=0)
+            with open(mfile) as fi:
+                text = fi.read()
+            self.assertIn('editapp_export_seconds_count', text)
+            self.assertIn('editapp_export_zones_total{result="written"}', text)
+
+            rc = self.c.get('/metrics', REMOTE_ADDR='192.0.2.1')
+            self.assertEqual(rc.status_code, 403)
+
+            # pool workers write their counts even though they exit
+            # without atexit, and are merged into the archive once
+            # they're gone
+            key = ('editapp_parse_records_total', (('kind', 'import'),))
+            before = metrics.collect().get(key, 0)
+            zdir = self.tempzonedir()
+            for n in range(3):
+                with open(os.path.join(zdir, "m{0}.example".format(n)), "w") as fo:
+                    fo.write("www A 192.0.2.{0}\nmail A 192.0.2.9\n".format(n))
+            call_command('import', zdir, owner='bob', jobs=2, verbosity=0)
+            self.assertEqual(metrics.collect().get(key, 0) - before, 6)
+            pids = [ int(fn.split('-')[0]) for fn in os.listdir(mdir) if fn[0].isdigit() ]
+            self.assertEqual(sorted(set(pids)), [1, os.getpid()])
+            self.assertIn(metrics.ARCHIVE, os.listdir(mdir))
+
+            # a process that has exited is counted once
+            p = subprocess.Popen(["true"])
+            p.wait()
+            with open(os.path.join(mdir, "{0}-1.json".format(p.pid)), "w") as fo:
+                json.dump([["editapp_export_zones_total", [["result", "removed"]], 7]], fo)
+            key = ('editapp_export_zones_total', (('result', 'removed'),))
+            total = metrics.collect().get(key, 0)
+            self.assertGreaterEqual(total, 7)
+            self.assertNotIn("{0}-1.json".format(p.pid), os.listdir(mdir))
+            self.assertEqual(metrics.collect().get(key, 0), total)
+
+# sampled requests are profiled and the profiles summed up
+    def test_30profiles(self):
+        with tempfile.TemporaryDirectory() as pdir, self.settings(PROFILE_DIR=pdir, PROFILE_KEEP=3):
+            self.c.get('/edit/edit/test.com')
+            self.assertEqual(os.listdir(pdir), [])
+
+            with self.settings(PROFILE_SAMPLE=1):
+                self.c.get('/edit/edit/test.com')
+                self.c.get('/edit/record/test.com/1')
+                self.c.get('/edit/')
+            self.assertEqual(len(os.listdir(pdir)), 6)
+
+            # staff can ask for one with a token
+            out = StringIO()
+            call_command('profiles', token=True, stdout=out)
+            token = out.getvalue().strip()
+            self.c.get('/edit/edit/test.com?profile=' + token)
+            self.assertEqual(len(os.listdir(pdir)), 6)
+            User.objects.filter(username='bob').update(is_staff=True)
+            self.c.get('/edit/edit/test.com?profile=' + token)
+            self.c.get('/edit/edit/test.com?profile=' + token + 'x')
+            # only the newest three are kept
+            self.assertEqual(len(os.listdir(pdir)), 6)
+            from .profiles import stored
+            tags = [ t for f, t in stored() ]
+            self.assertEqual([ t['view'] for t in tags ], ['recordview', 'indexview', 'editview'])
+            self.assertEqual((tags[2]['zone'], tags[2]['size']), ('test.com', 2))
+            self.assertIn('profile=', tags[2]['path'])
+
+            out = StringIO()
+            call_command('profiles', view='editview', top=5, stdout=out)
+            self.assertIn('editview', out.getvalue())
+            self.assertIn('views.py', out.getvalue())
+            self.assertNotIn('recordview', out.getvalue().split("\n\n")[0])
+
+# split old style zones a chunk at a time
+    def test_31splitrecords(self):
+        bob = User.objects.get(username='bob')
+        for n in range(5):
+            Domain.objects.create(domain="s{0}.example".format(n), owner=bob,
+                exported=timezone.make_aware(datetime(2000,1,1)), rrs="www A 10.0.0.{0}\n MX 10 mail".format(n))
+        call_command('splitrecords', chunk_size=2, verbosity=0)
+        self.assertEqual(Record.objects.filter(domain__domain__startswith="s").count(), 10)
+        self.assertEqual(Record.objects.filter(domain="test.com").count(), 2)
+
+        Domain.objects.filter(domain="s3.example").update(rrs="www A 10.9.9.9")
+        call_command('splitrecords', "s3.example", "s4.example", force=True, chunk_size=1, verbosity=0)
+        self.assertEqual(Record.objects.filter(domain="s3.example").count(), 1)
+        self.assertEqual(Record.objects.filter(domain="s4.example").count(), 2)
@@ -7,6 +7,10 @@ from . import views
 app_name = 'editapp'
 urlpatterns = [
     url(r'^$', views.indexview, name='index'),
+    url(r'^lookup$', views.lookupview, name='lookup'),
+    url(r'^search$', views.searchview, name='search'),
+    url(r'^replace$', views.replaceview, name='replace'),
+    url(r'^api/batch$', views.apibatchview, name='apibatch'),
     url(r'^create$', views.createview, name='create'),
     url(r'^edit/([-a-zA-Z0-9._]+)$', views.editview, name='edit'),
     url(r'^editblock/([-a-zA-Z0-9._]+)$', views.editblockview, name='editblock'),
@@ -1,29 +1,90 @@
 # DNS editor views
 
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import HttpResponse, HttpResponseNotFound, Http404
+from django.urls import reverse
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+from django.http import HttpResponse, HttpResponseNotFound, HttpResponseForbidden, Http404, JsonResponse
 from django.contrib.auth import logout
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+from django.db import transaction
 from django.db.models.functions import Substr
 from django.utils import timezone
-from .forms import DomainForm, ShortDomainForm, DomainEditForm
+from .forms import DomainForm, ShortDomainForm, DomainEditForm, ReplaceForm
 from .formsextlang import extxl, RRForm, CommentForm
-from .models import Domain
+from .models import Domain, Record, RdataRef, ApiToken
+from .zonecache import zoneview, recposition, cachedrows
+from .bulkedit import replace, editzone
+from . import metrics
+from django.conf import settings
 from django.contrib.auth.models import User
-from datetime import datetime
-import dnsextlang
+from datetime import datetime, timedelta
+import hashlib
+import json
+
+def visibledomains(request):
+    """
+    the domains this user can see
+    """
+    domdb = Domain.objects
+    if not request.user.has_perm('editapp.see_all'): # only see mine
+        domdb = domdb.filter(owner=request.user)
+    return domdb
+
+def ownerof(request, owner):
+    """
+    User for an owner name from a form, usually the user making the
+    request, which doesn't need a query
+    """
+    if owner == request.user.username:
+        return request.user
+    return User.objects.get(username=owner)
+
+def searchdomains(domdb, q, anywhere=False):
+    """
+    domains starting with q, or containing it if anywhere
+    prefix search can use the index on domain, substring search can't
+    """
+    if not q:
+        return domdb
+    return domdb.filter(domain__icontains=q) if anywhere else domdb.filter(domain__istartswith=q)
 
 @login_required
 def indexview(request):
     """
     initial page
-    shows all the domains in columns
+    shows a page of the domains in columns
+    ?q= to search by prefix, &anywhere=1 for substring
+    ?after= and ?before= page forward and back from a name
     """
-
-    domdb = Domain.objects
-    if not request.user.has_perm('editapp.see_all'): # only see mine
-        domdb = domdb.filter(owner__username=request.user.username)
-    domains = [ d.domain for d in domdb.order_by('domain') ]
+    size = getattr(settings, 'INDEX_PAGE_SIZE', 200)
+    q = request.GET.get('q', '').strip()
+    anywhere = bool(request.GET.get('anywhere'))
+    after = request.GET.get('after')
+    before = request.GET.get('before')
+
+    # page by name rather than offset so every page is an index range scan
+    # fetch one extra to see if there's more
+    domdb = searchdomains(visibledomains(request), q, anywhere).values_list('domain', flat=True)
+    if before:
+        domains = list(domdb.filter(domain__lt=before).order_by('-domain')[:size+1])
+        domains.reverse()
+        more = True
+        less = len(domains) > size
+        if less:
+            domains = domains[1:]
+    else:
+        if after:
+            domdb = domdb.filter(domain__gt=after)
+        domains = list(domdb.order_by('domain')[:size+1])
+        less = bool(after)
+        more = len(domains) > size
+        if more:
+            domains = domains[:size]
 
     # show in four columns
     # so slice into four arrays
@@ -33,9 +94,137 @@ def indexview(request):
     return render(request, 'editapp/index.html',
         {
             'c1': c1, 'c2': c2, 'c3': c3, 'c4': c4,
+            'q': q,
+            'anywhere': anywhere,
+            'prev': domains[0] if less and domains else None,
+            'next': domains[-1] if more and domains else None,
             'bpnav': bpnav(request, 'index')
         })
 
+@login_required
+def lookupview(request):
+    """
+    JSON list of domain names for type-ahead
+    ?q=prefix&limit=N, &anywhere=1 for substring
+    """
+    limit = min(_intarg(request.GET.get('limit'), 20), 100)
+    q = request.GET.get('q', '').strip()
+    domdb = searchdomains(visibledomains(request), q, bool(request.GET.get('anywhere')))
+    domains = list(domdb.order_by('domain').values_list('domain', flat=True)[:limit])
+    return JsonResponse({'domains': domains})
+
+def metricsview(request):
+    """
+    prometheus metrics for all of the processes, see metrics.py
+    for addresses in settings.METRICS_ALLOWED_IPS, default this host,
+    or staff users
+    """
+    if request.META.get('REMOTE_ADDR') not in getattr(settings, 'METRICS_ALLOWED_IPS', ('127.0.0.1', '::1')) \
+            and not request.user.is_staff:
+        return HttpResponseForbidden("Not allowed")
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+@login_required
+def searchview(request):
+    """
+    find records that point at an address or host name
+    ?v=value, &type=rrtype can repeat
+    """
+    value = request.GET.get('v', '').strip()
+    rrtypes = [ t for ts in request.GET.getlist('type') for t in ts.replace(',', ' ').split() ]
+    limit = getattr(settings, 'SEARCH_MAX_RESULTS', 1000)
+    hits = RdataRef.search(value, rrtypes, visibledomains(request), limit+1) if value else []
+
+    return render(request, 'editapp/search.html',
+        {
+            'value': value,
+            'rrtypes': " ".join(rrtypes),
+            'hits': hits[:limit],
+            'more': len(hits) > limit,
+            'bpnav': bpnav(request, 'search')
+        })
+
+@staff_member_required
+def replaceview(request):
+    """
+    find and replace an address or host name across zones
+    Preview shows what would change, Replace does it
+    """
+    changes = []
+    errors = []
+    batches = []
+    result = None
+    if request.method == 'POST':
+        form = ReplaceForm(request.POST)
+        if form.is_valid():
+            cd = form.cleaned_data
+            dryrun = 'apply' not in request.POST
+            def report(kind, *args):
+                { 'change': changes, 'error': errors, 'batch': batches }[kind].append(args)
+            doms = None
+            if cd['domains'].split():
+                doms = Domain.objects.filter(domain__in=cd['domains'].split())
+            result = replace(cd['old'], cd['new'], cd['rrtypes'].replace(',', ' ').split(), doms,
+                dryrun=dryrun, report=report)
+            result += (dryrun,)
+    else:
+        form = ReplaceForm()
+
+    return render(request, 'editapp/replace.html',
+        {
+            'form': form,
+            'changes': changes[:getattr(settings, 'SEARCH_MAX_RESULTS', 1000)],
+            'errors': errors,
+            'batches': batches,
+            'result': result,
+            'bpnav': bpnav(request, 'replace')
+        })
+
+class Rollback(Exception):
+    pass
+
+@csrf_exempt
+def apibatchview(request):
+    """
+    JSON API to edit records in bulk
+    POST {"ops": [{"zone": z, "op": "add"|"replace"|"delete", "seq": n or "old": text,
+        "text": text}, ...]} with Authorization: Token xxx
+    all of the ops are done in one transaction or none of them are
+    """
+    user = ApiToken.authuser(request.META.get('HTTP_AUTHORIZATION'))
+    if not user:
+        return JsonResponse({'error': "Need a valid token"}, status=401)
+    if request.method != 'POST':
+        return JsonResponse({'error': "POST only"}, status=405)
+    try:
+        ops = json.loads(request.body.decode())['ops']
+        if not isinstance(ops, list) or not all(isinstance(op, dict) for op in ops):
+            raise ValueError
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'error': "Need a JSON object with a list of ops"}, status=400)
+
+    request.user = user
+    results = [ None ] * len(ops)
+    byzone = {}
+    for n, op in enumerate(ops):
+        byzone.setdefault(str(op.get('zone', '')), []).append(n)
+    doms = { d.domain: d for d in visibledomains(request).filter(domain__in=list(byzone)) }
+    try:
+        with transaction.atomic():
+            for zone, ns in sorted(byzone.items()):
+                if zone not in doms:
+                    for n in ns:
+                        results[n] = {'ok': False, 'error': "No zone " + zone}
+                    continue
+                for n, res in zip(ns, editzone(doms[zone], [ ops[n] for n in ns ])):
+                    results[n] = res
+            if not all(res['ok'] for res in results):
+                raise Rollback
+        applied = True
+    except Rollback:
+        applied = False
+    return JsonResponse({'applied': applied, 'results': results}, status=200 if applied else 400)
+
 @login_required
 def createview(request):
     """
@@ -46,16 +235,16 @@ def createview(request):
         if form.is_valid():
             cd = form.cleaned_data
             owner = cd['owner'] if cd['owner'] else request.user.username
-            ownerdb = User.objects.get(username=owner)
+            ownerdb = ownerof(request, owner)
             domainname = cd['domain']
 
             # see if it's a duplicate name
-            exists = Domain.objects.filter(domain=domainname)
-            if len(exists) == 0:
-                Domain.objects.create(domain=domainname,
+            if not Domain.objects.filter(domain=domainname).exists():
+                dom = Domain.objects.create(domain=domainname,
                     owner=ownerdb,
                     exported=timezone.make_aware(datetime(2000,1,1)),
                     rrs='; records for {0}\n'.format(domainname))
+                dom.splitrecords()
                 return editview(request, domainname)
             # duplicate name
             form.errors["domain"] = ["Name already exists"]
@@ -68,7 +257,59 @@ def createview(request):
             'bpnav': bpnav(request, 'create')
         })
 
+def zoneupdated(request, domainname, *args, **kwargs):
+    """
+    when a zone the user can see last changed, for conditional GETs
+    None if they can't see it or it's not a GET
+    looked up once per request
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return None
+    if not hasattr(request, 'zoneupdated'):
+        domdb = Domain.objects.filter(domain=domainname)
+        if not request.user.has_perm('dnsedit.see_all'):
+            domdb = domdb.filter(owner__username=request.user.username)
+        request.zoneupdated = domdb.values_list('updated', flat=True).first()
+    return request.zoneupdated
+
+def zonelastmodified(request, domainname, *args, **kwargs):
+    """
+    Last-Modified for a zone page, None until the second the zone
+    last changed in is over
+    HTTP dates are in whole seconds, so a client that got the page
+    during that second could miss a second change in it and get a 304
+    for a stale page, later changes are in a later second
+    """
+    updated = zoneupdated(request, domainname)
+    if updated is None or timezone.now() < updated.replace(microsecond=0) + timedelta(seconds=1):
+        return None
+    return updated
+
+def zoneetag(request, domainname, *args, **kwargs):
+    """
+    ETag for a zone page, changes when the zone does, and differs for
+    each page and query and for anything about the user that changes
+    what the page shows, including the CSRF cookie the forms use
+    """
+    updated = zoneupdated(request, domainname)
+    if updated is None:
+        return None
+    user = request.user
+    tag = "{0} {1} {2} {3} {4} {5}".format(updated.isoformat(), request.get_full_path(), user.pk,
+        user.is_staff, user.has_perm('dnsedit.see_all'), request.COOKIES.get(settings.CSRF_COOKIE_NAME, ''))
+    return hashlib.sha1(tag.encode()).hexdigest()
+
+def zonepage(view):
+    """
+    decorator for zone pages, answer If-None-Match and If-Modified-Since
+    with a 304 if the zone hasn't changed, and make browsers check
+    each time
+    """
+    return cache_control(private=True, no_cache=True)(
+        condition(etag_func=zoneetag, last_modified_func=zonelastmodified)(view))
+
 @login_required
+@zonepage
 def editblockview(request, domainname, postok=True):
     """
     edit existing domain as a block of text
@@ -83,19 +324,24 @@ def editblockview(request, domainname, postok=True):
 
     if postok and request.method == 'POST':
         form = DomainForm(request.POST)
+        # only parse the lines that aren't already valid records
+        form.fields['rrs'].known = set(text for seq, valid, text in zoneview(dom)[1] if valid)
         if form.is_valid():
             cd = form.cleaned_data
             owner = cd['owner'] if cd['owner'] else request.user.username # non-priv can't change owner
-            ownerdb = User.objects.get(username=owner)
+            ownerdb = ownerof(request, owner)
 
             dom.ownerdb = ownerdb
+            dom.checksplit()            # so the journal sees the old records
             dom.rrs=cd['rrs']
+            dom.rrsstale = False
             dom.updated = timezone.now()
             dom.save()
+            dom.splitrecords(journal=True)
             return editview(request, domainname, postok=False)
         # otherwise fall through to edit again
     else:
-        form = DomainForm(initial={'domain': dom.domain, 'owner': dom.owner.username, 'rrs': dom.rrs})
+        form = DomainForm(initial={'domain': dom.domain, 'owner': dom.owner.username, 'rrs': dom.zonetext()})
 
     return render(request, 'editapp/editblock.html',
         {
@@ -104,10 +350,13 @@ def editblockview(request, domainname, postok=True):
             'bpnav': bpnav(request, 'edit')
         })
 
-def editview(request, domainname, postok=True):
+@zonepage
+def editview(request, domainname, postok=True, showrec=None):
     """
     edit existing domain as records
     argument is domain name
+    shows a page of records, ?page=N&size=N, or the page with
+    record showrec or ?rec=N
     """
 
     # has to exist if you're going to edit it
@@ -124,21 +373,35 @@ def editview(request, domainname, postok=True):
         if form.is_valid():
             cd = form.cleaned_data
             owner = cd['owner'] if cd['owner'] else request.user.username # non-priv can't change owner
-            ownerdb = User.objects.get(username=owner)
+            ownerdb = ownerof(request, owner)
 
             dom.ownerdb = ownerdb
             dom.updated = timezone.now()
             # post doesn't change records, only maybe the owner
             dom.updated = timezone.now()
-            dom.save()
+            dom.save(update_fields=['owner', 'updated'])
         # otherwise fall through to edit again
     else:
         form = DomainEditForm(initial={'domain': dom.domain, 'owner': dom.owner.username })
 
-    # make records individually editable
-    rrls = dnsextlang.ExtrecList(extxl, dom.rrs)
-    # list of (seq, valid, rrtext
-    rrview = [ (n, r.is_valid(), str(r)) for n, r in enumerate(rrls, start=0) ]
+    # make records individually editable a page at a time
+    # list of (seq, valid, rrtext)
+    size = _intarg(request.GET.get('size'), getattr(settings, 'EDIT_PAGE_SIZE', 100))
+    size = min(max(size, 10), 5000)
+    if showrec is None:
+        showrec = _intarg(request.GET.get('rec'), None)
+    if showrec is not None:
+        page = recposition(dom, showrec) // size + 1
+    else:
+        page = max(_intarg(request.GET.get('page'), 1), 1)
+    # the rendered rows are cached for each version of the zone
+    def rows(rrview):
+        return render_to_string('editapp/rows.html', { 'domain': domainname, 'rrview': rrview })
+    total, nrows, rowhtml = cachedrows(dom, (page-1)*size, size, rows)
+    npages = max((total + size - 1) // size, 1)
+    if page > npages:
+        page = npages
+        total, nrows, rowhtml = cachedrows(dom, (page-1)*size, size, rows)
 
     # spinner for new RRs
     addspinner = extxl.rrnames(select="rrname")
@@ -147,12 +410,51 @@ def editview(request, domainname, postok=True):
         {
             'form': form,
             'domain': domainname,
-            'rrview': rrview,
+            'rows': mark_safe(rowhtml),
+            'total': total,
+            'first': (page-1)*size + 1,
+            'last': (page-1)*size + nrows,
+            'page': page,
+            'npages': npages,
+            'size': size,
             'addspinner': addspinner,
             'bpnav': bpnav(request, 'edit')
         })
 
+def _intarg(arg, default):
+    """
+    integer query argument or default if it's missing or not a number
+    """
+    return int(arg) if arg and arg.isdigit() else default
+
+def isfragment(request):
+    """
+    request from the edit page's script, which wants a piece of a page
+    or JSON rather than a whole page
+    """
+    return bool(request.GET.get('fragment') or request.POST.get('fragment'))
+
+def rowreply(domainname, rec, deleted=False):
+    """
+    reply to a record edit from the edit page's script
+    the record's new table row, so the page can patch that row rather
+    than fetching the whole zone again
+    """
+    if deleted:
+        return JsonResponse({'seq': rec.seq, 'deleted': True})
+    row = render_to_string('editapp/rows.html', { 'domain': domainname,
+        'rrview': [(rec.seq, rec.valid, rec.text)] })
+    return JsonResponse({'seq': rec.seq, 'valid': rec.valid, 'text': rec.text, 'row': row})
+
+def formerrors(form):
+    """
+    reply to a record edit from the script that didn't check out
+    """
+    return JsonResponse({'errors': [ "{0}: {1}".format(f, " ".join(e)) if f != '__all__' else " ".join(e)
+        for f, e in form.errors.items() ]}, status=400)
+
 @login_required
+@zonepage
 def recordview(request, domainname, recno):
     """
     edit or delete a record existing domain as a block of text
@@ -164,46 +466,49 @@ def recordview(request, domainname, recno):
         dom = get_object_or_404(Domain, domain=domainname) 
     else:
         dom = get_object_or_404(Domain, domain=domainname, owner__username=request.user.username)
-    lineno = int(recno)
-    rrs = dnsextlang.ExtrecList(extxl, dom.rrs)
-    if lineno < 0 or lineno > len(rrs):
-        raise Http404("No record {0} in {1}".format(lineno, domainname))
+    dom.checksplit()
+    try:
+        rec = Record.objects.get(domain=dom, seq=int(recno))
+    except Record.DoesNotExist:
+        raise Http404("No record {0} in {1}".format(recno, domainname))
+    rec.domain = dom
 
     if request.method == 'POST':
         if request.POST['rrname0'] == "COMMENT":
             form = CommentForm(request.POST)
             if form.is_valid():
-                rrlist = dom.rrs.splitlines()
                 if 'delete' in request.POST:
-                    rrlist[lineno:lineno+1] = [] # snip out the record
+                    rec.remove()        # snip out the record
                 else:
-                    rrlist[lineno] = form.cleaned_data.get('comment')
-                dom.rrs = "\n".join(rrlist)
-                dom.updated = timezone.now()
-                dom.save()
-                return editview(request, domainname, postok=False)
+                    rec.change(form.cleaned_data.get('comment'))
+                if isfragment(request):
+                    return rowreply(domainname, rec, deleted='delete' in request.POST)
+                return editview(request, domainname, postok=False, showrec=rec.seq)
         else:
             form = RRForm(request.POST)
             if form.is_valid():
-                rrlist = dom.rrs.splitlines()
                 if 'delete' in request.POST:
-                    rrlist[lineno:lineno+1] = [] # snip out the record
+                    rec.remove()        # snip out the record
                 else:
-                    rrlist[lineno] = form.cleaned_data.get('dnsrecord')
-                dom.rrs = "\n".join(rrlist)
-                dom.updated = timezone.now()
-                dom.save()
-                return editview(request, domainname, postok=False)
+                    rec.change(form.cleaned_data.get('dnsrecord'))
+                if isfragment(request):
+                    return rowreply(domainname, rec, deleted='delete' in request.POST)
+                return editview(request, domainname, postok=False, showrec=rec.seq)
 
         # otherwise fall through to edit again
+        if isfragment(request):
+            return formerrors(form)
 
     else:    
-        record = str(rrs[lineno])
-        if record.strip()[0] == ';':     # it's a comment
+        record = rec.text
+        if record.strip()[:1] in ('', ';'):     # it's a comment
             form = CommentForm(initial={'comment': record})
         else:
             form = RRForm(record)
-    
+
+    if isfragment(request):
+        return render(request, 'editapp/recordform.html',
+            { 'form': form, 'action': reverse('editapp:record', args=(domainname, recno)), 'delete': True })
     return render(request, 'editapp/record.html',
         {
             'form': form,
@@ -229,27 +534,30 @@ def recordaddview(request, domainname):
         if request.POST['rrname0'] == "COMMENT":
             form = CommentForm(request.POST)
             if form.is_valid():
-                rrlist = dom.rrs.splitlines()
-                rrlist.append(form.cleaned_data.get('comment'))
-                dom.rrs = "\n".join(rrlist)
-                dom.updated = timezone.now()
-                dom.save()
-                return editview(request, domainname, postok=False)
+                dom.checksplit()
+                rec = Record.append(dom, form.cleaned_data.get('comment'))
+                if isfragment(request):
+                    return rowreply(domainname, rec)
+                return editview(request, domainname, postok=False, showrec=rec.seq)
         else:                           # Add button
             form = RRForm(request.POST)
             if form.is_valid():
-                rrlist = dom.rrs.splitlines()
-                rrlist.append(form.cleaned_data.get('dnsrecord'))
-                dom.rrs = "\n".join(rrlist)
-                dom.updated = timezone.now()
-                dom.save()
-                return editview(request, domainname, postok=False)
+                dom.checksplit()
+                rec = Record.append(dom, form.cleaned_data.get('dnsrecord'))
+                if isfragment(request):
+                    return rowreply(domainname, rec)
+                return editview(request, domainname, postok=False, showrec=rec.seq)
 
         # otherwise fall through to edit again
+        if isfragment(request):
+            return formerrors(form)
     else:
         rrname = request.POST['rrname']
         form = RRForm(rrname=rrname)
 
+    if isfragment(request):
+        return render(request, 'editapp/recordform.html',
+            { 'form': form, 'action': reverse('editapp:recordadd', args=(domainname,)) })
     return render(request, 'editapp/recordadd.html',
         {
             'form': form,
@@ -305,6 +613,9 @@ def bpnav(request, here):
     bo = "<ul id=tabnav>\n"
     bo += bp("/edit","Home")
     bo += bp("/edit/create","Create a domain")
+    bo += bp("/edit/search","Find records")
+    if request.user.is_staff:
+        bo += bp("/edit/replace","Replace")
 #    bo += bp("/edit/test","Test something")
     bo += bp("/admin","Admin")
     bo += bp("/logout?next=/edit", "Logout")
@@ -0,0 +1,115 @@
+# cache of zones' record lists for the edit views
+# entries are keyed by domain name and only used if the domain hasn't
+# been updated since the entry was made
+# the rendered record table rows for each page are cached the same way,
+# each window under its own key so the cache can evict them one at a time
+
+from django.core.cache import caches
+from django.conf import settings
+from . import metrics
+import logging
+
+logger = logging.getLogger(__name__)
+
+# hit and miss counters for this process
+stats = { 'hits': 0, 'misses': 0 }
+
+def zcache():
+    """
+    the django cache that holds the zones, settings.ZONE_CACHE
+    names it, default 'zones' if there is one
+    """
+    name = getattr(settings, 'ZONE_CACHE', 'zones')
+    if name not in settings.CACHES:
+        name = 'default'
+    return caches[name]
+
+def _key(domainname):
+    return "zone:" + domainname
+
+def _rowskey(domainname, offset, limit):
+    return "rows:{0}:{1}:{2}".format(domainname, offset, limit)
+
+def _count(what):
+    """
+    bump a counter, log them now and then
+    """
+    stats[what] += 1
+    metrics.inc('editapp_zone_cache_{0}_total'.format(what))
+    n = stats['hits'] + stats['misses']
+    if n % getattr(settings, 'ZONE_CACHE_LOG_EVERY', 1000) == 0:
+        logger.info("zone cache: %d hits %d misses", stats['hits'], stats['misses'])
+
+def hitratio():
+    """
+    fraction of lookups that were hits, None if no lookups yet
+    """
+    n = stats['hits'] + stats['misses']
+    return stats['hits'] / n if n else None
+
+def zoneview(dom, offset=0, limit=None):
+    """
+    a window of a domain's records in zone order, limit None for the rest
+    returns (total records, [(seq, valid, rrtext), ...])
+    from the cache if it's there and current
+    zones too big to cache are read from the database a window at a time
+    """
+    end = None if limit is None else offset + limit
+    c = zcache()
+    ent = c.get(_key(dom.domain))
+    if ent and ent[0] == dom.updated:
+        _count('hits')
+        return len(ent[1]), ent[1][offset:end]
+
+    _count('misses')
+    recs = dom.record_set.order_by('seq').values_list('seq', 'valid', 'text')
+    total = recs.count()
+    if total == 0 and dom.checksplit():
+        total = recs.count()
+
+    # don't let one giant zone push everything else out
+    if total > getattr(settings, 'ZONE_CACHE_MAX_RECORDS', 100000):
+        return total, list(recs[offset:end])
+    view = list(recs)
+    c.set(_key(dom.domain), (dom.updated, view))
+    return len(view), view[offset:end]
+
+def recposition(dom, seq):
+    """
+    position in the zone of record seq, or where it would be
+    """
+    return dom.record_set.filter(seq__lt=seq).count()
+
+def cachedrows(dom, offset, limit, render):
+    """
+    rendered table rows for a window of a domain's records
+    returns (total records, records in the window, html)
+    render(rrview) makes the html from a window from zoneview() when
+    it's not cached
+    windows of older versions of the zone are ignored, and left for
+    the cache to evict
+    """
+    c = zcache()
+    key = _rowskey(dom.domain, offset, limit)
+    ent = c.get(key)
+    if ent and ent[0] == dom.updated:
+        metrics.inc('editapp_row_cache_hits_total')
+        return ent[1:]
+
+    metrics.inc('editapp_row_cache_misses_total')
+    total, rrview = zoneview(dom, offset, limit)
+    ent = (dom.updated, total, len(rrview), render(rrview))
+    c.set(key, ent)
+    return ent[1:]
+
+def invalidate(domainname):
+    """
+    forget a domain, e.g. when it's been saved
+    """
+    zcache().delete(_key(domainname))
+
+def domain_changed(sender, instance, **kwargs):
+    """
+    post_save and post_delete handler for Domain
+    """
+    invalidate(instance.domain)
@@ -0,0 +1,195 @@
+# read zones in BIND master file format and store them
+# parsing is done without the database so it can run in other processes
+
+from django.db import transaction
+from django.utils import timezone
+from datetime import datetime
+from .models import Domain, Record, RdataRef, PendingExport, Change, rrkeys
+from . import metrics
+from collections import Counter, defaultdict
+from time import perf_counter
+import re
+
+# seconds in BIND TTL units
+TTLUNITS = { 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800 }
+
+def ttlsecs(tok):
+    """
+    TTL like 3600 or 1h30m in seconds, None if it isn't a TTL
+    """
+    if tok.isdigit():
+        return int(tok)
+    parts = re.findall(r'(\d+)([smhdw])', tok.lower())
+    if not parts or "".join(n+u for n, u in parts) != tok.lower():
+        return None
+    return sum(int(n) * TTLUNITS[u] for n, u in parts)
+
+def logical(text):
+    """
+    join records continued with parentheses and drop comments at the
+    ends of lines, generates lines
+    whole line comments are kept
+    """
+    buf = ""
+    depth = 0
+    for line in text.splitlines():
+        if depth == 0 and line.lstrip().startswith(';'):
+            yield line
+            continue
+        out = []
+        quoted = False
+        esc = False
+        for c in line:
+            if esc:
+                esc = False
+            elif c == '\\':
+                esc = True
+            elif c == '"':
+                quoted = not quoted
+            elif not quoted:
+                if c == ';':
+                    break
+                if c == '(':
+                    depth += 1
+                    c = ' '
+                elif c == ')':
+                    depth -= 1
+                    c = ' '
+            out.append(c)
+        buf += "".join(out) if not buf else " " + "".join(out).strip()
+        if depth <= 0:
+            depth = 0
+            if buf.strip():
+                yield re.sub(r'\s+$', '', buf)
+            buf = ""
+    if depth:
+        raise ValueError("Unbalanced parentheses")
+
+def zonelines(text, zone, keepsoa=False):
+    """
+    turn a BIND zone file into the one record per line form the
+    editor uses
+    @ becomes the zone name, $TTL is put on records without one, TTLs
+    with units are turned into seconds, and the SOA is dropped unless
+    keepsoa since HEAD usually provides it
+    raises ValueError for things it can't handle
+    """
+    origin = zone.lower().rstrip('.') + '.'
+    defttl = None
+    lines = []
+    for line in logical(text):
+        if line.lstrip().startswith(';'):
+            lines.append(line)
+            continue
+        if line.startswith('$'):
+            toks = line.split()
+            if toks[0].upper() == '$TTL' and len(toks) > 1 and ttlsecs(toks[1]) is not None:
+                defttl = ttlsecs(toks[1])
+                continue
+            if toks[0].upper() == '$ORIGIN' and len(toks) > 1 and toks[1].lower() == origin:
+                continue
+            raise ValueError("Can't handle " + line)
+
+        m = re.match(r'(\S*)(\s+)(.*)', line)
+        if not m:
+            raise ValueError("No record type in " + line)
+        owner, sp, rest = m.groups()
+        if owner == '@':
+            owner = origin
+        toks = rest.split(None, 2)
+
+        # TTL and class can come in either order before the rrtype
+        ttl = None
+        for n in (0, 1):
+            if n < len(toks) and ttlsecs(toks[n]) is not None:
+                ttl = ttlsecs(toks[n])
+                del toks[n]
+                break
+            if n < len(toks) and toks[n].upper() not in ('IN', 'CH', 'HS'):
+                break
+        if ttl is None:
+            ttl = defttl
+        rest = " ".join(toks)
+        if not keepsoa and re.match(r'((in|IN)\s+)?(soa|SOA)\b', rest):
+            continue
+        lines.append(owner + sp + (str(ttl) + " " if ttl is not None else "") + rest)
+    return lines
+
+def parsezone(zone, text, keepsoa=False):
+    """
+    parse a zone without touching the database
+    returns (zone, [(name, ttl, rrtype, rdata, text, valid, refs), ...], [errors])
+    with the records empty if it can't be read at all
+    """
+    t = perf_counter()
+    try:
+        lines = zonelines(text, zone, keepsoa)
+    except ValueError as e:
+        return zone, [], [str(e)]
+    recs = []
+    errs = []
+    for n, l in enumerate(lines):
+        r = Record(domain_id=zone, seq=n)
+        r.settext(l)
+        recs.append((r.name, r.ttl, r.rrtype, r.rdata, r.text, r.valid, r.refs))
+        if not r.valid:
+            errs.append("record {0}: {1}".format(n+1, l))
+    metrics.observe('editapp_parse_seconds', perf_counter() - t, kind='import')
+    metrics.inc('editapp_parse_records_total', len(lines), kind='import')
+    return zone, recs, errs
+
+def journalreplaced(zones, old):
+    """
+    journal the differences between the zones in old as they are
+    and as they're about to be replaced by zones
+    """
+    oldrecs = defaultdict(list)
+    for d, name, ttl, rrtype, rdata, valid in Record.objects.filter(domain_id__in=old) \
+            .order_by('domain', 'seq').values_list('domain', 'name', 'ttl', 'rrtype', 'rdata', 'valid'):
+        oldrecs[d].append((name, ttl, rrtype, rdata, valid))
+    # zones from before there were records
+    for d in Domain.objects.filter(domain__in=old - set(oldrecs)).only('domain', 'rrs'):
+        oldrecs[d.domain] = [ (r.name, r.ttl, r.rrtype, r.rdata, r.valid)
+            for r in (Record.fromtext(d, n, l) for n, l in enumerate(d.rrs.splitlines())) ]
+
+    changes = []
+    for z, recs in zones:
+        if z not in old:
+            continue
+        o = Counter(rrkeys(oldrecs[z]))
+        n = Counter(rrkeys((name, ttl, rrtype, rdata, valid) for name, ttl, rrtype, rdata, text, valid, refs in recs))
+        changes.extend(Change(domain=z, op=op, name=k[0], ttl=k[1], rrtype=k[2], rdata=k[3])
+            for op, keys in (('del', o - n), ('add', n - o)) for k in keys.elements())
+    Change.objects.bulk_create(changes, batch_size=500)
+
+def storezones(zones, owner, replace=False):
+    """
+    store a batch of parsed zones in one transaction
+    zones is [(zone, recs)] from parsezone
+    with replace, existing zones are replaced and the differences
+    journaled, otherwise they're skipped
+    returns the names of zones that already existed and were skipped
+    """
+    names = [ z for z, recs in zones ]
+    t = timezone.now()
+    with transaction.atomic():
+        old = set(Domain.objects.filter(domain__in=names).values_list('domain', flat=True))
+        if replace:
+            journalreplaced(zones, old)
+            Domain.objects.filter(domain__in=old).delete()
+        else:
+            zones = [ (z, recs) for z, recs in zones if z not in old ]
+        Domain.objects.bulk_create([ Domain(domain=z, owner=owner, updated=t,
+            exported=timezone.make_aware(datetime(2000,1,1)), rrs="\n".join(r[4] for r in recs))
+            for z, recs in zones ])
+        rows = []
+        for z, recs in zones:
+            for n, (name, ttl, rrtype, rdata, text, valid, refs) in enumerate(recs):
+                r = Record(domain_id=z, seq=n, name=name, ttl=ttl, rrtype=rrtype, rdata=rdata,
+                    text=text, valid=valid)
+                r.refs = refs
+                rows.append(r)
+        Record.objects.bulk_create(rows, batch_size=500)
+        RdataRef.add(rows)
+        PendingExport.queuemany([ z for z, recs in zones ], t)
+    return [] if replace else sorted(old)
@@ -36,6 +36,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'editapp.middleware.TimingMiddleware',  # first so it times everything
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -43,8 +44,12 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'editapp.middleware.ProfileMiddleware',  # last, it calls the view
 ]
 
+# fraction of editapp requests to profile, see editapp/profiles.py
+PROFILE_SAMPLE = 0
+
 ROOT_URLCONF = 'editdns.urls'
 
 TEMPLATES = [
@@ -81,6 +86,38 @@ DATABASES = {
     }
 }
 
+# Caches
+# 'zones' holds parsed zones for the edit pages, see editapp/zonecache.py
+# 'lines' holds the results of checking lines of block edits, lots of
+# small entries, so it has its own limit and can't push out the zones
+# locmem is per process and evicts least recently used entries past
+# MAX_ENTRIES, use a shared backend like memcached with multiple workers
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'zones': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'editapp-zones',
+        'TIMEOUT': 3600,
+        'OPTIONS': {
+            'MAX_ENTRIES': 200,
+        },
+    },
+    'lines': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'editapp-lines',
+        'TIMEOUT': 3600,
+        'OPTIONS': {
+            'MAX_ENTRIES': 50000,
+        },
+    },
+}
+
+# zones with more records than this aren't cached
+ZONE_CACHE_MAX_RECORDS = 100000
+
 LOGIN_URL = '/login/'
 
 # Password validation